@@ -1,22 +1,81 @@
 # app.py
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash
+from flask import (Flask, render_template, request, redirect, url_for, jsonify, session, flash, Response, make_response,
+                   stream_with_context, send_from_directory, current_app)
 from config import Config
-from models import db, SafetyReport, Drug, Patient, Reaction, Company
+from models import db, SafetyReport, Drug, Patient
 from flask_caching import Cache
-from sqlalchemy.orm import joinedload
-from sqlalchemy import func, extract
-from collections import defaultdict
+from sqlalchemy.orm import joinedload, selectinload
 import math
-from sqlalchemy.orm import aliased
+import os
 import datetime
 import hashlib
+import uuid
+from suggestions import suggestion_index
+from stats_engine import compute_statistics, matching_report_ids, AGE_GROUP_LABELS, SERIOUS_CRITERIA
+from search_engine import SearchFilters, compute_facets, search_reports, SEX_LABELS
+from pagination import encode_cursor, decode_cursor, keyset_page, count_cache, estimate_table_rows
+import rollups
+import ingest
+from caching import view_cache
+import signal_detection
+import interactions
+import columnar
+import synthetic
+import benchmark
+import migrations
+import drug_dictionary
+import comparison
+import export
+import report_data
+from query_executor import query_executor, QueryTimeout
+from instrumentation import instrumentation
+from replicas import replica_router
+import jobs
+from jobs import job_queue, JobLimitError, JobsDisabledError
+import partitions
+from partitions import partition_router
+import dedup
+import warmup
+import bulk_admin
+import snapshot
+import approximate
+
+# Response cache, bound to each application by create_app()
+cache = Cache()
+
+
+class RouteTable:
+    """
+    Collects the routes and error handlers declared in this module, so
+    create_app() can attach them to every application it builds under
+    their plain endpoint names.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.error_handlers = []
+
+    def route(self, rule, **options):
+        def decorator(f):
+            self.rules.append((rule, f, options))
+            return f
+        return decorator
+
+    def errorhandler(self, code_or_exception):
+        def decorator(f):
+            self.error_handlers.append((code_or_exception, f))
+            return f
+        return decorator
+
+    def register(self, app):
+        for (rule, f, options) in self.rules:
+            app.add_url_rule(rule, view_func=f, **options)
+        for (code_or_exception, f) in self.error_handlers:
+            app.register_error_handler(code_or_exception, f)
+
 
-# Initialize the Flask application
-app = Flask(__name__)
-app.config.from_object(Config)
-db.init_app(app)
-cache = Cache(app)
+routes = RouteTable()
 
 # Precomputed SHA-256 hash for admin password authentication
 ADMIN_PW_HASH = "4813494d137e1631bba301d5acab6e7bb7aa74ce1185d456565ef51d737677b2"
@@ -25,7 +84,7 @@ ADMIN_PW_HASH = "4813494d137e1631bba301d5acab6e7bb7aa74ce1185d456565ef51d737677b
 # HOME PAGE ROUTES
 #########################
 
-@app.route('/home')
+@routes.route('/home')
 def home():
     """
     Renders the home page of the application.
@@ -33,38 +92,76 @@ def home():
     return render_template('home.html')
 
 
-@app.route('/')
+@routes.route('/')
+@view_cache.cached()
+@replica_router.use_replica()
 def index():
     """
-    Displays a paginated table of safety reports.
+    Displays a paginated table of safety reports, one row per report.
     Allows optional filtering by drug name.
+    Next/previous links carry keyset cursors on (receivedate, safetyreportid);
+    a bare page number still works through OFFSET for shallow pages.
+    With dedup=1, earlier versions of duplicate reports are hidden; with
+    approx=1, the total of a broad drug filter is estimated instead of counted.
     """
-    page = int(request.args.get('page', '1'))
+    page = max(1, int(request.args.get('page', '1')))
     filter_drug = request.args.get('filter_drug', '').strip()
+    deduplicated = dedup_requested()
+    approx = approx_requested()
+    after = decode_cursor(request.args.get('after'), 2)
+    before = decode_cursor(request.args.get('before'), 2)
     per_page = 30
-    offset_val = (page - 1) * per_page
 
-    # Alias for Patient to facilitate joins
-    P = aliased(Patient)
-
-    # Base query with outer join to Patient for demographic details
-    q = (db.session.query(SafetyReport, P)
-         .outerjoin(P, SafetyReport.safetyreportid == P.safetyreportid))
+    # Base query over reports only, so multi-patient reports are not repeated
+    q = SafetyReport.query
 
     # Apply drug name filter if provided
     if filter_drug:
-        q = (q.join(Drug, SafetyReport.safetyreportid == Drug.safetyreportid)
-               .filter(Drug.medicinalproduct.ilike(f"%{filter_drug}%")))
-
-    # Order results by received date in descending order
-    q = q.order_by(SafetyReport.receivedate.desc())
+        q = q.filter(SafetyReport.safetyreportid.in_(matching_report_ids(filter_drug, deduplicated=deduplicated)))
+    elif deduplicated:
+        q = q.filter(dedup.canonical_only(SafetyReport.safetyreportid))
+
+    # Newest first, with the report id as a unique tie-breaker
+    order_columns = [SafetyReport.receivedate, SafetyReport.safetyreportid]
+
+    # The columnar store does not know the duplicate clusters
+    store = None if deduplicated else columnar.get_store()
+    if store is not None:
+        # The columnar store resolves the filter and page; only the page is loaded
+        page_ids, has_more, total_count = store.page_report_ids(filter_drug, per_page, page, after, before)
+        by_id = {sr.safetyreportid: sr for sr in SafetyReport.query.filter(SafetyReport.safetyreportid.in_(page_ids))}
+        reports = [by_id[i] for i in page_ids if i in by_id]
+        has_prev = has_more if before is not None else (after is not None or page > 1)
+        has_next = has_more if before is None else True
+    elif partition_router.enabled:
+        # Filled from the newest receivedate period backwards
+        reports, has_more = partition_router.page(q, order_columns, per_page, page, after, before,
+                                                  cache_key=('index', filter_drug.lower(), deduplicated),
+                                                  filtered=bool(filter_drug) or deduplicated)
+        has_prev = has_more if before is not None else (after is not None or page > 1)
+        has_next = has_more if before is None else True
+    elif before is not None:
+        reports, has_prev = keyset_page(q, order_columns, per_page, before=before)
+        has_next = True
+    elif after is not None:
+        reports, has_next = keyset_page(q, order_columns, per_page, after=after)
+        has_prev = True
+    else:
+        reports = (q.order_by(*[c.desc() for c in order_columns])
+                   .offset((page - 1) * per_page)
+                   .limit(per_page + 1)
+                   .all())
+        has_next = len(reports) > per_page
+        reports = reports[:per_page]
+        has_prev = page > 1
 
-    total_count = q.count()
-    results = q.offset(offset_val).limit(per_page).all()
+    # Fetch the first listed patient of each report on this page
+    first_patients = get_first_patients([sr.safetyreportid for sr in reports])
 
     # Prepare data rows for rendering
     rows = []
-    for (sr, pt) in results:
+    for sr in reports:
+        pt = first_patients.get(sr.safetyreportid)
         rows.append({
             'safetyreportid': sr.safetyreportid,
             'receivedate': sr.receivedate,
@@ -73,37 +170,64 @@ def index():
             'sex': pt.patientsex if pt else None
         })
 
-    # Calculate total number of pages
-    total_pages = max(1, math.ceil(total_count / per_page))
+    # Totals are cached; the unfiltered total is a table estimate where available
+    # (the columnar store already counted its matches)
+    data_version = view_cache.data_version()
+    estimate = approximate.estimate_matches(filter_drug) if approx and store is None else None
+    total_margin = None
+    if estimate is not None:
+        (total_count, total_margin) = estimate
+    elif store is None and (filter_drug or deduplicated):
+        total_count = count_cache.get_or_compute(('index', data_version, filter_drug.lower(), deduplicated),
+                                                 q.count)
+    elif store is None:
+        total_count = count_cache.get_or_compute(('index', data_version, ''),
+                                                 lambda: estimate_table_rows(SafetyReport))
+    total_pages = max(1, math.ceil(total_count / per_page), page)
+
+    # Cursors pointing at the first and last rows of this page
+    prev_cursor = encode_cursor([reports[0].receivedate, reports[0].safetyreportid]) if reports else None
+    next_cursor = encode_cursor([reports[-1].receivedate, reports[-1].safetyreportid]) if reports else None
 
     return render_template(
         'index.html',
         rows=rows,
         page=page,
         total_pages=total_pages,
-        filter_drug=filter_drug
+        filter_drug=filter_drug,
+        dedup=deduplicated,
+        approx=approx,
+        total_count=total_count,
+        total_margin=total_margin,
+        has_prev=has_prev and prev_cursor is not None,
+        has_next=has_next and next_cursor is not None,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor
     )
 
 
-@app.route('/report/<safetyreportid>')
+@routes.route('/report/<safetyreportid>')
+@view_cache.cached()
+@replica_router.use_replica()
 def report_detail(safetyreportid):
     """
     Provides detailed information for a specific safety report.
     Includes patient demographics, reactions, and associated drugs.
-    Groups drugs by medicinal product to consolidate entries.
+    Groups drugs by their drug dictionary product to consolidate entries.
     """
-    # Retrieve the safety report along with related data
+    # Retrieve the safety report along with related data; each collection is
+    # loaded by its own query instead of one joined patients x drugs x reactions product
     report = (SafetyReport.query
-              .options(joinedload(SafetyReport.patients))
-              .options(joinedload(SafetyReport.drugs))
-              .options(joinedload(SafetyReport.reactions))
+              .options(selectinload(SafetyReport.patients))
+              .options(selectinload(SafetyReport.drugs))
+              .options(selectinload(SafetyReport.reactions))
               .options(joinedload(SafetyReport.company))
               .get_or_404(safetyreportid))
 
     # Organize drugs by medicinal product to avoid duplication
     drug_groups = {}
     for d in report.drugs:
-        product_key = (d.medicinalproduct or 'Unknown').strip().lower()
+        product_key = d.drug_product_id or (d.medicinalproduct or 'Unknown').strip().lower()
         if product_key not in drug_groups:
             drug_groups[product_key] = {
                 'medicinalproduct': d.medicinalproduct or 'Unknown',
@@ -121,197 +245,438 @@ def report_detail(safetyreportid):
                            grouped_drugs=grouped_drugs)
 
 
-@app.route('/autocomplete', methods=['GET'])
+@routes.route('/api/reports')
+@replica_router.use_replica()
+def api_reports():
+    """
+    Returns one or more reports (ids=<id>,<id>,...) with their company,
+    patients, drugs and reactions as compact JSON, omitting empty fields.
+    Responses carry a strong ETag, so repeat requests are answered with
+    304 Not Modified until the data changes.
+    """
+    ids = []
+    for part in ','.join(request.args.getlist('ids')).split(','):
+        part = part.strip()
+        if part and part not in ids:
+            ids.append(part)
+    if not ids:
+        return jsonify({"error": "No report ids given."}), 400
+    max_ids = current_app.config['REPORT_API_MAX_IDS']
+    if len(ids) > max_ids:
+        return jsonify({"error": f"At most {max_ids} reports can be requested at once."}), 400
+
+    # The body and its ETag are cached together, so a revalidation is
+    # answered without touching the database
+    key = view_cache.make_key(request.endpoint, {}) if view_cache.cache is not None and view_cache.enabled else None
+    entry = view_cache.cache.get(key) if key else None
+    if key:
+        view_cache.stats.record(request.endpoint, entry is not None)
+    if entry is None:
+        reports = report_data.load_reports(ids)
+        found = {r['safetyreportid'] for r in reports}
+        body = report_data.dumps({'reports': reports, 'missing': [i for i in ids if i not in found]},
+                                 compact_output=True)
+        entry = (body, hashlib.sha256(body.encode('utf-8')).hexdigest()[:32])
+        if key:
+            view_cache.cache.set(key, entry, timeout=view_cache.timeouts.get(request.endpoint))
+
+    (body, etag) = entry
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={current_app.config['REPORT_API_MAX_AGE']}"
+    return response.make_conditional(request)
+
+
+@routes.route('/autocomplete', methods=['GET'])
+@view_cache.cached()
+@replica_router.use_replica()
 def autocomplete():
     """
     Provides autocomplete suggestions for drug names based on user input.
-    Returns a JSON list of matching medicinal products.
+    Served from the in-memory suggestion index rather than a table scan.
+    Returns a JSON list of matching medicinal products and active substances.
     """
     query = request.args.get('q', '').strip()
     suggestions = []
     if query:
-        drug_q = (Drug.query
-                  .filter(Drug.medicinalproduct.ilike(f"%{query}%"))
-                  .with_entities(Drug.medicinalproduct)
-                  .distinct()
-                  .limit(10)
-                 )
-        results = drug_q.all()
-        suggestions = [r[0] for r in results]
+        # Build the in-memory index on first use if startup warm-up was skipped,
+        # and rebuild it in the background once the data version moves on
+        data_version = view_cache.data_version()
+        if not suggestion_index.ready:
+            suggestion_index.load_from_db(data_version)
+        elif suggestion_index.data_version != data_version:
+            suggestion_index.refresh_in_background(current_app._get_current_object(), data_version)
+        suggestions = suggestion_index.suggest(query, limit=10)
     return jsonify(suggestions)
 
 
-@app.route('/search')
+@routes.route('/search')
+@view_cache.cached()
+@replica_router.use_replica()
 def search():
     """
-    Handles search functionality for safety reports based on drug names.
-    Supports pagination and indicates if more results are available.
+    Faceted search over safety reports.
+    Filters on drug and reaction name prefixes, reporter country, receive
+    date range, seriousness, age group and sex, and returns facet counts
+    for the matching reports alongside a page of results.
     """
-    query = request.args.get('query', '').strip()
-    offset = int(request.args.get('offset', '0'))
-    limit = 30
-    has_more = False
-    reports = []
-
-    if query:
-        q = (SafetyReport.query
-             .join(Drug, SafetyReport.safetyreportid == Drug.safetyreportid)
-             .filter(Drug.medicinalproduct.ilike(f"%{query}%"))
-             .order_by(SafetyReport.transmissiondate.desc()))
+    filters = SearchFilters.from_args(request.args)
+    page = max(1, int(request.args.get('page', '1')))
+    after = decode_cursor(request.args.get('after'), 2)
+    before = decode_cursor(request.args.get('before'), 2)
+    per_page = 30
 
-        total_matched = q.count()
-        has_more = (offset + limit) < total_matched
+    reports = []
+    facets = None
+    has_prev = has_next = False
+    if not filters.is_empty():
+        facets = compute_facets(filters.conditions())
+        if facets.total:
+            reports, has_more = search_reports(filters, per_page, page, after, before)
+            has_prev = has_more if before is not None else (after is not None or page > 1)
+            has_next = has_more if before is None else True
+
+    first_patients = get_first_patients([sr.safetyreportid for sr in reports])
+    rows = []
+    for sr in reports:
+        pt = first_patients.get(sr.safetyreportid)
+        rows.append({
+            'safetyreportid': sr.safetyreportid,
+            'receivedate': sr.receivedate,
+            'country': sr.primarysource_reportercountry,
+            'serious': sr.serious,
+            'age_group': pt.patientagegroup if pt else None,
+            'sex': pt.patientsex if pt else None
+        })
 
-        reports = q.offset(offset).limit(limit).all()
+    total_pages = max(1, math.ceil((facets.total if facets else 0) / per_page), page)
+    prev_cursor = encode_cursor([reports[0].receivedate, reports[0].safetyreportid]) if reports else None
+    next_cursor = encode_cursor([reports[-1].receivedate, reports[-1].safetyreportid]) if reports else None
 
     return render_template('search.html',
-                           reports=reports,
-                           query=query,
-                           offset=offset,
-                           limit=limit,
-                           has_more=has_more)
-
-
-@app.route('/statistics')
+                           filters=filters,
+                           facets=facets,
+                           rows=rows,
+                           page=page,
+                           total_pages=total_pages,
+                           has_prev=has_prev and prev_cursor is not None,
+                           has_next=has_next and next_cursor is not None,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
+                           criteria_options=[(c.key, label) for (label, c) in SERIOUS_CRITERIA],
+                           age_group_labels=AGE_GROUP_LABELS,
+                           sex_labels=SEX_LABELS)
+
+
+@routes.route('/statistics')
+@view_cache.cached()
+@replica_router.use_replica()
 def statistics():
     """
     Displays statistical dashboards for a specified drug.
     Includes reports over time, age distribution, seriousness, country distribution, and top reactions.
+    Queries too broad to answer inline run as a background job while the page polls for progress,
+    unless approx=1 lets them be estimated from the report sample.
     """
     drug_query = request.args.get('drug', '').strip()
-    if not drug_query:
-        # Render statistics page with no data if no drug is specified
-        return render_template('statistics.html',
-                               query=drug_query,
-                               total_reports=0,
-                               monthly_data={},
-                               age_group_counts={},
-                               seriousness_counts={},
-                               serious_criteria_counts={},
-                               country_counts={},
-                               top_reactions={})
-
-    # Filter safety reports related to the specified drug
-    base_query = (SafetyReport.query
-                  .join(Drug, SafetyReport.safetyreportid == Drug.safetyreportid)
-                  .filter(Drug.medicinalproduct.ilike(f"%{drug_query}%")))
-
-    total_reports = base_query.count()
-    if total_reports == 0:
-        # Render statistics page with no data if no reports are found
-        return render_template('statistics.html',
-                               query=drug_query,
-                               total_reports=0,
-                               monthly_data={},
-                               age_group_counts={},
-                               seriousness_counts={},
-                               serious_criteria_counts={},
-                               country_counts={},
-                               top_reactions={})
-
-    # Aggregate reports by year and month
-    monthly_counts_query = (
-        base_query.with_entities(
-            extract('year', SafetyReport.receivedate).label('yr'),
-            extract('month', SafetyReport.receivedate).label('mo'),
-            func.count(SafetyReport.safetyreportid)
-        )
-        .group_by('yr', 'mo')
-        .order_by('yr', 'mo')
-        .all()
-    )
-    monthly_data = {}
-    for (yr, mo, cnt) in monthly_counts_query:
-        label = f"{int(yr)}-{int(mo):02d}"
-        monthly_data[label] = int(cnt)
-
-    # Define age group mappings
-    age_map = {1: "Neonate", 2: "Infant", 3: "Child", 4: "Adolescent", 5: "Adult", 6: "Elderly"}
-
-    # Aggregate patient age groups
-    age_query = (
-        base_query.join(Patient, SafetyReport.safetyreportid == Patient.safetyreportid)
-        .with_entities(Patient.patientagegroup, func.count(Patient.id))
-        .group_by(Patient.patientagegroup)
-        .all()
-    )
-    age_group_counts = defaultdict(int)
-    for (age_val, c_) in age_query:
-        label = age_map.get(age_val, "Unknown")
-        age_group_counts[label] += c_
-
-    # Calculate counts for serious and non-serious reports
-    serious_count = base_query.filter(SafetyReport.serious == 1).count()
-    non_serious_count = base_query.filter(SafetyReport.serious != 1).count()
-    seriousness_counts = {
-        "Serious": serious_count,
-        "Non-Serious": non_serious_count
-    }
+    deduplicated = dedup_requested()
+    approx = approx_requested()
+    # Broad queries are estimated when asked for, otherwise run as a background job
+    estimate = approximate.statistics(drug_query) if approx else None
+    if estimate is not None:
+        result = estimate.to_dict()
+    else:
+        job = job_queue.defer('statistics', {'drug': drug_query, 'dedup': deduplicated}, get_job_owner())
+        if job is not None and job['status'] != 'done':
+            return render_job_pending(job)
+        result = job['result'] if job else get_drug_statistics(drug_query, deduplicated).to_dict()
+    response = make_response(render_template('statistics.html', dedup=deduplicated, approx=approx, **result))
+    if result['unavailable']:
+        # Partial results after a query timeout must not be cached
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@routes.route('/api/statistics')
+@view_cache.cached()
+@replica_router.use_replica()
+def api_statistics():
+    """
+    Returns the statistics dashboard data for a specified drug as JSON.
+    Broad queries answer 202 with a job whose status_url returns the result once done,
+    or with estimates and their margins of error under approx=1.
+    """
+    drug_query = request.args.get('drug', '').strip()
+    deduplicated = dedup_requested()
+    estimate = approximate.statistics(drug_query) if approx_requested() else None
+    if estimate is not None:
+        result = estimate.to_dict()
+    else:
+        job = job_queue.defer('statistics', {'drug': drug_query, 'dedup': deduplicated}, get_job_owner())
+        if job is not None and job['status'] != 'done':
+            return job_accepted_response(job)
+        result = job['result'] if job else get_drug_statistics(drug_query, deduplicated).to_dict()
+    response = jsonify(result)
+    if result['unavailable']:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@routes.route('/compare')
+@view_cache.cached()
+@replica_router.use_replica()
+def compare():
+    """
+    Displays the statistics of several drugs side by side, with the number
+    of reports shared between them.
+    """
+    raw = request.args.get('drugs', '')
+    deduplicated = dedup_requested()
+    criteria_labels = [label for (label, _) in SERIOUS_CRITERIA]
+    try:
+        queries = comparison.parse_drug_list(raw, current_app.config['COMPARE_MAX_DRUGS'])
+    except ValueError as e:
+        return render_template('compare.html', drugs=raw, error=str(e), criteria_labels=criteria_labels,
+                               dedup=deduplicated, **comparison.ComparisonResult([]).to_dict()), 400
+    job = job_queue.defer('compare', {'drugs': queries, 'dedup': deduplicated}, get_job_owner())
+    if job is not None and job['status'] != 'done':
+        return render_job_pending(job)
+    result = job['result'] if job else comparison.compare_drugs(queries, deduplicated=deduplicated).to_dict()
+    response = make_response(render_template('compare.html', drugs=', '.join(queries), error=None,
+                                             criteria_labels=criteria_labels, dedup=deduplicated, **result))
+    if result['unavailable']:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@routes.route('/api/compare')
+@view_cache.cached()
+@replica_router.use_replica()
+def api_compare():
+    """
+    Returns the side-by-side statistics of several drugs as JSON.
+    Accepts the same comma-separated 'drugs' parameter as the /compare page.
+    """
+    try:
+        queries = comparison.parse_drug_list(request.args.get('drugs', ''), current_app.config['COMPARE_MAX_DRUGS'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    deduplicated = dedup_requested()
+    job = job_queue.defer('compare', {'drugs': queries, 'dedup': deduplicated}, get_job_owner())
+    if job is not None and job['status'] != 'done':
+        return job_accepted_response(job)
+    result = job['result'] if job else comparison.compare_drugs(queries, deduplicated=deduplicated).to_dict()
+    response = jsonify(result)
+    if result['unavailable']:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@routes.route('/signals')
+@view_cache.cached()
+def signals():
+    """
+    Lists drug-reaction pairs with their disproportionality scores.
+    Supports filtering by drug, reaction and score thresholds, and sorting.
+    With dedup=1, the scores computed over deduplicated cases are listed.
+    """
+    params = get_signal_params()
+    rows, total = signal_detection.query_signals(**params)
+    total_pages = max(1, math.ceil(total / params['per_page']))
+    return render_template('signals.html',
+                           rows=rows,
+                           total=total,
+                           total_pages=total_pages,
+                           sortable=sorted(signal_detection.SORTABLE_COLUMNS),
+                           **params)
 
-    # Aggregate counts for specific seriousness criteria
-    serious_criteria_counts = {
-        "Death": base_query.filter(SafetyReport.seriousnessdeath == 1).count(),
-        "Life-Threatening": base_query.filter(SafetyReport.seriousnesslifethreatening == 1).count(),
-        "Hospitalization": base_query.filter(SafetyReport.seriousnesshospitalization == 1).count(),
-        "Disabling": base_query.filter(SafetyReport.seriousnessdisabling == 1).count(),
-        "Congenital Anomaly": base_query.filter(SafetyReport.seriousnesscongenitalanomali == 1).count(),
-        "Other": base_query.filter(SafetyReport.seriousnessother == 1).count()
-    }
 
-    # Aggregate reporter country distribution
-    country_query = (
-        base_query
-        .with_entities(SafetyReport.primarysource_reportercountry, func.count(SafetyReport.safetyreportid))
-        .group_by(SafetyReport.primarysource_reportercountry)
-        .all()
-    )
-    country_counts = {}
-    for (cc, ccount) in country_query:
-        country_label = cc if cc else "Unknown"
-        country_counts[country_label] = ccount
-
-    # Identify top 5 reactions associated with the specified drug
-    top_reactions_query = (
-        Reaction.query
-        .join(SafetyReport, Reaction.safetyreportid == SafetyReport.safetyreportid)
-        .join(Drug, Reaction.safetyreportid == Drug.safetyreportid)
-        .filter(Drug.medicinalproduct.ilike(f"%{drug_query}%"))
-        .with_entities(Reaction.reactionmeddrapt, func.count(Reaction.id))
-        .group_by(Reaction.reactionmeddrapt)
-        .order_by(func.count(Reaction.id).desc())
-        .limit(5)
-        .all()
-    )
-    top_reactions = {r: int(c_) for (r, c_) in top_reactions_query}
+@routes.route('/api/signals')
+@view_cache.cached()
+def api_signals():
+    """
+    Returns filtered and sorted disproportionality scores as JSON.
+    Accepts the same parameters as the /signals page.
+    """
+    params = get_signal_params()
+    rows, total = signal_detection.query_signals(**params)
+    return jsonify({
+        'total': total,
+        'page': params['page'],
+        'per_page': params['per_page'],
+        'deduplicated': params['deduplicated'],
+        'results': [signal_detection.signal_to_dict(r) for r in rows],
+    })
+
+
+@routes.route('/interactions')
+@view_cache.cached()
+def interactions_page():
+    """
+    Shows the drugs most often reported together with a drug and the
+    reactions over-represented when both are taken, or, with `with`, the
+    reactions of one drug pair.
+    """
+    params = get_interaction_params()
+    return render_template('interactions.html',
+                           scopes=sorted(interactions.ROLE_SCOPES),
+                           **params,
+                           **get_interaction_results(params))
 
-    # Sort seriousness criteria in descending order of report counts
-    serious_criteria_counts = sorted(serious_criteria_counts.items(), key=lambda x: x[1], reverse=True)
-    serious_criteria_counts = dict(serious_criteria_counts)
 
-    # Sort reporter country distribution in descending order of report counts
-    country_counts = sorted(country_counts.items(), key=lambda x: x[1], reverse=True)
-    country_counts = dict(country_counts)
+@routes.route('/api/interactions')
+@view_cache.cached()
+def api_interactions():
+    """
+    Returns the co-medications and interaction signals of a drug as JSON.
+    Accepts the same parameters as the /interactions page.
+    """
+    params = get_interaction_params()
+    results = get_interaction_results(params)
+    return jsonify({
+        'drug': results['drug_key'],
+        'with': params['other'] or None,
+        'scope': params['scope'],
+        'candidates': results['candidates'],
+        'co_medications': results['co_medications'],
+        'signals': [interactions.signal_to_dict(s) for s in results['signals']],
+    })
 
-    # Sort top reactions in descending order of counts
-    top_reactions = sorted(top_reactions.items(), key=lambda x: x[1], reverse=True)
-    top_reactions = dict(top_reactions)
 
-    return render_template('statistics.html',
-                           query=drug_query,
-                           total_reports=total_reports,
-                           monthly_data=monthly_data,
-                           age_group_counts=age_group_counts,
-                           seriousness_counts=seriousness_counts,
-                           serious_criteria_counts=serious_criteria_counts,
-                           country_counts=country_counts,
-                           top_reactions=top_reactions)
+#########################
+# EXPORT ROUTES
+#########################
+
+@routes.route('/export')
+@replica_router.use_replica()
+def export_reports():
+    """
+    Streams the reports matching the search filters (and the listing's
+    filter_drug) with their patients, drugs and reactions.
+    format is csv, ndjson or parquet; gzip=1 compresses CSV and NDJSON;
+    background=1 writes the file in a background job instead.
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return jsonify({"error": f"Unknown export format '{fmt}'."}), 400
+    if fmt == 'parquet' and not export.parquet_available():
+        return jsonify({"error": "Parquet export is not available on this server."}), 400
+    compress = request.args.get('gzip') == '1' and fmt != 'parquet'
+    filters = SearchFilters.from_args(request.args)
+    filter_drug = request.args.get('filter_drug', '').strip()
+
+    if request.args.get('background') == '1':
+        params = export.export_params(fmt, compress, filters, filter_drug)
+        return job_accepted_response(job_queue.submit('export', params, get_job_owner()))
+
+    # Rows are read lazily while the response body is sent
+    conditions = export.export_conditions(filters, filter_drug)
+    engine = db.session.get_bind()
+    chunks = export.export_chunks(fmt, export.iter_report_batches(conditions, current_app.config['EXPORT_BATCH_SIZE'], engine),
+                                  compress)
+    mimetype = 'application/gzip' if compress else export.FORMATS[fmt][0]
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{export.export_filename(fmt, compress)}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@routes.route('/export/<job_id>/download')
+def download_export(job_id):
+    """
+    Sends the file written by a finished background export.
+    """
+    job = job_queue.get(job_id)
+    if job is None or job['kind'] != 'export':
+        return jsonify({"error": "Export not found."}), 404
+    if job['status'] != 'done':
+        return job_accepted_response(job)
+    name = job['result']['file']
+    # Strip the unique prefix added to the stored file name
+    download_name = name.split('-', 1)[1]
+    return send_from_directory(os.path.abspath(current_app.config['EXPORT_DIR']), name, as_attachment=True, download_name=download_name)
+
+
+#########################
+# BACKGROUND JOB ROUTES
+#########################
+
+@routes.route('/api/jobs/<job_id>')
+def api_job_status(job_id):
+    """
+    Returns the status and progress of a background job as JSON,
+    including its result once it has finished.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    if job['kind'] == 'export':
+        job['download_url'] = url_for('download_export', job_id=job_id)
+    return jsonify(job)
+
+
+@routes.route('/admin/signals/compute', methods=['POST'])
+def admin_compute_signals():
+    """
+    Starts recomputing the disproportionality scores as a background job.
+    Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    min_count = request.form.get('min_count', '').strip()
+    params = {'min_count': int(min_count) if min_count.isdigit() else signal_detection.DEFAULT_MIN_COUNT}
+    return job_accepted_response(job_queue.submit('signals', params, get_job_owner()))
+
+
+@routes.route('/admin/interactions/compute', methods=['POST'])
+def admin_compute_interactions():
+    """
+    Starts recomputing the co-medication analytics as a background job.
+    Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    min_count = request.form.get('min_count', '').strip()
+    params = {'min_count': int(min_count) if min_count.isdigit() else interactions.DEFAULT_MIN_COUNT}
+    return job_accepted_response(job_queue.submit('interactions', params, get_job_owner()))
+
+
+@routes.errorhandler(JobLimitError)
+def job_limit_exceeded(e):
+    """
+    Tells the visitor to wait for one of their running jobs to finish.
+    """
+    if request.path.startswith('/api/') or request.method == 'POST':
+        return jsonify({"error": str(e)}), 429
+    return render_template('job_pending.html', job=None, error=str(e)), 429
+
+
+@routes.errorhandler(JobsDisabledError)
+def jobs_disabled(e):
+    """
+    Refuses requests that need a background job while jobs are turned off.
+    """
+    if request.path.startswith('/api/') or request.method == 'POST' or request.args.get('background') == '1':
+        return jsonify({"error": str(e)}), 403
+    return render_template('job_pending.html', job=None, error=str(e), error_title="Not Available"), 403
+
+
+@routes.errorhandler(QueryTimeout)
+def query_timed_out(e):
+    """
+    Reports a required query that was cancelled for exceeding QUERY_TIMEOUT_SECONDS.
+    """
+    message = "This query took too long and was cancelled. Try a more specific search or try again later."
+    if request.path.startswith('/api/'):
+        return jsonify({"error": message}), 503
+    return render_template('job_pending.html', job=None, error=message, error_title="Query Timed Out"), 503
 
 
 #########################
 # ADMIN PANEL ROUTES
 #########################
 
-@app.route('/admin', methods=['GET', 'POST'])
+@routes.route('/admin', methods=['GET', 'POST'])
 def admin_panel():
     """
     Manages the admin panel functionality.
@@ -339,8 +704,10 @@ def admin_panel():
     # Retrieve table name and pagination parameters
     table_name = request.args.get('table', '').strip()
     start = int(request.args.get('start', '0'))
+    after = request.args.get('after', '').strip()
     rows = []
     columns = []
+    next_after = None
     if table_name:
         model = get_model_by_name(table_name)
         if not model:
@@ -348,14 +715,23 @@ def admin_panel():
                                    table_name=None,
                                    rows=[],
                                    columns=[],
-                                   start=0)
+                                   start=0,
+                                   next_after=None)
 
         # Fetch column names for the selected table
         columns = get_model_columns(model)
 
-        # Query the selected table with pagination
-        q = db.session.query(model)
-        data_objs = q.offset(start).limit(100).all()
+        # Query the selected table in primary-key order; "after" continues
+        # from the last key shown instead of skipping rows with OFFSET
+        pk_column = db.inspect(model).primary_key[0]
+        q = db.session.query(model).order_by(pk_column)
+        if after:
+            q = q.filter(pk_column > convert_value_for_column(pk_column.type.python_type, after))
+        else:
+            q = q.offset(start)
+        data_objs = q.limit(100).all()
+        if len(data_objs) == 100:
+            next_after = getattr(data_objs[-1], pk_column.key)
 
         # Convert database objects to dictionaries for template rendering
         rows = []
@@ -377,10 +753,37 @@ def admin_panel():
                            table_name=table_name,
                            columns=columns,
                            rows=rows,
-                           start=start)
+                           start=start,
+                           next_after=next_after,
+                           pk_name=bulk_admin.primary_key(model).name if table_name else None,
+                           null_token=bulk_admin.NULL_TOKEN)
 
 
-@app.route('/admin/logout')
+@routes.route('/admin/cache-stats')
+def admin_cache_stats():
+    """
+    Returns response cache hit/miss counters and the current data version as JSON.
+    Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    stats = view_cache.stats.snapshot()
+    stats['data_version'] = view_cache.data_version()
+    return jsonify(stats)
+
+
+@routes.route('/metrics')
+def metrics():
+    """
+    Exposes request, SQL and template timing histograms for Prometheus.
+    Values are per worker process; scrape each worker or aggregate upstream.
+    """
+    if not instrumentation.enabled:
+        return render_template('404.html'), 404
+    return Response(instrumentation.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@routes.route('/admin/logout')
 def admin_logout():
     """
     Logs out the admin user by clearing the session.
@@ -390,7 +793,7 @@ def admin_logout():
     return redirect(url_for('home'))
 
 
-@app.errorhandler(404)
+@routes.errorhandler(404)
 def page_not_found(e):
     """
     Renders a custom 404 error page for undefined routes.
@@ -398,7 +801,7 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
-@app.route('/admin/edit/<table_name>/<row_id>')
+@routes.route('/admin/edit/<table_name>/<row_id>')
 def admin_edit_row(table_name, row_id):
     """
     Provides a form for editing a specific row in the admin panel.
@@ -430,7 +833,7 @@ def admin_edit_row(table_name, row_id):
                            col_values=col_values)
 
 
-@app.route('/admin/update', methods=['POST'])
+@routes.route('/admin/update', methods=['POST'])
 def admin_update():
     """
     Processes updates to a specific row in the admin panel.
@@ -448,25 +851,125 @@ def admin_update():
     if not obj:
         return jsonify({"success": False, "error": "Row not found."})
 
+    # Snapshot the rollup contributions of the affected report before editing
+    keys = [getattr(obj, bulk_admin.primary_key(model).name)]
+    affected_reports = bulk_admin.affected_report_ids(db.session, model, keys)
+    rollup_before = rollups.collect_contributions(affected_reports)
+
     columns = get_model_columns(model)
     # Update each column with form data if present
     for col in columns:
         form_key = f"col_{col}"
         if form_key in request.form:
-            raw_val = request.form[form_key]
-            # Convert the raw form value to the appropriate data type
-            converted_val = convert_value_for_column(type(getattr(obj, col)), raw_val)
+            # Convert the raw form value to the type declared by the column's schema
+            try:
+                converted_val = bulk_admin.convert_value(bulk_admin.get_column(model, col), request.form[form_key])
+            except bulk_admin.BulkEditError as e:
+                return jsonify({"success": False, "error": str(e)})
             setattr(obj, col, converted_val)
 
+    # A renamed drug is relinked to the dictionary entry of its new spelling
+    if model is Drug:
+        product_ids = drug_dictionary.resolve_product_ids(db.session, [(obj.medicinalproduct, obj.activesubstancename)])
+        obj.drug_product_id = product_ids[drug_dictionary.alias_key(obj.medicinalproduct)]
+
     # Attempt to commit changes to the database
     try:
+        # Apply only the affected report's rollup delta in the same transaction
+        db.session.flush()
+        affected_reports |= bulk_admin.affected_report_ids(db.session, model, keys)
+        rollups.refresh_reports(affected_reports, rollup_before)
         db.session.commit()
+        # Invalidate cached pages; drug name edits also change the autocomplete vocabulary
+        data_version = view_cache.bump_data_version()
+        if model is Drug:
+            suggestion_index.refresh_in_background(current_app._get_current_object(), data_version)
         return jsonify({"success": True})
     except Exception as e:
         db.session.rollback()
         return jsonify({"success": False, "error": str(e)})
 
 
+#########################
+# BULK ADMIN ROUTES
+#########################
+
+@routes.route('/admin/bulk/count', methods=['POST'])
+def admin_bulk_count():
+    """
+    Returns how many rows a mass update or delete filter matches, so the
+    admin can confirm the operation before running it.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    try:
+        model = bulk_admin.resolve_model(request.form.get('table', '').strip())
+        conditions = bulk_admin.parse_conditions(model, get_bulk_pairs('where'))
+    except bulk_admin.BulkEditError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": True, "count": bulk_admin.count_matching(model, conditions)})
+
+
+@routes.route('/admin/bulk/update', methods=['POST'])
+def admin_bulk_update():
+    """
+    Sets the submitted column values on every row matching the filter.
+    Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    params = {'table': request.form.get('table', '').strip(),
+              'where': get_bulk_pairs('where'),
+              'set': get_bulk_pairs('set')}
+    return run_bulk_operation('bulk_update', params)
+
+
+@routes.route('/admin/bulk/delete', methods=['POST'])
+def admin_bulk_delete():
+    """
+    Deletes every row matching the filter, with the patients, drugs and
+    reactions of deleted reports. Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    params = {'table': request.form.get('table', '').strip(),
+              'where': get_bulk_pairs('where')}
+    return run_bulk_operation('bulk_delete', params)
+
+
+@routes.route('/admin/bulk/edit', methods=['POST'])
+def admin_bulk_edit():
+    """
+    Saves the rows edited in the admin grid, posted as JSON:
+    {"table": ..., "rows": [{<primary key>: ..., <column>: <value>, ...}]}.
+    Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    body = request.get_json(silent=True) or {}
+    rows = [{str(k): '' if v is None else str(v) for (k, v) in row.items()}
+            for row in body.get('rows', []) if isinstance(row, dict)]
+    return run_bulk_operation('bulk_edit', {'table': str(body.get('table', '')), 'rows': rows})
+
+
+@routes.route('/admin/bulk/import', methods=['POST'])
+def admin_bulk_import():
+    """
+    Applies an uploaded CSV file whose header names the primary key and
+    the columns to set; each line updates one row. Restricted to logged-in admins.
+    """
+    if not session.get('admin_logged_in'):
+        return jsonify({"error": "Not authorized."}), 403
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({"success": False, "error": "No file uploaded."}), 400
+    upload_dir = current_app.config['BULK_UPLOAD_DIR']
+    os.makedirs(upload_dir, exist_ok=True)
+    name = f"{uuid.uuid4().hex}.csv"
+    upload.save(os.path.join(upload_dir, name))
+    return run_bulk_operation('bulk_import', {'table': request.form.get('table', '').strip(), 'file': name})
+
+
 #########################
 # HELPER FUNCTIONS
 #########################
@@ -476,14 +979,182 @@ def get_model_by_name(table_name):
     Maps a table name string to its corresponding SQLAlchemy model class.
     Returns the model class if found, else None.
     """
-    mapping = {
-        'safety_reports': SafetyReport,
-        'patients': Patient,
-        'reactions': Reaction,
-        'drugs': Drug,
-        'companies': Company
+    return bulk_admin.ADMIN_MODELS.get(table_name, None)
+
+
+def get_first_patients(report_ids):
+    """
+    Returns the first listed patient of each report, keyed by report id.
+    """
+    first_patients = {}
+    if report_ids:
+        for pt in Patient.query.filter(Patient.safetyreportid.in_(report_ids)).order_by(Patient.id):
+            first_patients.setdefault(pt.safetyreportid, pt)
+    return first_patients
+
+
+def get_float_arg(name):
+    """
+    Reads an optional float query parameter, returning None when absent or invalid.
+    """
+    raw = request.args.get(name, '').strip()
+    try:
+        return float(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def get_signal_params():
+    """
+    Collects the /signals filter, sort and paging parameters from the query string.
+    """
+    min_count = request.args.get('min_count', '').strip()
+    return {
+        'drug': request.args.get('drug', '').strip(),
+        'reaction': request.args.get('reaction', '').strip(),
+        'min_count': int(min_count) if min_count.isdigit() else signal_detection.DEFAULT_MIN_COUNT,
+        'min_prr': get_float_arg('min_prr'),
+        'min_ror_lower': get_float_arg('min_ror_lower'),
+        'min_ic025': get_float_arg('min_ic025'),
+        'sort': request.args.get('sort', 'ror_lower'),
+        'descending': request.args.get('order', 'desc') != 'asc',
+        'page': max(1, int(request.args.get('page', '1'))),
+        'per_page': min(500, max(1, int(request.args.get('per_page', '50')))),
+        'deduplicated': dedup_requested(),
+    }
+
+
+def get_interaction_params():
+    """
+    Collects the /interactions parameters from the query string.
+    """
+    scope = request.args.get('scope', interactions.DEFAULT_SCOPE)
+    return {
+        'drug': request.args.get('drug', '').strip(),
+        'other': request.args.get('with', '').strip(),
+        'scope': scope if scope in interactions.ROLE_SCOPES else interactions.DEFAULT_SCOPE,
+        'limit': min(500, max(1, int(request.args.get('limit', '50')))),
     }
-    return mapping.get(table_name, None)
+
+
+def get_interaction_results(params):
+    """
+    Resolves the drug of an /interactions request and loads its
+    co-medications and interaction signals.
+    """
+    (drug_key, candidates) = interactions.resolve_drug(params['drug'], params['scope'])
+    co_medications, signals = [], []
+    if drug_key:
+        co_medications = interactions.co_medications(drug_key, params['scope'], params['limit'])
+        signals = interactions.interaction_signals(drug_key, params['other'], params['scope'], params['limit'])
+    return {'drug_key': drug_key, 'candidates': candidates,
+            'co_medications': co_medications, 'signals': signals}
+
+
+def dedup_requested():
+    """
+    Whether the request asks to hide superseded versions of duplicate reports.
+    """
+    return request.args.get('dedup') == '1'
+
+
+def approx_requested():
+    """
+    Whether the request accepts estimates for broad drug queries.
+    Duplicate clusters are not reflected in the sample, so approximate
+    mode never applies together with dedup=1.
+    """
+    return request.args.get('approx') == '1' and not dedup_requested()
+
+
+def get_bulk_pairs(prefix):
+    """
+    Collects the [column, value] pairs of a bulk admin form, posted as
+    repeated <prefix>_column and <prefix>_value fields.
+    """
+    columns = request.form.getlist(f'{prefix}_column')
+    values = request.form.getlist(f'{prefix}_value')
+    return [[c.strip(), v] for (c, v) in zip(columns, values) if c.strip()]
+
+
+def run_bulk_operation(kind, params):
+    """
+    Runs a bulk admin operation inline, or as a background job when it
+    touches more than JOB_COST_THRESHOLD rows. Mass updates and deletes
+    need a filter unless all_rows=1 is posted.
+    """
+    try:
+        bulk_admin.check_params(kind, params)
+        if 'where' in params and not params['where'] and request.form.get('all_rows') != '1':
+            raise bulk_admin.BulkEditError("Add a filter, or confirm that every row should be changed.")
+        job = job_queue.defer(kind, params, get_job_owner())
+        if job is None:
+            (handler, _) = jobs.JOB_KINDS[kind]
+            result = handler(params, lambda fraction, message=None: None)
+    except bulk_admin.BulkEditError as e:
+        if kind == 'bulk_import':
+            bulk_admin.remove_upload(params['file'])
+        return jsonify({"success": False, "error": str(e)}), 400
+    replica_router.record_write()
+    if job is not None:
+        return job_accepted_response(job)
+    view_cache.bump_data_version()
+    return jsonify({"success": True, "result": result})
+
+
+def get_job_owner():
+    """
+    Identifies the visitor for the per-user background job limit.
+    Anonymous visitors get a random id kept in their session.
+    """
+    if session.get('admin_logged_in'):
+        return 'admin'
+    if 'job_owner' not in session:
+        session['job_owner'] = uuid.uuid4().hex
+    return session['job_owner']
+
+
+def render_job_pending(job):
+    """
+    Renders the page that polls a background job and reloads once it is done.
+    """
+    response = make_response(render_template('job_pending.html', job=job, error=None), 202)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def job_accepted_response(job):
+    """
+    JSON counterpart of render_job_pending() for the APIs.
+    """
+    body = {key: job[key] for key in ('id', 'kind', 'status', 'progress', 'message', 'error')}
+    body['status_url'] = url_for('api_job_status', job_id=job['id'])
+    if job['kind'] == 'export':
+        body['download_url'] = url_for('download_export', job_id=job['id'])
+    response = jsonify(body)
+    response.status_code = 202
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def get_drug_statistics(drug_query, deduplicated=False):
+    """
+    Returns the dashboard statistics for a drug query.
+    Uses the columnar store when it is the configured analytics backend;
+    otherwise reads the per-drug rollup tables when the query resolves to a
+    single known drug and falls back to computing from the raw tables.
+    Deduplicated statistics are always computed from the raw tables, since
+    neither the store nor the rollups know the duplicate clusters.
+    """
+    if deduplicated:
+        return compute_statistics(drug_query, deduplicated=True)
+    store = columnar.get_store()
+    if store is not None:
+        return store.statistics(drug_query)
+    result = rollups.load_statistics(drug_query)
+    if result is None:
+        result = compute_statistics(drug_query)
+    return result
 
 
 def get_model_columns(model_class):
@@ -545,7 +1216,70 @@ def convert_value_for_column(current_type, raw_val):
     return raw_val
 
 
+#########################
+# APPLICATION FACTORY
+#########################
+
+def create_app(config=Config, warm=False):
+    """
+    Builds the application: configuration, extensions, routes and CLI commands.
+    With `warm`, also runs the warm-up (see warmup.py) before returning; a
+    pre-forking server should build the application this way in its master
+    process, so every worker starts with the shared lookup structures and
+    hot responses in place.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    snapshot.init_app(app)
+    replica_router.init_app(app, db)
+    db.init_app(app)
+    snapshot.attach_engine_events(app)
+    cache.init_app(app)
+    view_cache.init_app(app, cache)
+    instrumentation.init_app(app)
+    query_executor.init_app(app)
+    partition_router.init_app(app)
+    job_queue.init_app(app)
+    routes.register(app)
+    app.cli.add_command(rollups.rollups_cli)
+    app.cli.add_command(ingest.ingest_command)
+    app.cli.add_command(signal_detection.signals_cli)
+    app.cli.add_command(interactions.interactions_cli)
+    app.cli.add_command(columnar.columnar_cli)
+    app.cli.add_command(synthetic.synth_command)
+    app.cli.add_command(benchmark.bench_cli)
+    app.cli.add_command(migrations.schema_cli)
+    app.cli.add_command(jobs.jobs_cli)
+    app.cli.add_command(export.export_command)
+    app.cli.add_command(partitions.partitions_cli)
+    app.cli.add_command(dedup.dedup_cli)
+    app.cli.add_command(warmup.warmup_command)
+    app.cli.add_command(snapshot.snapshot_cli)
+    app.cli.add_command(approximate.approx_cli)
+    if warm:
+        warmup.warm_up(app)
+    return app
+
+
+# Default application for the flask CLI, built on first access to `app`
+# so that importing this module builds nothing: gunicorn's master calls
+# create_app(warm=True) itself, and a second application would run every
+# extension's init_app twice
+_default_app = None
+
+
+def __getattr__(name):
+    global _default_app
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         db.create_all()
+        suggestion_index.load_from_db(view_cache.data_version())
     app.run(debug=False)
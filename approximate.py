@@ -0,0 +1,661 @@
+# approximate.py
+
+import collections
+import hashlib
+import math
+import threading
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, func
+
+from models import db, SafetyReport, Drug, Patient, Reaction, ReportSample, SampleStratum, DrugReportSketch
+from stats_engine import StatisticsResult, AGE_GROUP_LABELS, SERIOUS_CRITERIA, TOP_REACTIONS_LIMIT, sort_counts_desc
+from columnar import ColumnarStore, CRITERIA_COLUMNS, FETCH_BATCH_SIZE
+from caching import view_cache
+import drug_dictionary
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# Two-sided 95% normal quantile used for the margins of error
+Z_95 = 1.96
+
+# Ids per IN list while maintaining the sample
+ID_CHUNK_SIZE = 500
+
+# Rows written per executemany
+WRITE_BATCH_SIZE = 5000
+
+
+#########################
+# HASHING AND SKETCHES
+#########################
+
+def report_hash(safetyreportid):
+    """
+    Returns two independent 64-bit hashes of a report id: the first places
+    it in the HyperLogLog sketches, the second decides sample membership.
+    """
+    digest = hashlib.blake2b(safetyreportid.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big')
+
+
+def sample_position(safetyreportid):
+    """
+    Returns the report's fixed position in [0, 1); it is sampled when this
+    is below its stratum's rate, so a report keeps its membership across
+    ingestion runs and a rate change only adds or drops reports at the margin.
+    """
+    return report_hash(safetyreportid)[1] / 2 ** 64
+
+
+def hll_register(safetyreportid, precision):
+    """
+    Returns the (register, rank) a report id sets in a HyperLogLog sketch
+    with 2^precision registers.
+    """
+    h = report_hash(safetyreportid)[0]
+    register = h >> (64 - precision)
+    rest = h & ((1 << (64 - precision)) - 1)
+    rank = (64 - precision) - rest.bit_length() + 1
+    return register, rank
+
+
+def hll_estimate(registers):
+    """
+    Estimates the distinct count of a HyperLogLog register array, with the
+    linear counting correction for small cardinalities.
+    """
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / float(np.ldexp(1.0, -registers.astype(np.int64)).sum())
+    zeros = int((registers == 0).sum())
+    if raw <= 2.5 * m and zeros:
+        return m * math.log(m / zeros)
+    return raw
+
+
+def hll_relative_error(precision):
+    """
+    Returns the relative standard error of a sketch with 2^precision registers.
+    """
+    return 1.04 / math.sqrt(2 ** precision)
+
+
+def pack_registers(registers):
+    """
+    Compresses a register array for storage; sparse sketches shrink to a few bytes.
+    """
+    return zlib.compress(np.ascontiguousarray(registers, dtype=np.uint8).tobytes())
+
+
+def unpack_registers(blob, precision):
+    """
+    Restores a stored register array, checking it matches the configured precision.
+    """
+    registers = np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+    if len(registers) != 2 ** precision:
+        raise click.ClickException("The drug sketches were built with another APPROX_HLL_PRECISION; "
+                                   "run 'flask approx rebuild'.")
+    return registers
+
+
+#########################
+# STRATA
+#########################
+
+def stratum_key(receivedate, serious):
+    """
+    Returns the stratum of a report: its receive year and whether it is serious.
+    """
+    year = receivedate.year if receivedate is not None else 0
+    return f"{year}-{1 if serious == 1 else 2}"
+
+
+def allocate_rates(populations, sample_size, min_per_stratum):
+    """
+    Returns the sampling rate of each stratum: proportional to its share of
+    all reports, raised so that small strata still get `min_per_stratum`
+    sampled reports (or all of them).
+    """
+    total = sum(populations.values())
+    rates = {}
+    for (stratum, n) in populations.items():
+        if n == 0:
+            continue
+        target = max(sample_size * n / total, min_per_stratum)
+        rates[stratum] = min(1.0, target / n)
+    return rates
+
+
+def default_rate(strata, sample_size):
+    """
+    Rate for a stratum first seen during ingestion: the overall sampling fraction.
+    """
+    total = sum(population for (population, _) in strata.values())
+    return min(1.0, sample_size / total) if total else 1.0
+
+
+#########################
+# BUILDING AND MAINTENANCE
+#########################
+
+def rebuild(bind=None, echo=click.echo):
+    """
+    Draws the stratified report sample and computes the drug sketches from
+    scratch, replacing the stored ones. Returns (strata, sampled reports,
+    sketches).
+    """
+    bind = bind or db.session
+    config = current_app.config
+    precision = config['APPROX_HLL_PRECISION']
+
+    strata = []
+    positions = []
+    ids = []
+    stmt = select(SafetyReport.safetyreportid, SafetyReport.receivedate, SafetyReport.serious)
+    for part in bind.execute(stmt.execution_options(yield_per=FETCH_BATCH_SIZE)).partitions():
+        for (rid, receivedate, serious) in part:
+            ids.append(rid)
+            strata.append(stratum_key(receivedate, serious))
+            positions.append(sample_position(rid))
+    populations = collections.Counter(strata)
+    rates = allocate_rates(populations, config['APPROX_SAMPLE_SIZE'], config['APPROX_MIN_STRATUM_SAMPLE'])
+    sampled = [{'safetyreportid': rid, 'stratum': s}
+               for (rid, s, p) in zip(ids, strata, positions) if p < rates[s]]
+    echo(f"  {len(sampled)} of {len(ids)} reports sampled in {len(populations)} strata")
+
+    # Highest rank per (product, register), from every distinct report-product pair
+    registers = {}
+    stmt = select(Drug.drug_product_id, Drug.safetyreportid).where(Drug.drug_product_id.isnot(None)).distinct()
+    for part in bind.execute(stmt.execution_options(yield_per=FETCH_BATCH_SIZE)).partitions():
+        for (product_id, rid) in part:
+            (register, rank) = hll_register(rid, precision)
+            sketch = registers.get(product_id)
+            if sketch is None:
+                sketch = registers[product_id] = np.zeros(2 ** precision, dtype=np.uint8)
+            if rank > sketch[register]:
+                sketch[register] = rank
+    echo(f"  {len(registers)} drug sketches")
+
+    for model in (ReportSample, SampleStratum, DrugReportSketch):
+        bind.execute(model.__table__.delete())
+    _insert(bind, SampleStratum, [{'stratum': s, 'population': n, 'rate': rates[s]}
+                                  for (s, n) in populations.items()])
+    _insert(bind, ReportSample, sampled)
+    _insert(bind, DrugReportSketch, [{'drug_product_id': p, 'registers': pack_registers(r)}
+                                     for (p, r) in registers.items()])
+    return len(populations), len(sampled), len(registers)
+
+
+def _insert(bind, model, rows):
+    for i in range(0, len(rows), WRITE_BATCH_SIZE):
+        bind.execute(model.__table__.insert(), rows[i:i + WRITE_BATCH_SIZE])
+
+
+def _report_strata(report_ids, bind):
+    """
+    Returns {report id: stratum} for the reports that exist.
+    """
+    strata = {}
+    for i in range(0, len(report_ids), ID_CHUNK_SIZE):
+        chunk = report_ids[i:i + ID_CHUNK_SIZE]
+        stmt = (select(SafetyReport.safetyreportid, SafetyReport.receivedate, SafetyReport.serious)
+                .where(SafetyReport.safetyreportid.in_(chunk)))
+        for (rid, receivedate, serious) in bind.execute(stmt):
+            strata[rid] = stratum_key(receivedate, serious)
+    return strata
+
+
+def collect_strata(report_ids, bind=None):
+    """
+    Returns the strata of the given reports before they are replaced, for
+    refresh_reports() to correct the stratum populations.
+    """
+    bind = bind or db.session
+    return _report_strata(list(report_ids), bind)
+
+
+def refresh_reports(report_ids, before, bind=None):
+    """
+    Brings the sample and sketches up to date after the given reports were
+    inserted or replaced: adjusts the stratum populations by the difference
+    against `before` (from collect_strata()), redraws the reports' sample
+    membership and merges their drugs into the sketches. Does nothing until
+    'flask approx rebuild' has run. Sketches cannot forget a report, so
+    drugs removed from an edited report stay counted until the next rebuild.
+    """
+    bind = bind or db.session
+    config = current_app.config
+    report_ids = list(report_ids)
+    strata = {s: (population, rate) for (s, population, rate) in
+              bind.execute(select(SampleStratum.stratum, SampleStratum.population, SampleStratum.rate))}
+    if not strata or not report_ids:
+        return
+
+    after = _report_strata(report_ids, bind)
+    delta = collections.Counter(after.values())
+    delta.subtract(collections.Counter(before.values()))
+    new_rate = default_rate(strata, config['APPROX_SAMPLE_SIZE'])
+    for (stratum, change) in delta.items():
+        if change == 0:
+            continue
+        if stratum in strata:
+            (population, rate) = strata[stratum]
+            strata[stratum] = (population + change, rate)
+            bind.execute(SampleStratum.__table__.update()
+                         .where(SampleStratum.stratum == stratum)
+                         .values(population=SampleStratum.population + change))
+        else:
+            strata[stratum] = (change, new_rate)
+            bind.execute(SampleStratum.__table__.insert(),
+                         {'stratum': stratum, 'population': change, 'rate': new_rate})
+
+    for i in range(0, len(report_ids), ID_CHUNK_SIZE):
+        chunk = report_ids[i:i + ID_CHUNK_SIZE]
+        bind.execute(ReportSample.__table__.delete().where(ReportSample.safetyreportid.in_(chunk)))
+    sampled = [{'safetyreportid': rid, 'stratum': s} for (rid, s) in after.items()
+               if sample_position(rid) < strata[s][1]]
+    _insert(bind, ReportSample, sampled)
+
+    _merge_sketches(list(after), bind, config['APPROX_HLL_PRECISION'])
+
+
+def _merge_sketches(report_ids, bind, precision):
+    """
+    Adds the given reports to the sketches of the products they mention.
+    """
+    updates = {}
+    for i in range(0, len(report_ids), ID_CHUNK_SIZE):
+        chunk = report_ids[i:i + ID_CHUNK_SIZE]
+        stmt = (select(Drug.drug_product_id, Drug.safetyreportid)
+                .where(Drug.safetyreportid.in_(chunk), Drug.drug_product_id.isnot(None)))
+        for (product_id, rid) in bind.execute(stmt):
+            (register, rank) = hll_register(rid, precision)
+            sketch = updates.setdefault(product_id, {})
+            sketch[register] = max(rank, sketch.get(register, 0))
+    product_ids = list(updates)
+    for i in range(0, len(product_ids), ID_CHUNK_SIZE):
+        chunk = product_ids[i:i + ID_CHUNK_SIZE]
+        stored = dict(bind.execute(select(DrugReportSketch.drug_product_id, DrugReportSketch.registers)
+                                   .where(DrugReportSketch.drug_product_id.in_(chunk))).all())
+        rows = []
+        for product_id in chunk:
+            if product_id in stored:
+                registers = unpack_registers(stored[product_id], precision).copy()
+            else:
+                registers = np.zeros(2 ** precision, dtype=np.uint8)
+            for (register, rank) in updates[product_id].items():
+                registers[register] = max(rank, int(registers[register]))
+            rows.append({'drug_product_id': product_id, 'registers': pack_registers(registers)})
+        bind.execute(DrugReportSketch.__table__.delete().where(DrugReportSketch.drug_product_id.in_(chunk)))
+        _insert(bind, DrugReportSketch, rows)
+
+
+#########################
+# ESTIMATION
+#########################
+
+class ApproximateIndex:
+    """
+    In-memory copy of the report sample as a ColumnarStore keyed by drug
+    product id, with each sampled report's stratum weight, plus every drug
+    sketch as sparse (register, rank) pairs. Estimates cost time
+    proportional to the sample and the matched sketches, however many
+    reports match.
+    """
+
+    def __init__(self, store, populations, report_strata, sketch_products, sketch_offsets, sketch_registers,
+                 sketch_ranks, precision, data_version=None):
+        self.store = store
+        self.populations = populations
+        self.report_strata = report_strata
+        self.sampled = np.bincount(report_strata, minlength=len(populations)).astype(np.float64)
+        self.sketch_products = sketch_products
+        self.sketch_offsets = sketch_offsets
+        self.sketch_registers = sketch_registers
+        self.sketch_ranks = sketch_ranks
+        self.precision = precision
+        self.data_version = data_version
+
+    @classmethod
+    def load_from_db(cls, precision, data_version=None, bind=None):
+        """
+        Loads the sampled reports with their drugs, reactions and patients,
+        the stratum populations and the drug sketches.
+        """
+        bind = bind or db.session
+        sample = select(ReportSample.safetyreportid)
+
+        def stream(stmt, owner_column):
+            stmt = stmt.where(owner_column.in_(sample))
+            for part in bind.execute(stmt.execution_options(yield_per=FETCH_BATCH_SIZE)).partitions():
+                yield from part
+
+        criteria_cols = [getattr(SafetyReport, name) for name in CRITERIA_COLUMNS]
+        reports = list(stream(select(SafetyReport.safetyreportid, SafetyReport.receivedate, SafetyReport.serious,
+                                     SafetyReport.primarysource_reportercountry, *criteria_cols)
+                              .where(SafetyReport.receivedate.isnot(None)), SafetyReport.safetyreportid))
+        drugs = stream(select(Drug.safetyreportid, Drug.drug_product_id), Drug.safetyreportid)
+        reactions = stream(select(Reaction.safetyreportid, Reaction.reactionmeddrapt), Reaction.safetyreportid)
+        patients = stream(select(Patient.safetyreportid, Patient.patientagegroup, Patient.patientsex),
+                          Patient.safetyreportid)
+        store = ColumnarStore.from_rows(reports, drugs, reactions, patients)
+
+        strata = bind.execute(select(SampleStratum.stratum, SampleStratum.population)
+                              .order_by(SampleStratum.stratum)).all()
+        stratum_index = {s: i for (i, (s, _)) in enumerate(strata)}
+        populations = np.array([max(0, n) for (_, n) in strata], dtype=np.float64)
+        a = store.arrays
+        years = (store.receive_months // 12 + 1970).tolist()
+        report_strata = np.array([stratum_index.get(f"{y}-{1 if s == 1 else 2}", -1)
+                                  for (y, s) in zip(years, a['serious'].tolist())], dtype=np.int64)
+        if (report_strata < 0).any():
+            # Sampled reports edited into a stratum that has no row yet; rebuild to re-sample
+            populations = np.append(populations, 0.0)
+            report_strata[report_strata < 0] = len(populations) - 1
+
+        products, offsets, registers, ranks = [], [0], [], []
+        stmt = select(DrugReportSketch.drug_product_id, DrugReportSketch.registers).order_by(
+            DrugReportSketch.drug_product_id)
+        for part in bind.execute(stmt.execution_options(yield_per=FETCH_BATCH_SIZE)).partitions():
+            for (product_id, blob) in part:
+                dense = unpack_registers(blob, precision)
+                nonzero = np.flatnonzero(dense)
+                products.append(product_id)
+                registers.append(nonzero.astype(np.uint16 if precision <= 16 else np.uint32))
+                ranks.append(dense[nonzero])
+                offsets.append(offsets[-1] + len(nonzero))
+        return cls(store, populations, report_strata,
+                   np.array(products, dtype=np.int64), np.array(offsets, dtype=np.int64),
+                   np.concatenate(registers) if registers else np.zeros(0, dtype=np.uint16),
+                   np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.uint8),
+                   precision, data_version)
+
+    def distinct_reports(self, product_ids):
+        """
+        Estimates the number of distinct reports mentioning any of the products.
+        """
+        wanted = np.asarray(sorted(product_ids), dtype=np.int64)
+        pos = np.searchsorted(self.sketch_products, wanted)
+        found = pos[(pos < len(self.sketch_products)) &
+                    (self.sketch_products[np.minimum(pos, len(self.sketch_products) - 1)] == wanted)]
+        registers = np.zeros(2 ** self.precision, dtype=np.uint8)
+        if len(found):
+            starts = self.sketch_offsets[found]
+            lengths = self.sketch_offsets[found + 1] - starts
+            idx = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            np.maximum.at(registers, self.sketch_registers[idx].astype(np.int64), self.sketch_ranks[idx])
+        return hll_estimate(registers)
+
+    def sample_mask(self, product_ids):
+        """
+        Boolean mask over the sampled reports mentioning any of the products.
+        """
+        store = self.store
+        wanted = set(product_ids)
+        code_match = np.fromiter((p in wanted for p in store.drug_dict.values), dtype=bool,
+                                 count=len(store.drug_dict.values))
+        mask = np.zeros(store.n_reports, dtype=bool)
+        if code_match.any():
+            mask[store.drug_owner[code_match[store.arrays['drug_codes']]]] = True
+        return mask
+
+    def ratio_estimates(self, owners, codes, n_codes, matched_per_stratum):
+        """
+        Estimates, for each code, the share of the matching reports' entries
+        carrying it: the stratified ratio of the weighted count of entries
+        (report `owners` with `codes`) to the weighted number of matching
+        reports. Returns (ratios, variances) arrays of length n_codes.
+        """
+        n_strata = len(self.populations)
+        key = owners.astype(np.int64) * n_codes + codes.astype(np.int64)
+        (uniq, y) = np.unique(key, return_counts=True)
+        cell = self.report_strata[uniq // n_codes] * n_codes + uniq % n_codes
+        sy = np.bincount(cell, weights=y, minlength=n_strata * n_codes).reshape(n_strata, n_codes)
+        syy = np.bincount(cell, weights=y.astype(np.float64) ** 2,
+                          minlength=n_strata * n_codes).reshape(n_strata, n_codes)
+
+        n = self.sampled
+        big_n = self.populations
+        live = n > 0
+        weight = np.where(live, big_n / np.maximum(n, 1), 0.0)
+        sx = matched_per_stratum
+        tx = float((weight * sx).sum())
+        ratio = (weight[:, None] * sy).sum(axis=0) / tx
+        # Residuals d = y - R x of the linearized ratio estimator, per stratum
+        sd = sy - ratio * sx[:, None]
+        sdd = syy - 2 * ratio * sy + ratio ** 2 * sx[:, None]
+        several = n > 1
+        s2 = np.where(several[:, None], (sdd - sd ** 2 / np.maximum(n, 1)[:, None]) / np.maximum(n - 1, 1)[:, None],
+                      0.0)
+        fpc = np.clip(1 - n / np.maximum(big_n, 1), 0.0, 1.0)
+        factor = np.where(live, big_n ** 2 * fpc / np.maximum(n, 1), 0.0)
+        variance = (factor[:, None] * np.maximum(s2, 0.0)).sum(axis=0) / tx ** 2
+        return ratio, variance
+
+    def statistics(self, drug_query, product_ids, total):
+        """
+        Estimates the dashboard statistics of the reports mentioning the
+        products, scaling the sample's shares to the sketch estimate of
+        their number. Returns (StatisticsResult, sampled matches).
+        """
+        store = self.store
+        a = store.arrays
+        mask = self.sample_mask(product_ids)
+        hits = int(mask.sum())
+        if hits == 0:
+            return None, 0
+        matched = np.flatnonzero(mask)
+        matched_per_stratum = np.bincount(self.report_strata[matched],
+                                          minlength=len(self.populations)).astype(np.float64)
+        if not (matched_per_stratum * self.populations).any():
+            return None, 0
+        hll_error = hll_relative_error(self.precision)
+        margins = {'total_reports': int(round(Z_95 * total * hll_error))}
+
+        def section(name, owners, codes, labels):
+            (ratio, variance) = self.ratio_estimates(owners, codes, len(labels), matched_per_stratum)
+            counts, errors = {}, {}
+            for code in np.flatnonzero(ratio).tolist():
+                label = labels[code]
+                estimate = total * ratio[code]
+                counts[label] = counts.get(label, 0) + estimate
+                errors[label] = math.sqrt(errors.get(label, 0) ** 2 + total ** 2 * variance[code] +
+                                          (estimate * hll_error) ** 2)
+            counts = {k: int(round(v)) for (k, v) in counts.items()}
+            margins[name] = {k: int(round(Z_95 * v)) for (k, v) in errors.items() if k in counts}
+            return counts
+
+        serious_codes = np.where(a['serious'][matched] == 1, 0, 1)
+        seriousness_counts = section('seriousness_counts', matched, serious_codes, ["Serious", "Non-Serious"])
+
+        criteria_owner = np.concatenate([matched[a[name][matched] == 1] for name in CRITERIA_COLUMNS])
+        criteria_codes = np.concatenate([np.full(int((a[name][matched] == 1).sum()), i)
+                                         for (i, name) in enumerate(CRITERIA_COLUMNS)])
+        serious_criteria_counts = section('serious_criteria_counts', criteria_owner, criteria_codes,
+                                          [label for (label, _) in SERIOUS_CRITERIA])
+        for (label, _) in SERIOUS_CRITERIA:
+            serious_criteria_counts.setdefault(label, 0)
+
+        months = store.receive_months[matched]
+        base = int(months.min())
+        month_labels = [f"{1970 + m // 12}-{m % 12 + 1:02d}" for m in range(base, int(months.max()) + 1)]
+        monthly_data = section('monthly_data', matched, months - base, month_labels)
+        monthly_data = {label: monthly_data[label] for label in month_labels if label in monthly_data}
+
+        patient_rows = mask[store.patient_owner]
+        ages = a['patient_agegroup'][patient_rows].astype(np.int64) & 0xFF
+        age_labels = [AGE_GROUP_LABELS.get(code, "Unknown") for code in range(int(ages.max()) + 1)] if len(ages) else []
+        age_group_counts = section('age_group_counts', store.patient_owner[patient_rows], ages, age_labels) \
+            if len(ages) else {}
+
+        country_labels = [c or "Unknown" for c in store.country_dict.values]
+        country_counts = section('country_counts', matched, a['country_codes'][matched], country_labels)
+
+        reaction_rows = mask[store.reaction_owner]
+        reaction_labels = store.reaction_dict.values
+        reactions = section('top_reactions', store.reaction_owner[reaction_rows],
+                            a['reaction_codes'][reaction_rows], reaction_labels) if reaction_rows.any() else {}
+        top = sorted(reactions.items(), key=lambda x: (-x[1], x[0]))[:TOP_REACTIONS_LIMIT]
+        top_reactions = dict(top)
+        margins['top_reactions'] = {k: margins['top_reactions'][k] for k in top_reactions} if top else {}
+
+        result = StatisticsResult(drug_query,
+                                  total_reports=int(round(total)),
+                                  monthly_data=monthly_data,
+                                  age_group_counts=age_group_counts,
+                                  seriousness_counts=seriousness_counts,
+                                  serious_criteria_counts=sort_counts_desc(serious_criteria_counts),
+                                  country_counts=sort_counts_desc(country_counts),
+                                  top_reactions=sort_counts_desc(top_reactions),
+                                  approximate=True,
+                                  margins=margins)
+        return result, hits
+
+
+#########################
+# SHARED INSTANCE
+#########################
+
+_index = None
+_index_lock = threading.Lock()
+_refreshing = False
+
+
+def _load(app, data_version):
+    with app.app_context():
+        try:
+            return ApproximateIndex.load_from_db(app.config['APPROX_HLL_PRECISION'], data_version)
+        finally:
+            db.session.remove()
+
+
+def _refresh_in_background(app, data_version):
+    global _refreshing
+
+    def worker():
+        global _index, _refreshing
+        try:
+            index = _load(app, data_version)
+            with _index_lock:
+                _index = index
+        finally:
+            _refreshing = False
+
+    with _index_lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def get_index():
+    """
+    Returns the loaded sample and sketches, or None when approximate mode
+    is disabled or 'flask approx rebuild' has not run. The first call loads
+    them; after the data changes, requests keep using the previous copy
+    while a background thread reloads it.
+    """
+    global _index
+    config = current_app.config
+    if not config.get('APPROX_ENABLED', True):
+        return None
+    app = current_app._get_current_object()
+    data_version = view_cache.data_version()
+    with _index_lock:
+        index = _index
+    if index is None:
+        if db.session.execute(select(SampleStratum.stratum).limit(1)).first() is None:
+            return None
+        index = ApproximateIndex.load_from_db(config['APPROX_HLL_PRECISION'], data_version)
+        with _index_lock:
+            _index = index
+    elif index.data_version != data_version:
+        _refresh_in_background(app, data_version)
+    return index
+
+
+def estimate_matches(drug_query):
+    """
+    Returns (estimate, margin) for the number of reports mentioning a drug
+    matching the query, or None when the query should be counted exactly:
+    no sketches are available, or fewer than APPROX_MIN_REPORTS reports match.
+    """
+    if not drug_query or not drug_dictionary.dictionary_ready():
+        return None
+    index = get_index()
+    if index is None:
+        return None
+    product_ids = drug_dictionary.matching_product_ids(drug_query)
+    if not product_ids:
+        return None
+    total = index.distinct_reports(product_ids)
+    if total < current_app.config['APPROX_MIN_REPORTS']:
+        return None
+    return int(round(total)), int(round(Z_95 * total * hll_relative_error(index.precision)))
+
+
+def statistics(drug_query):
+    """
+    Returns approximate dashboard statistics for a drug query, or None when
+    they should be computed exactly: approximate mode is unavailable, the
+    query is estimated to match fewer than APPROX_MIN_REPORTS reports, or
+    too few sampled reports match for useful error bars.
+    """
+    if not drug_query or not drug_dictionary.dictionary_ready():
+        return None
+    index = get_index()
+    if index is None:
+        return None
+    product_ids = drug_dictionary.matching_product_ids(drug_query)
+    if not product_ids:
+        return None
+    total = index.distinct_reports(product_ids)
+    if total < current_app.config['APPROX_MIN_REPORTS']:
+        return None
+    (result, hits) = index.statistics(drug_query, product_ids, total)
+    if hits < current_app.config['APPROX_MIN_SAMPLE_MATCHES']:
+        return None
+    return result
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+approx_cli = AppGroup('approx', help="Maintain the report sample and drug sketches of approximate mode.")
+
+
+@approx_cli.command('rebuild')
+def rebuild_command():
+    """
+    Draws the stratified report sample and computes every drug sketch.
+    """
+    click.echo("Rebuilding the report sample and drug sketches...")
+    (strata, sampled, sketches) = rebuild()
+    db.session.commit()
+    view_cache.bump_data_version()
+    click.echo(f"Sampled {sampled} reports in {strata} strata; {sketches} drug sketches.")
+
+
+@approx_cli.command('status')
+def status_command():
+    """
+    Prints each stratum's population, sampling rate and sampled reports.
+    """
+    sampled = dict(db.session.execute(select(ReportSample.stratum, func.count())
+                                      .group_by(ReportSample.stratum)).all())
+    rows = db.session.execute(select(SampleStratum.stratum, SampleStratum.population, SampleStratum.rate)
+                              .order_by(SampleStratum.stratum)).all()
+    if not rows:
+        click.echo("No sample; run 'flask approx rebuild'.")
+        return
+    click.echo(f"{'stratum':10s} {'reports':>10s} {'rate':>8s} {'sampled':>8s}")
+    for (stratum, population, rate) in rows:
+        click.echo(f"{stratum:10s} {population:10d} {rate:8.4f} {sampled.get(stratum, 0):8d}")
+    sketches = db.session.scalar(select(func.count()).select_from(DrugReportSketch))
+    click.echo(f"{sum(sampled.values())} sampled reports, {sketches} drug sketches")
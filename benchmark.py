@@ -0,0 +1,294 @@
+# benchmark.py
+
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, func, select
+
+from models import db, SafetyReport, Drug
+from caching import view_cache
+from pagination import count_cache
+from suggestions import suggestion_index
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# Latency percentiles reported for every scenario
+PERCENTILES = (50, 95, 99)
+
+
+class QueryCounter:
+    """
+    Counts SQL statements sent through the engine while active.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def pick_parameters():
+    """
+    Chooses request parameters from the data actually in the database:
+    a popular, a mid-frequency and a rare drug, report ids spread across the
+    table, and autocomplete prefixes of the popular names.
+    """
+    drug_rows = db.session.execute(
+        select(Drug.medicinalproduct, func.count(Drug.id).label('n'))
+        .group_by(Drug.medicinalproduct)
+        .order_by(func.count(Drug.id).desc())
+    ).all()
+    names = [r[0] for r in drug_rows]
+    if not names:
+        raise click.ClickException("The database has no drugs; run 'flask synth' first.")
+    total_reports = db.session.scalar(select(func.count()).select_from(SafetyReport))
+    step = max(1, total_reports // 20)
+    report_ids = [db.session.scalar(select(SafetyReport.safetyreportid)
+                                    .order_by(SafetyReport.safetyreportid)
+                                    .offset(k * step).limit(1))
+                  for k in range(min(20, total_reports))]
+    return {
+        'drugs': {
+            'popular': names[0],
+            'mid': names[len(names) // 10],
+            'rare': names[-1],
+        },
+        'report_ids': report_ids,
+        'prefixes': sorted({n.strip()[:k].lower() for n in names[:20] for k in (1, 3) if n.strip()}),
+        'reports': total_reports,
+    }
+
+
+def build_scenarios(params):
+    """
+    Returns (name, url, needs_admin) triples covering the main read paths.
+    A scenario may list several URLs; iterations cycle through them.
+    """
+    drugs = params['drugs']
+    scenarios = [
+        ('index', ['/'], False),
+        ('index_deep_page', ['/?page=50'], False),
+    ]
+    for (label, name) in drugs.items():
+        scenarios.append((f'index_filter_{label}', [f'/?filter_drug={name}'], False))
+        scenarios.append((f'statistics_{label}', [f'/statistics?drug={name}'], False))
+        scenarios.append((f'api_statistics_{label}', [f'/api/statistics?drug={name}'], False))
+        scenarios.append((f'search_{label}', [f'/search?drug={name}'], False))
+    scenarios += [
+        ('compare', [f"/compare?drugs={drugs['popular']},{drugs['mid']}"], False),
+        ('signals', ['/signals', f"/signals?drug={drugs['popular']}"], False),
+        ('interactions', [f"/interactions?drug={drugs['popular']}"], False),
+        ('autocomplete', [f'/autocomplete?q={p}' for p in params['prefixes']], False),
+        ('report_detail', [f'/report/{rid}' for rid in params['report_ids']], False),
+        ('api_reports', [f'/api/reports?ids={rid}' for rid in params['report_ids']], False),
+        ('api_reports_batch', ['/api/reports?ids=' + ','.join(params['report_ids'])], False),
+        ('admin_panel_reports', ['/admin?table=safety_reports'], True),
+        ('admin_panel_drugs_deep', ['/admin?table=drugs&start=10000'], True),
+    ]
+    return scenarios
+
+
+def run_scenario(client, urls, iterations, warmup, use_cache):
+    """
+    Requests the URLs `warmup + iterations` times and measures each timed
+    request. Peak Python memory is taken from one extra traced request so
+    tracing overhead does not distort the latencies.
+    """
+    latencies = []
+    queries = []
+    statuses = set()
+    engine = db.engine
+    for i in range(warmup + iterations):
+        if not use_cache:
+            count_cache.clear()
+        url = urls[i % len(urls)]
+        with QueryCounter(engine) as counter:
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - started
+        statuses.add(response.status_code)
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count)
+
+    if not use_cache:
+        count_cache.clear()
+    tracemalloc.start()
+    client.get(urls[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    lat = np.array(latencies)
+    result = {f'p{p}_ms': round(float(np.percentile(lat, p)), 3) for p in PERCENTILES}
+    result.update({
+        'mean_ms': round(float(lat.mean()), 3),
+        'max_ms': round(float(lat.max()), 3),
+        'queries_mean': round(float(np.mean(queries)), 2),
+        'queries_max': int(max(queries)),
+        'peak_kib': round(peak / 1024, 1),
+        'statuses': sorted(statuses),
+        'iterations': iterations,
+    })
+    return result
+
+
+def run_benchmarks(iterations=30, warmup=3, use_cache=False, only=None):
+    """
+    Drives every scenario through the Flask test client and returns the
+    results document. The response cache is bypassed unless `use_cache`.
+    """
+    app = current_app._get_current_object()
+    params = pick_parameters()
+    db.session.remove()
+    if not suggestion_index.ready:
+        suggestion_index.load_from_db(view_cache.data_version())
+
+    saved_enabled = view_cache.enabled
+    view_cache.enabled = use_cache
+    results = {}
+    try:
+        client = app.test_client()
+        for (name, urls, needs_admin) in build_scenarios(params):
+            if only and not any(o in name for o in only):
+                continue
+            with client.session_transaction() as s:
+                s['admin_logged_in'] = needs_admin
+            results[name] = run_scenario(client, urls, iterations, warmup, use_cache)
+            click.echo(f"{name:32s} p50 {results[name]['p50_ms']:9.2f} ms  "
+                       f"p95 {results[name]['p95_ms']:9.2f} ms  "
+                       f"p99 {results[name]['p99_ms']:9.2f} ms  "
+                       f"{results[name]['queries_mean']:6.1f} queries")
+    finally:
+        view_cache.enabled = saved_enabled
+
+    return {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'database': db.engine.dialect.name,
+            'database_backend': app.config.get('DATABASE_BACKEND', 'mysql'),
+            'analytics_backend': app.config.get('ANALYTICS_BACKEND', 'sql'),
+            'reports': params['reports'],
+            'drugs': params['drugs'],
+            'use_cache': use_cache,
+            'warmup': warmup,
+            # Process-wide peak resident set size (KiB on Linux)
+            'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        },
+        'scenarios': results,
+    }
+
+
+def compare_results(baseline, current, threshold):
+    """
+    Compares two results documents scenario by scenario.
+    Returns (rows, regressions): a row per shared scenario with the p50/p95
+    change in percent, and the names whose p95 or query count grew by more
+    than `threshold` percent.
+    """
+    rows = []
+    regressions = []
+    for (name, cur) in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        row = {'scenario': name}
+        for key in ('p50_ms', 'p95_ms', 'queries_mean'):
+            before, after = base[key], cur[key]
+            row[key] = (before, after, (after - before) / before * 100 if before else 0.0)
+        rows.append(row)
+        if row['p95_ms'][2] > threshold or row['queries_mean'][2] > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions):
+    """
+    Prints a comparison table produced by compare_results().
+    """
+    click.echo(f"{'scenario':32s} {'p50 ms':>21s} {'p95 ms':>21s} {'queries':>17s}")
+    for row in rows:
+        cells = []
+        for key in ('p50_ms', 'p95_ms', 'queries_mean'):
+            before, after, change = row[key]
+            cells.append(f"{before:7.1f}->{after:7.1f} {change:+5.0f}%")
+        flag = '  REGRESSION' if row['scenario'] in regressions else ''
+        click.echo(f"{row['scenario']:32s} {cells[0]:>21s} {cells[1]:>21s} {cells[2]:>17s}{flag}")
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+bench_cli = AppGroup('bench', help="Benchmark the main routes against the configured database.")
+
+
+@bench_cli.command('run')
+@click.option('--iterations', default=30, show_default=True, help="Timed requests per scenario.")
+@click.option('--warmup', default=3, show_default=True, help="Untimed requests per scenario.")
+@click.option('--use-cache', is_flag=True, help="Keep the response and count caches enabled.")
+@click.option('--only', multiple=True, help="Run only scenarios whose name contains this text.")
+@click.option('--output', type=click.Path(dir_okay=False), help="Write the results as JSON.")
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help="Compare against an earlier results file.")
+@click.option('--threshold', default=10.0, show_default=True,
+              help="Percent increase in p95 or query count treated as a regression.")
+@click.option('--fail-on-regression', is_flag=True, help="Exit with status 1 when a regression is found.")
+def run_command(iterations, warmup, use_cache, only, output, baseline, threshold, fail_on_regression):
+    """
+    Runs the benchmark scenarios and optionally compares with a baseline.
+    """
+    results = run_benchmarks(iterations=iterations, warmup=warmup, use_cache=use_cache, only=only)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        click.echo(f"Results written to {output}")
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            rows, regressions = compare_results(json.load(f), results, threshold)
+        print_comparison(rows, regressions)
+        if regressions and fail_on_regression:
+            sys.exit(1)
+
+
+@bench_cli.command('compare')
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', default=10.0, show_default=True,
+              help="Percent increase in p95 or query count treated as a regression.")
+def compare_command(baseline, current, threshold):
+    """
+    Compares two saved results files.
+    """
+    with open(baseline, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(current, encoding='utf-8') as f:
+        cur = json.load(f)
+    rows, regressions = compare_results(base, cur, threshold)
+    print_comparison(rows, regressions)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,479 @@
+# bulk_admin.py
+
+import csv
+import datetime
+import os
+
+from flask import current_app
+from sqlalchemy import select, update, func, bindparam, or_
+
+from models import db, SafetyReport, Patient, Reaction, Drug, Company
+import dedup
+import drug_dictionary
+import rollups
+
+# Admin table name -> model
+ADMIN_MODELS = {
+    'safety_reports': SafetyReport,
+    'patients': Patient,
+    'reactions': Reaction,
+    'drugs': Drug,
+    'companies': Company,
+}
+
+# Rows updated or deleted per transaction
+DEFAULT_CHUNK_SIZE = 1000
+
+# Filter value matching NULL in mass updates and deletes
+NULL_TOKEN = 'NULL'
+
+# Per-report child tables, deleted before the reports they belong to
+CHILD_MODELS = (Reaction, Drug, Patient)
+
+# Values accepted for boolean columns
+TRUE_VALUES = ('true', '1', 'yes', 'on')
+FALSE_VALUES = ('false', '0', 'no', 'off')
+
+
+class BulkEditError(ValueError):
+    """
+    Raised when a bulk operation names an unknown table or column, or
+    carries a value that its column cannot hold.
+    """
+
+
+#########################
+# SCHEMA-TYPED VALUES
+#########################
+
+def resolve_model(table_name):
+    """
+    Returns the model of an admin table name, raising BulkEditError if unknown.
+    """
+    model = ADMIN_MODELS.get(table_name)
+    if model is None:
+        raise BulkEditError(f"Unknown table {table_name!r}.")
+    return model
+
+
+def primary_key(model):
+    """
+    Returns the primary key column of a model's table.
+    """
+    return model.__table__.primary_key.columns.values()[0]
+
+
+def get_column(model, name):
+    """
+    Returns a column of a model's table, raising BulkEditError if unknown.
+    """
+    column = model.__table__.columns.get(name)
+    if column is None:
+        raise BulkEditError(f"Unknown column {name!r} in {model.__tablename__}.")
+    return column
+
+
+def convert_value(column, raw):
+    """
+    Converts a raw form or CSV value to the Python type the column's schema
+    declares. An empty value is NULL. Raises BulkEditError for values the
+    column cannot hold, including NULL in a NOT NULL column and strings
+    longer than the column.
+    """
+    value = None
+    if raw is not None and raw != '':
+        python_type = column.type.python_type
+        try:
+            if python_type is bool:
+                if raw.strip().lower() not in TRUE_VALUES + FALSE_VALUES:
+                    raise ValueError(raw)
+                value = raw.strip().lower() in TRUE_VALUES
+            elif python_type is int:
+                value = int(raw.strip())
+            elif python_type is float:
+                value = float(raw.strip())
+            elif python_type is datetime.datetime:
+                value = datetime.datetime.fromisoformat(raw.strip())
+            elif python_type is datetime.date:
+                value = datetime.date.fromisoformat(raw.strip())
+            else:
+                value = raw
+        except ValueError:
+            raise BulkEditError(f"{column.name}: {raw!r} is not a valid {python_type.__name__}.")
+        length = getattr(column.type, 'length', None)
+        if isinstance(value, str) and length and len(value) > length:
+            raise BulkEditError(f"{column.name}: {raw!r} is longer than {length} characters.")
+    if value is None and not column.nullable:
+        raise BulkEditError(f"{column.name} cannot be empty.")
+    return value
+
+
+def parse_conditions(model, pairs):
+    """
+    Turns [column, raw value] pairs into WHERE conditions. Repeated columns
+    match any of their values; NULL_TOKEN or an empty value matches NULL.
+    """
+    values = {}
+    for (name, raw) in pairs:
+        values.setdefault(name, []).append(raw)
+    conditions = []
+    for (name, raws) in values.items():
+        column = get_column(model, name)
+        matches = []
+        if NULL_TOKEN in raws or '' in raws:
+            matches.append(column.is_(None))
+        converted = [convert_value(column, raw) for raw in raws if raw not in (NULL_TOKEN, '')]
+        if converted:
+            matches.append(column.in_(converted))
+        conditions.append(or_(*matches) if len(matches) > 1 else matches[0])
+    return conditions
+
+
+def parse_changes(model, pairs):
+    """
+    Turns [column, raw value] pairs into the typed values of an UPDATE.
+    Primary keys cannot be changed in bulk.
+    """
+    changes = {}
+    pk = primary_key(model)
+    for (name, raw) in pairs:
+        column = get_column(model, name)
+        if column is pk:
+            raise BulkEditError(f"The primary key {name} cannot be changed in bulk.")
+        changes[name] = convert_value(column, raw)
+    if not changes:
+        raise BulkEditError("No columns to change.")
+    return changes
+
+
+def parse_rows(model, rows):
+    """
+    Converts edited rows ({column: raw value}, each naming its primary key)
+    to typed values.
+    """
+    pk = primary_key(model)
+    parsed = []
+    for (number, row) in enumerate(rows, start=1):
+        if not row.get(pk.name):
+            raise BulkEditError(f"Row {number}: missing {pk.name}.")
+        try:
+            parsed.append({name: convert_value(get_column(model, name), raw) for (name, raw) in row.items()})
+        except BulkEditError as e:
+            raise BulkEditError(f"Row {number}: {e}")
+    return parsed
+
+
+def read_csv_rows(model, path):
+    """
+    Reads an uploaded CSV file whose header names the columns to set,
+    including the primary key, and returns its typed rows.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        check_csv_header(model, reader.fieldnames)
+        return parse_rows(model, list(reader))
+
+
+def check_csv_header(model, fieldnames):
+    """
+    Raises BulkEditError unless a CSV header names the primary key and
+    only known columns.
+    """
+    if not fieldnames:
+        raise BulkEditError("The CSV file is empty.")
+    for name in fieldnames:
+        get_column(model, name)
+    pk = primary_key(model)
+    if pk.name not in fieldnames:
+        raise BulkEditError(f"The CSV header must include the primary key {pk.name}.")
+
+
+#########################
+# CHUNKED OPERATIONS
+#########################
+
+def affected_report_ids(conn, model, keys):
+    """
+    Returns the ids of the safety reports whose statistics depend on the
+    given rows. Company rows do not feed any per-report statistics.
+    """
+    if model is SafetyReport:
+        return set(keys)
+    if model is Company:
+        return set()
+    table = model.__table__
+    return set(conn.execute(select(table.c.safetyreportid)
+                            .where(primary_key(model).in_(keys))
+                            .where(table.c.safetyreportid.isnot(None))).scalars())
+
+
+def _relink_drugs(conn, rows):
+    """
+    Points renamed drug rows at the dictionary entry of their new spelling.
+    """
+    renamed = [row for row in rows if row.get('medicinalproduct') is not None]
+    if not renamed:
+        return
+    product_ids = drug_dictionary.resolve_product_ids(
+        conn, [(row['medicinalproduct'], row.get('activesubstancename')) for row in renamed])
+    for row in renamed:
+        row['drug_product_id'] = product_ids[drug_dictionary.alias_key(row['medicinalproduct'])]
+
+
+def _matching_keys(conn, model, conditions, after, limit):
+    """
+    Returns the next `limit` primary keys matching the conditions after `after`.
+    """
+    pk = primary_key(model)
+    stmt = select(pk).where(*conditions).order_by(pk).limit(limit)
+    if after is not None:
+        stmt = stmt.where(pk > after)
+    return conn.execute(stmt).scalars().all()
+
+
+def count_matching(model, conditions, limit=None, bind=None):
+    """
+    Counts the rows matching the conditions, stopping after `limit` + 1.
+    """
+    bind = bind or db.session
+    stmt = select(primary_key(model)).where(*conditions)
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    return bind.execute(select(func.count()).select_from(stmt.subquery())).scalar()
+
+
+def _update_chunk(conn, model, keys, changes):
+    """
+    Sets the same values on a chunk of rows with one UPDATE ... WHERE IN,
+    keeping the rollups and duplicate detection of their reports current.
+    """
+    reports = affected_report_ids(conn, model, keys)
+    if changes.get('safetyreportid') is not None:
+        reports.add(changes['safetyreportid'])
+    before = rollups.collect_contributions(reports, bind=conn)
+    conn.execute(update(model.__table__).where(primary_key(model).in_(keys)).values(changes))
+    rollups.refresh_reports(reports, before, bind=conn)
+    dedup.forget_reports(conn, reports)
+
+
+def _update_rows_chunk(conn, model, rows):
+    """
+    Applies a chunk of individually edited rows as executemany UPDATEs, one
+    per distinct set of edited columns. Returns the number of rows found.
+    """
+    pk = primary_key(model)
+    table = model.__table__
+    found = set(conn.execute(select(pk).where(pk.in_([row[pk.name] for row in rows]))).scalars())
+    rows = [row for row in rows if row[pk.name] in found]
+    reports = affected_report_ids(conn, model, found)
+    reports.update(row['safetyreportid'] for row in rows if row.get('safetyreportid') is not None)
+    if model is Drug:
+        _relink_drugs(conn, rows)
+    before = rollups.collect_contributions(reports, bind=conn)
+    groups = {}
+    for row in rows:
+        names = tuple(sorted(name for name in row if name != pk.name))
+        if names:
+            groups.setdefault(names, []).append(row)
+    for (names, group) in groups.items():
+        stmt = (update(table)
+                .where(pk == bindparam('b_' + pk.name))
+                .values({name: bindparam('b_' + name) for name in names}))
+        conn.execute(stmt, [{'b_' + k: v for (k, v) in row.items()} for row in group])
+    rollups.refresh_reports(reports, before, bind=conn)
+    dedup.forget_reports(conn, reports)
+    return len(rows)
+
+
+def _delete_chunk(conn, model, keys):
+    """
+    Deletes a chunk of rows with set-based statements instead of ORM
+    cascades: a report's reactions, drugs and patients go with it, and
+    reports of a deleted company are kept without a company.
+    """
+    table = model.__table__
+    pk = primary_key(model)
+    if model is Company:
+        reports = SafetyReport.__table__
+        conn.execute(update(reports).where(reports.c.companynumb.in_(keys)).values(companynumb=None))
+        conn.execute(table.delete().where(pk.in_(keys)))
+        return
+    reports = affected_report_ids(conn, model, keys)
+    before = rollups.collect_contributions(reports, bind=conn)
+    dedup.forget_reports(conn, reports)
+    if model is SafetyReport:
+        for child in CHILD_MODELS:
+            conn.execute(child.__table__.delete().where(child.__table__.c.safetyreportid.in_(keys)))
+    conn.execute(table.delete().where(pk.in_(keys)))
+    rollups.refresh_reports(reports, before, bind=conn)
+
+
+def update_where(engine, model, conditions, changes, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Sets `changes` on every row matching the conditions, `chunk_size` rows
+    per transaction in primary-key order. Returns the number of rows updated.
+    """
+    with engine.connect() as conn:
+        total = count_matching(model, conditions, bind=conn)
+    if model is Drug:
+        with engine.begin() as conn:
+            _relink_drugs(conn, [changes])
+    (done, after) = (0, None)
+    while True:
+        with engine.begin() as conn:
+            keys = _matching_keys(conn, model, conditions, after, chunk_size)
+            if not keys:
+                break
+            _update_chunk(conn, model, keys, changes)
+        (done, after) = (done + len(keys), keys[-1])
+        if progress:
+            progress(min(0.99, done / max(total, 1)), f"Updated {done} of {total} rows")
+    return done
+
+
+def delete_where(engine, model, conditions, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Deletes every row matching the conditions, `chunk_size` rows per
+    transaction. Returns the number of rows deleted.
+    """
+    with engine.connect() as conn:
+        total = count_matching(model, conditions, bind=conn)
+    (done, after) = (0, None)
+    while True:
+        with engine.begin() as conn:
+            keys = _matching_keys(conn, model, conditions, after, chunk_size)
+            if not keys:
+                break
+            _delete_chunk(conn, model, keys)
+        (done, after) = (done + len(keys), keys[-1])
+        if progress:
+            progress(min(0.99, done / max(total, 1)), f"Deleted {done} of {total} rows")
+    return done
+
+
+def update_rows(engine, model, rows, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Applies individually edited rows, `chunk_size` per transaction.
+    Returns (rows updated, rows whose primary key was not found).
+    """
+    done = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = [dict(row) for row in rows[start:start + chunk_size]]
+        with engine.begin() as conn:
+            done += _update_rows_chunk(conn, model, chunk)
+        if progress:
+            progress(min(0.99, (start + len(chunk)) / len(rows)),
+                     f"Processed {start + len(chunk)} of {len(rows)} rows")
+    return done, len(rows) - done
+
+
+#########################
+# JOB HANDLERS
+#########################
+
+def chunk_size():
+    return current_app.config.get('BULK_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def upload_path(name):
+    """
+    Returns where an uploaded CSV file named `name` is kept until imported.
+    """
+    return os.path.join(current_app.config['BULK_UPLOAD_DIR'], os.path.basename(name))
+
+
+def remove_upload(name):
+    path = upload_path(name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def check_params(kind, params):
+    """
+    Validates the parameters of a bulk operation before it is run or
+    queued, raising BulkEditError, so mistakes are reported at once
+    rather than by a failed job.
+    """
+    model = resolve_model(params['table'])
+    if kind in ('bulk_update', 'bulk_delete'):
+        parse_conditions(model, params['where'])
+    if kind == 'bulk_update':
+        parse_changes(model, params['set'])
+    elif kind == 'bulk_edit':
+        if not params['rows']:
+            raise BulkEditError("No rows to save.")
+        parse_rows(model, params['rows'])
+    elif kind == 'bulk_import':
+        try:
+            with open(upload_path(params['file']), newline='', encoding='utf-8-sig') as f:
+                check_csv_header(model, next(csv.reader(f), None))
+        except UnicodeDecodeError:
+            raise BulkEditError("The CSV file must be UTF-8 encoded.")
+
+
+def bulk_update_cost(params, limit):
+    """
+    Estimates a mass update or delete by the number of matching rows.
+    """
+    model = resolve_model(params['table'])
+    return count_matching(model, parse_conditions(model, params['where']), limit)
+
+
+def bulk_edit_cost(params, limit):
+    return len(params['rows'])
+
+
+def bulk_import_cost(params, limit):
+    """
+    Estimates an import by the number of lines in the uploaded file.
+    """
+    with open(upload_path(params['file']), 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+
+def run_bulk_update(params, progress):
+    model = resolve_model(params['table'])
+    conditions = parse_conditions(model, params['where'])
+    changes = parse_changes(model, params['set'])
+    progress(0.0, "Updating rows")
+    return {'table': params['table'],
+            'updated': update_where(db.engine, model, conditions, changes, chunk_size(), progress)}
+
+
+def run_bulk_delete(params, progress):
+    model = resolve_model(params['table'])
+    conditions = parse_conditions(model, params['where'])
+    progress(0.0, "Deleting rows")
+    return {'table': params['table'],
+            'deleted': delete_where(db.engine, model, conditions, chunk_size(), progress)}
+
+
+def run_bulk_edit(params, progress):
+    model = resolve_model(params['table'])
+    rows = parse_rows(model, params['rows'])
+    (updated, missing) = update_rows(db.engine, model, rows, chunk_size(), progress)
+    return {'table': params['table'], 'updated': updated, 'missing': missing}
+
+
+def run_bulk_import(params, progress):
+    """
+    Job handler applying an uploaded CSV file, which is removed afterwards
+    whether or not the import succeeded.
+    """
+    try:
+        model = resolve_model(params['table'])
+        progress(0.0, "Reading the CSV file")
+        rows = read_csv_rows(model, upload_path(params['file']))
+        (updated, missing) = update_rows(db.engine, model, rows, chunk_size(), progress)
+    finally:
+        remove_upload(params['file'])
+    return {'table': params['table'], 'updated': updated, 'missing': missing}
+
+
+# Job kind -> (handler, cost estimate), registered in jobs.JOB_KINDS
+BULK_JOB_KINDS = {
+    'bulk_update': (run_bulk_update, bulk_update_cost),
+    'bulk_delete': (run_bulk_delete, bulk_update_cost),
+    'bulk_edit': (run_bulk_edit, bulk_edit_cost),
+    'bulk_import': (run_bulk_import, bulk_import_cost),
+}
@@ -0,0 +1,284 @@
+# caching.py
+
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, session, make_response, Response
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.simplecache import SimpleCache
+from flask_caching.backends.nullcache import NullCache
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; increments are then unlocked
+    fcntl = None
+
+# Cache key holding the global data version
+DATA_VERSION_KEY = 'medae:data_version'
+
+
+class LRUCache(BaseCache):
+    """
+    Thread-safe in-process cache bounded by entry count.
+    Evicts the least recently used entry once `threshold` is reached.
+    Select it with CACHE_TYPE = 'caching.LRUCache'.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        """
+        Builds the backend from the Flask-Caching configuration.
+        """
+        kwargs.update(threshold=config['CACHE_THRESHOLD'])
+        return cls(*args, **kwargs)
+
+    def _expiry(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.monotonic() + timeout if timeout > 0 else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._entries[key] = (value, self._expiry(timeout))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.threshold:
+                self._entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._entries:
+                return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            entry = self._entries.get(key)
+            value = (entry[0] if entry else 0) + delta
+            self._entries[key] = (value, entry[1] if entry else None)
+            return value
+
+
+class DataVersionFile:
+    """
+    The global data version stored in a small file, shared by every
+    process on the host: server workers and CLI commands (ingestion,
+    deduplication, rebuilds) invalidate each other's caches even when
+    every process caches responses in its own memory. Increments are
+    serialized with a lock file and written atomically, so readers never
+    see a partial value.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        """
+        Returns the stored version, or None when there is none yet.
+        """
+        try:
+            with open(self.path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def update(self, increment):
+        """
+        Stores a new version: the current one plus one when `increment`,
+        otherwise it is only created if missing, seeded from the clock so it
+        never reuses an earlier version number. Returns the stored version.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            version = self.get()
+            if version is not None and not increment:
+                return version
+            version = version + 1 if version is not None else int(time.time())
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(str(version))
+            os.replace(tmp_path, self.path)
+            return version
+
+
+class CacheStats:
+    """
+    Per-endpoint hit and miss counters for the response cache.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, hit):
+        with self._lock:
+            counts = self._counts.setdefault(endpoint, {'hits': 0, 'misses': 0})
+            counts['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        """
+        Returns the counters with a hit ratio per endpoint and in total.
+        """
+        with self._lock:
+            endpoints = {e: dict(c) for (e, c) in self._counts.items()}
+        hits = sum(c['hits'] for c in endpoints.values())
+        misses = sum(c['misses'] for c in endpoints.values())
+        for c in endpoints.values():
+            total = c['hits'] + c['misses']
+            c['hit_ratio'] = round(c['hits'] / total, 4) if total else 0.0
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            'endpoints': endpoints,
+        }
+
+
+class ViewCache:
+    """
+    Caches whole view responses keyed by endpoint, normalized request
+    parameters and the global data version.
+    Bumping the data version makes every earlier entry unreachable, so
+    writes never have to enumerate the keys they invalidate.
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.version_file = None
+        self.timeouts = {}
+        self.stats = CacheStats()
+        # Set to False to bypass response caching (e.g. while benchmarking)
+        self.enabled = True
+
+    def init_app(self, app, cache):
+        """
+        Binds the Flask-Caching instance and per-endpoint timeouts. With a
+        backend private to each process, the data version is kept in the
+        DATA_VERSION_PATH file instead, so invalidations reach every process.
+        """
+        self.cache = cache
+        self.timeouts = app.config.get('CACHE_TIMEOUTS', {})
+        backend = app.extensions['cache'][cache]
+        if isinstance(backend, (LRUCache, SimpleCache, NullCache)):
+            self.version_file = DataVersionFile(app.config['DATA_VERSION_PATH'])
+        else:
+            self.version_file = None
+
+    def data_version(self):
+        """
+        Returns the current global data version, initializing it if needed.
+        A missing version (first start, eviction or a backend restart) is
+        seeded from the clock so it never reuses an earlier version number.
+        """
+        if self.version_file is not None:
+            version = self.version_file.get()
+            return version if version is not None else self.version_file.update(increment=False)
+        version = self.cache.get(DATA_VERSION_KEY)
+        if version is None:
+            self.cache.add(DATA_VERSION_KEY, int(time.time()), timeout=0)
+            version = self.cache.get(DATA_VERSION_KEY) or int(time.time())
+        return int(version)
+
+    def bump_data_version(self):
+        """
+        Invalidates every cached response by moving to a new data version.
+        """
+        if self.version_file is not None:
+            return self.version_file.update(increment=True)
+        self.data_version()
+        version = self.cache.cache.inc(DATA_VERSION_KEY)
+        if version is None:
+            version = self.data_version() + 1
+        # Generic inc() re-stores the key with the default timeout; keep it forever
+        self.cache.set(DATA_VERSION_KEY, int(version), timeout=0)
+        return int(version)
+
+    def make_key(self, endpoint, view_args):
+        """
+        Builds a cache key from the endpoint, its URL arguments, the query
+        string with empty values dropped and whitespace trimmed, and whether
+        the visitor is an admin (the navigation bar differs).
+        """
+        params = []
+        for k in sorted(request.args):
+            for v in request.args.getlist(k):
+                v = v.strip()
+                if v:
+                    params.append((k, v))
+        parts = [
+            repr(sorted(view_args.items())),
+            repr(params),
+            'admin' if session.get('admin_logged_in') else 'anon',
+        ]
+        digest = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+        return f"view:{endpoint}:{self.data_version()}:{digest}"
+
+    def cached(self):
+        """
+        Decorator caching successful responses of a view for the endpoint's
+        configured timeout (CACHE_TIMEOUTS, falling back to the default).
+        Responses marked Cache-Control: no-store are passed through uncached.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.cache is None or not self.enabled:
+                    return f(*args, **kwargs)
+                endpoint = request.endpoint
+                key = self.make_key(endpoint, kwargs)
+                entry = self.cache.get(key)
+                if entry is not None:
+                    self.stats.record(endpoint, True)
+                    body, status, content_type = entry
+                    return Response(body, status=status, content_type=content_type)
+
+                self.stats.record(endpoint, False)
+                response = make_response(f(*args, **kwargs))
+                no_store = 'no-store' in response.headers.get('Cache-Control', '')
+                if response.status_code == 200 and not response.direct_passthrough and not no_store:
+                    self.cache.set(key,
+                                   (response.get_data(), response.status_code, response.content_type),
+                                   timeout=self.timeouts.get(endpoint))
+                return response
+            return wrapper
+        return decorator
+
+
+# Shared response cache used by the routes
+view_cache = ViewCache()
@@ -0,0 +1,519 @@
+# columnar.py
+
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, func
+
+from models import db, SafetyReport, Drug, Patient, Reaction
+from stats_engine import StatisticsResult, AGE_GROUP_LABELS, SERIOUS_CRITERIA, TOP_REACTIONS_LIMIT, sort_counts_desc
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# Rows fetched per round trip while loading from the database
+FETCH_BATCH_SIZE = 50000
+
+# Day numbers are counted from this date
+EPOCH = datetime.date(1970, 1, 1)
+
+# Per-report columns and their dtypes (seriousness flags use 1 for "yes", 0 otherwise)
+REPORT_COLUMNS = {
+    'report_ids': None,
+    'receive_days': 'int32',
+    'serious': 'int8',
+    'country_codes': 'int32',
+}
+CRITERIA_COLUMNS = [column.key for (_, column) in SERIOUS_CRITERIA]
+
+# File in the store directory naming its current version directory
+POINTER_FILE = 'CURRENT'
+
+# Child tables stored as CSR-style (offsets, values) arrays keyed by report
+CHILD_COLUMNS = ['drug_offsets', 'drug_codes', 'reaction_offsets', 'reaction_codes',
+                 'patient_offsets', 'patient_agegroup', 'patient_sex']
+
+
+class _Dictionary:
+    """
+    Maps distinct strings to consecutive integer codes.
+    """
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self.codes = {v: i for (i, v) in enumerate(self.values)}
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = len(self.values)
+            self.codes[value] = c
+            self.values.append(value)
+        return c
+
+
+def _to_days(value):
+    """
+    Converts a date to an int32 day number.
+    """
+    return (value - EPOCH).days
+
+
+def _csr(report_index, values, n_reports, dtype):
+    """
+    Groups child values by report index into (offsets, values) arrays.
+    """
+    report_index = np.asarray(report_index, dtype=np.int64)
+    values = np.asarray(values, dtype=dtype)
+    order = np.argsort(report_index, kind='stable')
+    counts = np.bincount(report_index, minlength=n_reports)
+    offsets = np.zeros(n_reports + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, values[order]
+
+
+def _owner_index(offsets):
+    """
+    Expands CSR offsets into the report index of every child row.
+    """
+    counts = np.diff(offsets)
+    return np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+
+
+class ColumnarStore:
+    """
+    Read-mostly in-memory copy of the report tables as NumPy columns.
+    Strings are dictionary-encoded, dates are int32 day numbers, and each
+    report's drugs, reactions and patients are located through CSR offsets.
+    Reports are kept sorted newest first (receivedate, then id, descending)
+    so filtered listings come out already in display order.
+    """
+
+    def __init__(self, arrays, drug_dict, reaction_dict, country_dict, watermark):
+        self.arrays = arrays
+        self.drug_dict = drug_dict
+        self.reaction_dict = reaction_dict
+        self.country_dict = country_dict
+        self.watermark = watermark
+        self._derive()
+
+    def _derive(self):
+        """
+        Computes helper arrays that are cheap to rebuild and never persisted.
+        """
+        a = self.arrays
+        self.n_reports = len(a['report_ids'])
+        self.drug_owner = _owner_index(a['drug_offsets'])
+        self.reaction_owner = _owner_index(a['reaction_offsets'])
+        self.patient_owner = _owner_index(a['patient_offsets'])
+        months = a['receive_days'].astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+        self.receive_months = months
+        self.neg_days = -a['receive_days'].astype(np.int64)
+
+    #########################
+    # BUILDING AND PERSISTENCE
+    #########################
+
+    @classmethod
+    def from_rows(cls, reports, drugs, reactions, patients, drug_dict=None, reaction_dict=None, country_dict=None):
+        """
+        Builds a store from iterables of row tuples:
+        reports (safetyreportid, receivedate, serious, country, *criteria),
+        drugs (safetyreportid, lowercased name), reactions (safetyreportid, term),
+        patients (safetyreportid, agegroup, sex).
+        """
+        drug_dict = drug_dict or _Dictionary()
+        reaction_dict = reaction_dict or _Dictionary()
+        country_dict = country_dict or _Dictionary([''])
+
+        ids, days, serious, countries = [], [], [], []
+        criteria = {name: [] for name in CRITERIA_COLUMNS}
+        for row in reports:
+            ids.append(row[0])
+            days.append(_to_days(row[1]))
+            serious.append(row[2] if row[2] is not None else 0)
+            countries.append(country_dict.code(row[3] or ''))
+            for (name, value) in zip(CRITERIA_COLUMNS, row[4:]):
+                criteria[name].append(1 if value == 1 else 0)
+
+        report_ids = np.array([i.encode('utf-8') for i in ids], dtype='S') if ids else np.zeros(0, dtype='S1')
+        receive_days = np.array(days, dtype=np.int32)
+
+        # Newest first, ties broken by descending id
+        order = np.lexsort((report_ids, receive_days))[::-1]
+        position = {ids[i]: p for (p, i) in enumerate(order.tolist())}
+        n = len(ids)
+
+        arrays = {
+            'report_ids': report_ids[order],
+            'receive_days': receive_days[order],
+            'serious': np.array(serious, dtype=np.int8)[order],
+            'country_codes': np.array(countries, dtype=np.int32)[order],
+        }
+        for name in CRITERIA_COLUMNS:
+            arrays[name] = np.array(criteria[name], dtype=np.int8)[order]
+
+        def child(rows, encode):
+            owners, values = [], []
+            for row in rows:
+                p = position.get(row[0])
+                if p is not None:
+                    owners.append(p)
+                    values.append(encode(row))
+            return owners, values
+
+        owners, values = child(drugs, lambda r: drug_dict.code(r[1]))
+        arrays['drug_offsets'], arrays['drug_codes'] = _csr(owners, values, n, np.int32)
+        owners, values = child(reactions, lambda r: reaction_dict.code(r[1]))
+        arrays['reaction_offsets'], arrays['reaction_codes'] = _csr(owners, values, n, np.int32)
+        owners, values = child(patients, lambda r: (r[1] or 0, r[2] or 0))
+        pairs = np.array(values, dtype=np.int8).reshape(-1, 2)
+        arrays['patient_offsets'], sorted_pairs = _csr(owners, pairs, n, np.int8)
+        arrays['patient_agegroup'] = np.ascontiguousarray(sorted_pairs[:, 0])
+        arrays['patient_sex'] = np.ascontiguousarray(sorted_pairs[:, 1])
+
+        watermark = int(receive_days.max()) if n else None
+        return cls(arrays, drug_dict, reaction_dict, country_dict, watermark)
+
+    @classmethod
+    def load_from_db(cls, since_days=None):
+        """
+        Loads the report tables (optionally only reports received on or after
+        `since_days`) and builds a store from them.
+        """
+        criteria_cols = [getattr(SafetyReport, name) for name in CRITERIA_COLUMNS]
+        report_stmt = select(SafetyReport.safetyreportid, SafetyReport.receivedate, SafetyReport.serious,
+                             SafetyReport.primarysource_reportercountry, *criteria_cols)
+        child_filter = None
+        if since_days is not None:
+            since = EPOCH + datetime.timedelta(days=since_days)
+            report_stmt = report_stmt.where(SafetyReport.receivedate >= since)
+            child_filter = select(SafetyReport.safetyreportid).where(SafetyReport.receivedate >= since)
+
+        def stream(stmt, owner_column):
+            if child_filter is not None:
+                stmt = stmt.where(owner_column.in_(child_filter))
+            result = db.session.execute(stmt.execution_options(yield_per=FETCH_BATCH_SIZE))
+            for part in result.partitions():
+                yield from part
+
+        reports = list(stream(report_stmt, SafetyReport.safetyreportid))
+        drugs = stream(select(Drug.safetyreportid, func.lower(Drug.medicinalproduct)), Drug.safetyreportid)
+        reactions = stream(select(Reaction.safetyreportid, Reaction.reactionmeddrapt), Reaction.safetyreportid)
+        patients = stream(select(Patient.safetyreportid, Patient.patientagegroup, Patient.patientsex),
+                          Patient.safetyreportid)
+        return cls.from_rows(reports, drugs, reactions, patients)
+
+    def save(self, path):
+        """
+        Writes every column as a .npy file plus a meta.json with the
+        dictionaries into a new version directory under `path`, then points
+        the CURRENT file at it. Files of a published version are never
+        rewritten, so processes that have them memory-mapped keep reading a
+        complete store; they switch when they next see CURRENT change.
+        Versions older than the one replaced are removed.
+        Returns the version directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        previous = read_pointer(path)
+        version = f"v{time.time_ns()}"
+        directory = os.path.join(path, version)
+        os.makedirs(directory)
+        for (name, arr) in self.arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(arr))
+        meta = {
+            'drugs': self.drug_dict.values,
+            'reactions': self.reaction_dict.values,
+            'countries': self.country_dict.values,
+            'watermark': self.watermark,
+            'n_reports': self.n_reports,
+        }
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        tmp = os.path.join(path, POINTER_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(tmp, os.path.join(path, POINTER_FILE))
+
+        # A reader may have just read the previous pointer, so that version stays
+        for entry in os.listdir(path):
+            if entry.startswith('v') and entry not in (version, previous):
+                shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+        return directory
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        """
+        Opens the current version of a saved store. With mmap the column
+        files are memory-mapped read-only, so processes opening the same
+        store share the page cache.
+        """
+        directory = version_directory(path)
+        if directory is None:
+            raise FileNotFoundError(f"No columnar store at {path}")
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        names = list(REPORT_COLUMNS) + CRITERIA_COLUMNS + CHILD_COLUMNS
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in names}
+        return cls(arrays, _Dictionary(meta['drugs']), _Dictionary(meta['reactions']),
+                   _Dictionary(meta['countries']), meta['watermark'])
+
+    def refreshed(self):
+        """
+        Returns a new store with the reports received since the watermark
+        appended. Reports on the watermark day that are already present are
+        not duplicated. Edits to older reports need a full rebuild.
+        """
+        if self.watermark is None:
+            return ColumnarStore.load_from_db()
+        fresh = ColumnarStore.load_from_db(since_days=self.watermark)
+        known = set(self.arrays['report_ids'][self.neg_days == -self.watermark].tolist())
+        keep = np.array([rid not in known for rid in fresh.arrays['report_ids'].tolist()], dtype=bool)
+        if not keep.any():
+            return self
+        return self.merged(fresh, keep)
+
+    def merged(self, other, keep):
+        """
+        Combines this store with the reports of `other` selected by `keep`,
+        re-encoding the other store's dictionary codes into this store's.
+        """
+        drug_dict = _Dictionary(self.drug_dict.values)
+        reaction_dict = _Dictionary(self.reaction_dict.values)
+        country_dict = _Dictionary(self.country_dict.values)
+
+        def rows(store, mask, drug_map, reaction_map, country_map):
+            a = store.arrays
+            idx = np.flatnonzero(mask)
+            ids = [i.decode('utf-8') for i in a['report_ids'][idx].tolist()]
+            reports = []
+            for (k, i) in enumerate(idx.tolist()):
+                day = EPOCH + datetime.timedelta(days=int(a['receive_days'][i]))
+                reports.append((ids[k], day, int(a['serious'][i]), country_map[int(a['country_codes'][i])],
+                                *[int(a[name][i]) for name in CRITERIA_COLUMNS]))
+            drugs, reactions, patients = [], [], []
+            for (k, i) in enumerate(idx.tolist()):
+                for j in range(a['drug_offsets'][i], a['drug_offsets'][i + 1]):
+                    drugs.append((ids[k], drug_map[int(a['drug_codes'][j])]))
+                for j in range(a['reaction_offsets'][i], a['reaction_offsets'][i + 1]):
+                    reactions.append((ids[k], reaction_map[int(a['reaction_codes'][j])]))
+                for j in range(a['patient_offsets'][i], a['patient_offsets'][i + 1]):
+                    patients.append((ids[k], int(a['patient_agegroup'][j]), int(a['patient_sex'][j])))
+            return reports, drugs, reactions, patients
+
+        mine = rows(self, np.ones(self.n_reports, dtype=bool),
+                    self.drug_dict.values, self.reaction_dict.values, self.country_dict.values)
+        theirs = rows(other, keep, other.drug_dict.values, other.reaction_dict.values, other.country_dict.values)
+        return ColumnarStore.from_rows(mine[0] + theirs[0], mine[1] + theirs[1], mine[2] + theirs[2],
+                                       mine[3] + theirs[3], drug_dict, reaction_dict, country_dict)
+
+    #########################
+    # QUERIES
+    #########################
+
+    def report_mask(self, drug_query):
+        """
+        Boolean mask over reports mentioning a drug whose name contains the
+        query case-insensitively, like the ILIKE '%q%' filter of the SQL paths.
+        """
+        q = drug_query.lower()
+        code_match = np.fromiter((name is not None and q in name for name in self.drug_dict.values), dtype=bool,
+                                 count=len(self.drug_dict.values))
+        mask = np.zeros(self.n_reports, dtype=bool)
+        if code_match.any():
+            rows = code_match[self.arrays['drug_codes']]
+            mask[self.drug_owner[rows]] = True
+        return mask
+
+    def statistics(self, drug_query):
+        """
+        Computes the dashboard statistics for a drug query with vectorized
+        masks and bincounts. Produces the same StatisticsResult as the SQL engine.
+        """
+        if not drug_query:
+            return StatisticsResult(drug_query)
+        a = self.arrays
+        mask = self.report_mask(drug_query)
+        total = int(mask.sum())
+        if total == 0:
+            return StatisticsResult(drug_query)
+
+        serious = a['serious'][mask]
+        seriousness_counts = {
+            "Serious": int((serious == 1).sum()),
+            "Non-Serious": int((serious != 1).sum()),
+        }
+        serious_criteria_counts = {label: int(a[column.key][mask].sum()) for (label, column) in SERIOUS_CRITERIA}
+
+        monthly_data = {}
+        months = self.receive_months[mask]
+        base = int(months.min())
+        counts = np.bincount(months - base)
+        for offset in np.flatnonzero(counts).tolist():
+            m = base + offset
+            monthly_data[f"{1970 + m // 12}-{m % 12 + 1:02d}"] = int(counts[offset])
+
+        age_group_counts = {}
+        patient_rows = mask[self.patient_owner]
+        ages = np.bincount(a['patient_agegroup'][patient_rows].astype(np.int64) & 0xFF)
+        for code in np.flatnonzero(ages).tolist():
+            label = AGE_GROUP_LABELS.get(code, "Unknown")
+            age_group_counts[label] = age_group_counts.get(label, 0) + int(ages[code])
+
+        country_counts = {}
+        countries = np.bincount(a['country_codes'][mask], minlength=len(self.country_dict.values))
+        for code in np.flatnonzero(countries).tolist():
+            label = self.country_dict.values[code] or "Unknown"
+            country_counts[label] = country_counts.get(label, 0) + int(countries[code])
+
+        return StatisticsResult(drug_query,
+                                total_reports=total,
+                                monthly_data=monthly_data,
+                                age_group_counts=age_group_counts,
+                                seriousness_counts=seriousness_counts,
+                                serious_criteria_counts=sort_counts_desc(serious_criteria_counts),
+                                country_counts=sort_counts_desc(country_counts),
+                                top_reactions=self.top_reactions(mask))
+
+    def top_reactions(self, mask, limit=TOP_REACTIONS_LIMIT):
+        """
+        Returns the most frequent reaction terms among the masked reports.
+        """
+        rows = mask[self.reaction_owner]
+        counts = np.bincount(self.arrays['reaction_codes'][rows], minlength=len(self.reaction_dict.values))
+        nonzero = np.flatnonzero(counts)
+        if len(nonzero) > limit:
+            nonzero = nonzero[np.argpartition(counts[nonzero], -limit)[-limit:]]
+        top = sorted(nonzero.tolist(), key=lambda c: (-counts[c], self.reaction_dict.values[c]))
+        return {self.reaction_dict.values[c]: int(counts[c]) for c in top}
+
+    def _cursor_position(self, cursor, past):
+        """
+        Returns the listing index of a (receivedate, id) cursor: the first
+        report strictly after it when `past`, otherwise the cursor's own slot.
+        """
+        day = _to_days(cursor[0])
+        rid = str(cursor[1]).encode('utf-8')
+        lo = int(np.searchsorted(self.neg_days, -day, side='left'))
+        hi = int(np.searchsorted(self.neg_days, -day, side='right'))
+        block = self.arrays['report_ids'][lo:hi][::-1]
+        side = 'left' if past else 'right'
+        return lo + (hi - lo) - int(np.searchsorted(block, rid, side=side))
+
+    def page_report_ids(self, drug_query, per_page, page=1, after=None, before=None):
+        """
+        Returns (report_ids, has_more, total) for one listing page in
+        (receivedate, id) descending order, using the same cursor semantics
+        as the SQL keyset pagination.
+        """
+        mask = self.report_mask(drug_query) if drug_query else np.ones(self.n_reports, dtype=bool)
+        idx = np.flatnonzero(mask)
+        if before is not None:
+            end = int(np.searchsorted(idx, self._cursor_position(before, past=False)))
+            start = max(0, end - per_page)
+            chosen, has_more = idx[start:end], start > 0
+        else:
+            if after is not None:
+                start = int(np.searchsorted(idx, self._cursor_position(after, past=True)))
+            else:
+                start = (page - 1) * per_page
+            chosen = idx[start:start + per_page]
+            has_more = start + per_page < len(idx)
+        ids = [i.decode('utf-8') for i in self.arrays['report_ids'][chosen].tolist()]
+        return ids, has_more, len(idx)
+
+
+#########################
+# SHARED INSTANCE
+#########################
+
+_store = None
+_store_version = None
+_store_lock = threading.Lock()
+
+
+def read_pointer(path):
+    """
+    Returns the name of the store version CURRENT points to, or None.
+    """
+    try:
+        with open(os.path.join(path, POINTER_FILE), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def version_directory(path):
+    """
+    Returns the directory holding the current version of a store, or None
+    when there is none. A store written before versioning (meta.json
+    directly under `path`) is its own single version.
+    """
+    version = read_pointer(path)
+    if version is not None:
+        return os.path.join(path, version)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return path
+    return None
+
+
+def get_store():
+    """
+    Returns the configured store, opening or reopening it when CURRENT
+    points to a new version.
+    Returns None unless ANALYTICS_BACKEND is 'columnar' and a saved store exists.
+    """
+    global _store, _store_version
+    if current_app.config.get('ANALYTICS_BACKEND') != 'columnar':
+        return None
+    path = current_app.config['ANALYTICS_STORE_PATH']
+    directory = version_directory(path)
+    if directory is None:
+        return None
+    with _store_lock:
+        if _store is None or directory != _store_version:
+            _store = ColumnarStore.open(path)
+            _store_version = directory
+        return _store
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+columnar_cli = AppGroup('columnar', help="Build and refresh the columnar analytics store.")
+
+
+@columnar_cli.command('build')
+def build_command():
+    """
+    Loads every report from the database and writes the store to disk.
+    """
+    store = ColumnarStore.load_from_db()
+    store.save(current_app.config['ANALYTICS_STORE_PATH'])
+    click.echo(f"Saved {store.n_reports} reports to {current_app.config['ANALYTICS_STORE_PATH']}")
+
+
+@columnar_cli.command('refresh')
+def refresh_command():
+    """
+    Appends reports received since the stored watermark and saves the store.
+    """
+    path = current_app.config['ANALYTICS_STORE_PATH']
+    if version_directory(path) is None:
+        raise click.ClickException("No store found; run 'flask columnar build' first.")
+    old = ColumnarStore.open(path, mmap=False)
+    store = old.refreshed()
+    if store is old:
+        click.echo("No new reports.")
+        return
+    store.save(path)
+    click.echo(f"Added {store.n_reports - old.n_reports} reports ({store.n_reports} total)")
@@ -0,0 +1,156 @@
+# comparison.py
+
+from sqlalchemy import select, func, extract, literal, union, and_
+
+from models import db, SafetyReport, Drug, Patient, Reaction
+from query_executor import query_executor
+from stats_engine import (build_statistics_result, statistics_scalar_columns,
+                          StatisticsResult, TOP_REACTIONS_LIMIT)
+import drug_dictionary
+import dedup
+
+
+class ComparisonResult:
+    """
+    Side-by-side statistics for several drug queries, plus the number of
+    reports mentioning more than one of them.
+    """
+
+    def __init__(self, queries, results=None, overlaps=None, multi_drug_reports=0, unavailable=None):
+        self.queries = queries
+        self.results = results or [StatisticsResult(q) for q in queries]
+        # [(query_a, query_b, shared report count)] for every pair sharing a report
+        self.overlaps = overlaps or []
+        self.multi_drug_reports = multi_drug_reports
+        # Breakdowns whose statement timed out or failed
+        self.unavailable = unavailable or []
+
+    def to_dict(self):
+        """
+        Returns the result as a plain dictionary, suitable for JSON or templates.
+        """
+        return {
+            'queries': self.queries,
+            'results': [r.to_dict() for r in self.results],
+            'overlaps': [{'drugs': [a, b], 'reports': n} for (a, b, n) in self.overlaps],
+            'multi_drug_reports': self.multi_drug_reports,
+            'unavailable': self.unavailable,
+        }
+
+
+def parse_drug_list(raw, max_drugs):
+    """
+    Splits a comma-separated list of drug queries, dropping blanks and
+    case-insensitive duplicates. Raises ValueError beyond `max_drugs`.
+    """
+    queries = []
+    seen = set()
+    for part in (raw or '').split(','):
+        q = part.strip()
+        if q and q.lower() not in seen:
+            seen.add(q.lower())
+            queries.append(q)
+    if len(queries) > max_drugs:
+        raise ValueError(f"At most {max_drugs} drugs can be compared at once.")
+    return queries
+
+
+def _drug_report_pairs(drug_queries, bind, deduplicated=False):
+    """
+    Builds a subquery of distinct (drug, safetyreportid) pairs, where drug is
+    the position of the matching query. Names are resolved against the drug
+    dictionary in a single statement when it is populated. With
+    `deduplicated`, superseded versions of a case are left out.
+    """
+    if drug_dictionary.dictionary_ready(bind):
+        product_ids = drug_dictionary.matching_product_ids_by_query(drug_queries, bind)
+        filters = [Drug.drug_product_id.in_(ids) for ids in product_ids]
+    else:
+        filters = [Drug.medicinalproduct.ilike(f"%{q}%") for q in drug_queries]
+    if deduplicated:
+        filters = [and_(f, dedup.canonical_only(Drug.safetyreportid)) for f in filters]
+    selects = [select(literal(i).label('drug'), Drug.safetyreportid.label('safetyreportid')).where(f)
+               for (i, f) in enumerate(filters)]
+    return union(*selects).subquery('pairs')
+
+
+def compare_drugs(drug_queries, bind=None, deduplicated=False):
+    """
+    Computes the statistics of every drug query together. Each breakdown is
+    one statement grouped by the drug position, so the number of queries
+    does not grow with the number of drugs compared.
+    """
+    if not drug_queries:
+        return ComparisonResult(drug_queries)
+
+    parallel_bind = bind
+    bind = bind or db.session
+    pairs = _drug_report_pairs(drug_queries, bind, deduplicated)
+    drug = pairs.c.drug
+    reports = pairs.join(SafetyReport, SafetyReport.safetyreportid == pairs.c.safetyreportid)
+    patients = pairs.join(Patient, Patient.safetyreportid == pairs.c.safetyreportid)
+    reactions = pairs.join(Reaction, Reaction.safetyreportid == pairs.c.safetyreportid)
+
+    yr = extract('year', SafetyReport.receivedate).label('yr')
+    mo = extract('month', SafetyReport.receivedate).label('mo')
+
+    # Top reactions of each drug, ranked within the drug
+    reaction_count = func.count(Reaction.id)
+    ranked = (select(drug, Reaction.reactionmeddrapt, reaction_count.label('n'),
+                     func.row_number().over(partition_by=drug,
+                                            order_by=(reaction_count.desc(), Reaction.reactionmeddrapt))
+                     .label('position'))
+              .select_from(reactions)
+              .group_by(drug, Reaction.reactionmeddrapt)
+              .subquery('ranked'))
+
+    # Reports shared by each pair of drugs, and by any two or more of them
+    a = pairs.alias('a')
+    b = pairs.alias('b')
+    shared = (select(pairs.c.safetyreportid)
+              .group_by(pairs.c.safetyreportid)
+              .having(func.count() > 1)
+              .subquery('shared'))
+
+    statements = {
+        'scalar': (select(drug, *statistics_scalar_columns())
+                   .select_from(reports)
+                   .group_by(drug)),
+        'monthly': (select(drug, yr, mo, func.count(SafetyReport.safetyreportid))
+                    .select_from(reports)
+                    .group_by(drug, yr, mo)
+                    .order_by(drug, yr, mo)),
+        'age': (select(drug, Patient.patientagegroup, func.count(Patient.id))
+                .select_from(patients)
+                .group_by(drug, Patient.patientagegroup)),
+        'country': (select(drug, SafetyReport.primarysource_reportercountry,
+                           func.count(SafetyReport.safetyreportid))
+                    .select_from(reports)
+                    .group_by(drug, SafetyReport.primarysource_reportercountry)),
+        'reactions': (select(ranked.c.drug, ranked.c.reactionmeddrapt, ranked.c.n)
+                      .where(ranked.c.position <= TOP_REACTIONS_LIMIT)),
+        'overlaps': (select(a.c.drug, b.c.drug, func.count())
+                     .select_from(a.join(b, and_(a.c.safetyreportid == b.c.safetyreportid,
+                                                 a.c.drug < b.c.drug)))
+                     .group_by(a.c.drug, b.c.drug)),
+        'multi_drug': select(func.count()).select_from(shared),
+    }
+    rows, failed = query_executor.run(statements, parallel_bind)
+    if 'scalar' in failed:
+        # The totals are required; retry them once on the caller's connection,
+        # under the same timeout (QueryTimeout if they miss it again)
+        rows['scalar'] = query_executor.execute(statements['scalar'], bind)
+        failed.remove('scalar')
+
+    # Split every grouped result into per-drug row lists
+    per_drug = [{} for _ in drug_queries]
+    for name in ('scalar', 'monthly', 'age', 'country', 'reactions'):
+        for row in rows.get(name, []):
+            per_drug[row[0]].setdefault(name, []).append(tuple(row[1:]))
+    drug_failed = [name for name in failed if name in ('monthly', 'age', 'country', 'reactions')]
+    results = [build_statistics_result(q, per_drug[i], drug_failed) for (i, q) in enumerate(drug_queries)]
+
+    overlaps = [(drug_queries[i], drug_queries[j], int(n)) for (i, j, n) in rows.get('overlaps', [])]
+    overlaps.sort(key=lambda x: -x[2])
+    multi_drug_reports = int(rows['multi_drug'][0][0]) if 'multi_drug' in rows else 0
+    return ComparisonResult(drug_queries, results, overlaps, multi_drug_reports, failed)
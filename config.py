@@ -27,3 +27,181 @@ class Config:
     # Disables the SQLAlchemy event system to save resources.
     # Setting to True to suppress modification tracking, which is unnecessary in this context.
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+
+    # Database backend: 'mysql' (the URI above) or 'snapshot', serving the
+    # read-only pages and APIs from the SQLite file at SNAPSHOT_PATH written
+    # by `flask snapshot export`. A snapshot needs no server: it is opened
+    # immutable, read through SNAPSHOT_MMAP_BYTES of memory-mapped I/O with
+    # a SNAPSHOT_CACHE_KIB page cache per connection, and background jobs,
+    # replicas and admin edits are unavailable.
+    DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'mysql')
+    SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'snapshot.sqlite')
+    SNAPSHOT_MMAP_BYTES = int(os.getenv('SNAPSHOT_MMAP_BYTES', str(8 * 2 ** 30)))
+    SNAPSHOT_CACHE_KIB = int(os.getenv('SNAPSHOT_CACHE_KIB', '65536'))
+
+    # Response cache backend. The default is a bounded in-process LRU; use
+    # 'flask_caching.backends.FileSystemCache' (with CACHE_DIR) or
+    # 'flask_caching.backends.RedisCache' (with CACHE_REDIS_URL) to share the
+    # cached responses themselves between worker processes or hosts. With an
+    # in-process backend, the data version that invalidates them is kept in
+    # the DATA_VERSION_PATH file, so admin edits in one worker and CLI
+    # commands (ingest, dedup, rebuilds) reach every process on the host.
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'caching.LRUCache')
+    CACHE_THRESHOLD = int(os.getenv('CACHE_THRESHOLD', '2000'))
+    CACHE_DIR = os.getenv('CACHE_DIR', 'cache_data')
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    CACHE_DEFAULT_TIMEOUT = int(os.getenv('CACHE_DEFAULT_TIMEOUT', '300'))
+    DATA_VERSION_PATH = os.getenv('DATA_VERSION_PATH', os.path.join('cache_data', 'data_version'))
+
+    # Per-endpoint cache lifetimes in seconds; entries are also invalidated
+    # whenever the data version is bumped by an admin edit or ingestion.
+    CACHE_TIMEOUTS = {
+        'index': 120,
+        'search': 300,
+        'report_detail': 3600,
+        'api_reports': 3600,
+        'autocomplete': 3600,
+        'statistics': 900,
+        'api_statistics': 900,
+        'compare': 900,
+        'api_compare': 900,
+        'signals': 900,
+        'api_signals': 900,
+        'interactions_page': 900,
+        'api_interactions': 900,
+    }
+
+    # Backend answering statistics and filtered report listings: 'sql' queries
+    # the database (and rollup tables), 'columnar' uses the NumPy store saved
+    # at ANALYTICS_STORE_PATH by 'flask columnar build' and kept current with
+    # 'flask columnar refresh'. Falls back to SQL while no store exists.
+    ANALYTICS_BACKEND = os.getenv('ANALYTICS_BACKEND', 'sql')
+    ANALYTICS_STORE_PATH = os.getenv('ANALYTICS_STORE_PATH', 'columnar_store')
+
+    # Per-request SQL instrumentation: Server-Timing headers, Prometheus
+    # histograms on /metrics and N+1 warnings once one statement shape runs
+    # N_PLUS_ONE_THRESHOLD times in a request. Statements slower than
+    # SLOW_QUERY_THRESHOLD_MS (unset disables) are logged to SLOW_QUERY_LOG,
+    # with the EXPLAIN output of SELECTs when SLOW_QUERY_EXPLAIN is on.
+    INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', '1') == '1'
+    N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', '10'))
+    SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '0')) or None
+    SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+    SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', '1') == '1'
+
+    # Connection pool settings. Dashboard queries run concurrently on
+    # separate pooled connections, so the pool should cover the number of
+    # web threads times QUERY_EXECUTOR_WORKERS, or requests fall back to
+    # running their queries one after another.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+    # Concurrent execution of independent read queries. Each query gets
+    # QUERY_TIMEOUT_SECONDS, after which it is cancelled on the server (also
+    # enforced by MySQL via MAX_EXECUTION_TIME); a timed-out chart is left
+    # empty instead of failing the whole page, while timed-out totals are
+    # retried once under the same limit and otherwise answered with a 503.
+    QUERY_EXECUTOR_ENABLED = os.getenv('QUERY_EXECUTOR_ENABLED', '1') == '1'
+    QUERY_EXECUTOR_WORKERS = int(os.getenv('QUERY_EXECUTOR_WORKERS', '8'))
+    QUERY_TIMEOUT_SECONDS = float(os.getenv('QUERY_TIMEOUT_SECONDS', '10'))
+
+    # Read replicas (comma-separated URIs) serving the read-only pages and
+    # APIs round-robin. A replica failing its health check is skipped until
+    # it passes again; with none healthy, reads go to the primary. Writes,
+    # ingestion and CLI commands always use SQLALCHEMY_DATABASE_URI. After
+    # an admin edit, that browser session reads from the primary for
+    # READ_YOUR_WRITES_SECONDS so the change is visible despite replica lag.
+    SQLALCHEMY_REPLICA_URIS = [u.strip() for u in os.getenv('SQLALCHEMY_REPLICA_URIS', '').split(',') if u.strip()]
+    REPLICA_HEALTH_CHECK_SECONDS = float(os.getenv('REPLICA_HEALTH_CHECK_SECONDS', '10'))
+    READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+
+    # Largest number of drugs /compare and /api/compare accept in one request
+    COMPARE_MAX_DRUGS = int(os.getenv('COMPARE_MAX_DRUGS', '8'))
+
+    # Background analytics jobs. Statistics and comparison requests expected
+    # to aggregate more than JOB_COST_THRESHOLD reports run in a pool of
+    # JOB_WORKERS local processes (with JOB_QUERY_TIMEOUT_SECONDS per query)
+    # while the browser polls for progress. Identical requests share a job
+    # and its result for JOB_RESULT_TTL_SECONDS or until the data changes.
+    JOBS_ENABLED = os.getenv('JOBS_ENABLED', '1') == '1'
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+    JOB_COST_THRESHOLD = int(os.getenv('JOB_COST_THRESHOLD', '20000'))
+    JOBS_PER_USER_LIMIT = int(os.getenv('JOBS_PER_USER_LIMIT', '2'))
+    JOB_RESULT_TTL_SECONDS = int(os.getenv('JOB_RESULT_TTL_SECONDS', '3600'))
+    JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '900'))
+    JOB_QUERY_TIMEOUT_SECONDS = float(os.getenv('JOB_QUERY_TIMEOUT_SECONDS', '600'))
+
+    # Report exports. EXPORT_BATCH_SIZE reports are fetched per server-side
+    # cursor batch, which bounds the memory an export of any size needs.
+    # Background exports (background=1) are written to EXPORT_DIR and
+    # deleted by `flask jobs purge`.
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+    EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+
+    # /api/reports: largest number of ids per request, and how long browsers
+    # may reuse a response before revalidating it with its ETag
+    REPORT_API_MAX_IDS = int(os.getenv('REPORT_API_MAX_IDS', '100'))
+    REPORT_API_MAX_AGE = int(os.getenv('REPORT_API_MAX_AGE', '60'))
+
+    # Receive-date partitioning. Report listings are served one
+    # PARTITION_GRANULARITY period ('year' or 'quarter') at a time, newest
+    # first, so date filters prune whole periods. `flask partitions apply`
+    # partitions safety_reports natively on MySQL; `flask partitions
+    # archive` moves old reports into read-only SQLite files under
+    # PARTITION_ARCHIVE_DIR. PARTITIONING_ENABLED is '1', '0' or 'auto',
+    # which enables the per-period listings only on a natively partitioned
+    # table; elsewhere one keyset query per page is cheaper.
+    PARTITIONING_ENABLED = os.getenv('PARTITIONING_ENABLED', 'auto')
+    PARTITION_GRANULARITY = os.getenv('PARTITION_GRANULARITY', 'year')
+    PARTITION_ARCHIVE_DIR = os.getenv('PARTITION_ARCHIVE_DIR', 'archives')
+
+    # Duplicate detection (`flask dedup run`). Reports from the same
+    # reporter country and patient sex whose drug and reaction sets have a
+    # Jaccard similarity of at least DEDUP_SIMILARITY_THRESHOLD, compatible
+    # age groups and receive dates at most DEDUP_MAX_DAYS apart are
+    # clustered as versions of one case; dedup=1 hides all but the newest.
+    # LSH buckets with more than DEDUP_MAX_BUCKET_SIZE reports are too
+    # generic to compare. Fingerprints are computed on DEDUP_WORKERS
+    # processes (0 for one per CPU).
+    DEDUP_SIMILARITY_THRESHOLD = float(os.getenv('DEDUP_SIMILARITY_THRESHOLD', '0.8'))
+    DEDUP_MAX_DAYS = int(os.getenv('DEDUP_MAX_DAYS', '730'))
+    DEDUP_MAX_BUCKET_SIZE = int(os.getenv('DEDUP_MAX_BUCKET_SIZE', '500'))
+    DEDUP_WORKERS = int(os.getenv('DEDUP_WORKERS', '0'))
+
+    # Pre-fork warm-up, run by create_app(warm=True) as gunicorn.conf.py
+    # does in the master process: loads the autocomplete index and the
+    # columnar store and renders the listing plus the statistics of the
+    # WARMUP_TOP_DRUGS most reported drugs (and any comma-separated
+    # WARMUP_URLS) into the response cache, so every worker starts warm.
+    # WARMUP_FREEZE_GC keeps the collector from copying the shared pages.
+    WARMUP_TOP_DRUGS = int(os.getenv('WARMUP_TOP_DRUGS', '10'))
+    WARMUP_URLS = [u.strip() for u in os.getenv('WARMUP_URLS', '').split(',') if u.strip()]
+    WARMUP_FREEZE_GC = os.getenv('WARMUP_FREEZE_GC', '1') == '1'
+
+    # Bulk admin operations (mass update, grid edits, CSV import, delete)
+    # run BULK_CHUNK_SIZE rows per transaction; those touching more than
+    # JOB_COST_THRESHOLD rows run as background jobs. Uploaded CSV files
+    # wait in BULK_UPLOAD_DIR until they are imported.
+    BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', '1000'))
+    BULK_UPLOAD_DIR = os.getenv('BULK_UPLOAD_DIR', 'uploads')
+
+    # Approximate mode (approx=1 on /, /statistics and /api/statistics).
+    # Drug queries estimated to match at least APPROX_MIN_REPORTS reports
+    # are answered from a stratified sample of about APPROX_SAMPLE_SIZE
+    # reports (at least APPROX_MIN_STRATUM_SAMPLE per receive year and
+    # seriousness) scaled to per-drug HyperLogLog counts with
+    # 2^APPROX_HLL_PRECISION registers, with 95% margins of error; smaller
+    # queries, or ones matching fewer than APPROX_MIN_SAMPLE_MATCHES sampled
+    # reports, are computed exactly. `flask approx rebuild` draws the sample
+    # and ingestion keeps it current.
+    APPROX_ENABLED = os.getenv('APPROX_ENABLED', '1') == '1'
+    APPROX_SAMPLE_SIZE = int(os.getenv('APPROX_SAMPLE_SIZE', '100000'))
+    APPROX_MIN_STRATUM_SAMPLE = int(os.getenv('APPROX_MIN_STRATUM_SAMPLE', '200'))
+    APPROX_HLL_PRECISION = int(os.getenv('APPROX_HLL_PRECISION', '12'))
+    APPROX_MIN_REPORTS = int(os.getenv('APPROX_MIN_REPORTS', '20000'))
+    APPROX_MIN_SAMPLE_MATCHES = int(os.getenv('APPROX_MIN_SAMPLE_MATCHES', '100'))
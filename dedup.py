@@ -0,0 +1,478 @@
+# dedup.py
+
+import datetime
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, func
+
+from models import (db, SafetyReport, Patient, Drug, Reaction, ReportFingerprint, ReportDedupBucket,
+                    ReportCluster)
+from caching import view_cache
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# MinHash signature length, split into BANDS bands of ROWS values for LSH.
+# Reports with Jaccard similarity s share a bucket with probability
+# 1 - (1 - s^ROWS)^BANDS: 0.98 at s = 0.8, 0.40 at s = 0.5.
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+# Reports with fewer drug and reaction tokens are too generic to match
+MIN_TOKENS = 3
+
+# Reports fingerprinted per worker task
+CHUNK_SIZE = 2000
+
+# Candidate pairs confirmed per batch of fingerprint lookups
+PAIR_BATCH_SIZE = 50000
+
+# Ids per IN (...) lookup
+ID_CHUNK_SIZE = 1000
+
+_PRIME = 4294967311
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+#########################
+# FINGERPRINTS
+#########################
+
+def blocking_key(country, sex):
+    """
+    Reports are only compared within the same reporter country and patient sex.
+    """
+    return f"{country or ''}:{sex or ''}"
+
+
+@functools.lru_cache(maxsize=None)
+def _permutations():
+    """
+    Fixed hash permutations, so signatures from separate runs are comparable.
+    """
+    rng = np.random.RandomState(20240601)
+    return (rng.randint(1, 2 ** 31, NUM_PERM).astype(np.uint64),
+            rng.randint(0, 2 ** 32, NUM_PERM, dtype=np.int64).astype(np.uint64))
+
+
+def minhash(tokens):
+    """
+    Returns the NUM_PERM-value MinHash signature of a set of string tokens.
+    """
+    (perm_a, perm_b) = _permutations()
+    x = np.fromiter((zlib.crc32(t.encode('utf-8')) for t in tokens), dtype=np.uint64, count=len(tokens))
+    return ((np.outer(perm_a, x) + perm_b[:, None]) % _PRIME).min(axis=1)
+
+
+def band_buckets(key, signature):
+    """
+    Hashes each band of a signature, salted with the blocking key, into a
+    signed 64-bit bucket id.
+    """
+    buckets = []
+    for band in range(BANDS):
+        values = signature[band * ROWS:(band + 1) * ROWS]
+        digest = hashlib.blake2b(f"{key}|{band}|".encode('utf-8') + values.tobytes(), digest_size=8).digest()
+        buckets.append(int.from_bytes(digest, 'big', signed=True))
+    return buckets
+
+
+def compute_fingerprints(conn, ids):
+    """
+    Builds the fingerprint and bucket rows of the given reports.
+    Drugs are identified by drug dictionary product where linked, so
+    spelling variants of one product match; reactions by lowercased term.
+    """
+    reports = {row.safetyreportid: row for row in
+               conn.execute(select(SafetyReport.safetyreportid, SafetyReport.primarysource_reportercountry,
+                                   SafetyReport.receivedate, SafetyReport.receiptdate)
+                            .where(SafetyReport.safetyreportid.in_(ids)))}
+    first_patient = {}
+    for row in conn.execute(select(Patient.safetyreportid, Patient.patientagegroup, Patient.patientsex)
+                            .where(Patient.safetyreportid.in_(ids))
+                            .order_by(Patient.id)):
+        first_patient.setdefault(row.safetyreportid, row)
+    tokens = {i: set() for i in reports}
+    for (rid, product_id, name) in conn.execute(select(Drug.safetyreportid, Drug.drug_product_id,
+                                                       Drug.medicinalproduct)
+                                                .where(Drug.safetyreportid.in_(ids))):
+        if product_id is not None:
+            tokens[rid].add(f"d{product_id}")
+        elif name:
+            tokens[rid].add(f"n{name.strip().lower()}")
+    for (rid, term) in conn.execute(select(Reaction.safetyreportid, Reaction.reactionmeddrapt)
+                                    .where(Reaction.safetyreportid.in_(ids))):
+        if term:
+            tokens[rid].add(f"r{term.strip().lower()}")
+
+    fingerprints, buckets = [], []
+    for (rid, report) in reports.items():
+        patient = first_patient.get(rid)
+        sex = patient.patientsex if patient else None
+        key = blocking_key(report.primarysource_reportercountry, sex)
+        report_tokens = sorted(tokens[rid])
+        fingerprints.append({
+            'safetyreportid': rid,
+            'blocking_key': key,
+            'tokens': json.dumps(report_tokens),
+            'patientagegroup': patient.patientagegroup if patient else None,
+            'patientsex': sex,
+            'receivedate': report.receivedate,
+            'receiptdate': report.receiptdate,
+        })
+        if len(report_tokens) >= MIN_TOKENS:
+            buckets.extend({'bucket': b, 'safetyreportid': rid}
+                           for b in band_buckets(key, minhash(report_tokens)))
+    return fingerprints, buckets
+
+
+_worker_app = None
+
+
+def _init_worker(config):
+    """
+    Sets up a minimal application in a freshly spawned worker process.
+    """
+    global _worker_app
+    app = Flask(__name__)
+    app.config.update(config)
+    db.init_app(app)
+    _worker_app = app
+
+
+def _fingerprint_chunk(ids):
+    with _worker_app.app_context():
+        with db.engine.connect() as conn:
+            return compute_fingerprints(conn, ids)
+
+
+def forget_reports(conn, ids):
+    """
+    Removes the fingerprints, buckets and cluster rows of the given reports
+    and of every report sharing a cluster with them, so the next
+    incremental run processes them again. Call when reports are replaced
+    or deleted.
+    """
+    ids = list(ids)
+    clusters = ReportCluster.__table__
+    members = set(ids)
+    for chunk in _chunks(ids, ID_CHUNK_SIZE):
+        cluster_ids = select(clusters.c.cluster_id).where(clusters.c.safetyreportid.in_(chunk))
+        members.update(conn.execute(select(clusters.c.safetyreportid)
+                                    .where(clusters.c.cluster_id.in_(cluster_ids))).scalars())
+    for chunk in _chunks(list(members), ID_CHUNK_SIZE):
+        for model in (ReportCluster, ReportDedupBucket, ReportFingerprint):
+            table = model.__table__
+            conn.execute(table.delete().where(table.c.safetyreportid.in_(chunk)))
+
+
+#########################
+# CANDIDATES AND CLUSTERS
+#########################
+
+def similarity(a, b, max_days):
+    """
+    Returns the Jaccard similarity of two fingerprints' token sets, or 0
+    when their known age groups differ or they were received more than
+    `max_days` apart.
+    """
+    if a['patientagegroup'] and b['patientagegroup'] and a['patientagegroup'] != b['patientagegroup']:
+        return 0.0
+    if max_days and a['receivedate'] and b['receivedate'] \
+            and abs((a['receivedate'] - b['receivedate']).days) > max_days:
+        return 0.0
+    union = len(a['tokens'] | b['tokens'])
+    return len(a['tokens'] & b['tokens']) / union if union else 0.0
+
+
+def _load_fingerprints(conn, ids):
+    table = ReportFingerprint.__table__
+    out = {}
+    for chunk in _chunks(list(ids), ID_CHUNK_SIZE):
+        for row in conn.execute(select(table).where(table.c.safetyreportid.in_(chunk))):
+            fp = dict(row._mapping)
+            fp['tokens'] = set(json.loads(fp['tokens']))
+            out[fp['safetyreportid']] = fp
+    return out
+
+
+def _bucket_groups(conn, max_bucket_size, new_ids=None):
+    """
+    Yields the report ids of every bucket shared by two or more reports,
+    streamed in bucket order. With `new_ids`, only buckets containing one
+    of them. Buckets larger than `max_bucket_size` hold overly common
+    signatures and are skipped (yielded as None).
+    """
+    table = ReportDedupBucket.__table__
+    if new_ids is None:
+        shared = select(table.c.bucket).group_by(table.c.bucket).having(func.count() > 1)
+        queries = [select(table.c.bucket, table.c.safetyreportid)
+                   .where(table.c.bucket.in_(shared))
+                   .order_by(table.c.bucket)]
+    else:
+        queries = [select(table.c.bucket, table.c.safetyreportid)
+                   .where(table.c.bucket.in_(select(table.c.bucket).where(table.c.safetyreportid.in_(chunk))))
+                   .order_by(table.c.bucket)
+                   for chunk in _chunks(list(new_ids), ID_CHUNK_SIZE)]
+    for stmt in queries:
+        result = conn.execution_options(stream_results=True, yield_per=10000).execute(stmt)
+        for (_, rows) in itertools.groupby(result, key=lambda row: row[0]):
+            members = [row[1] for row in rows]
+            if len(members) > max_bucket_size:
+                yield None
+            elif len(members) > 1:
+                yield members
+
+
+class _Clusters:
+    """
+    Union-find over report ids, tracking each report's best similarity.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.best = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            (self.parent[x], x) = (root, self.parent[x])
+        return root
+
+    def union(self, a, b, score):
+        (ra, rb) = (self.find(a), self.find(b))
+        if ra != rb:
+            self.parent[ra] = rb
+        self.best[a] = max(self.best.get(a, 0.0), score)
+        self.best[b] = max(self.best.get(b, 0.0), score)
+
+    def components(self):
+        groups = {}
+        for x in self.parent:
+            groups.setdefault(self.find(x), []).append(x)
+        return [g for g in groups.values() if len(g) > 1]
+
+
+def find_duplicates(conn, stream_conn, threshold, max_days, max_bucket_size, new_ids=None):
+    """
+    Confirms the candidate pairs of shared buckets against the full token
+    sets and returns (clusters, stats). With `new_ids`, only pairs
+    involving one of those reports are considered.
+    The buckets are streamed on `stream_conn`, which must be a different
+    connection from `conn`: with an unbuffered MySQL cursor, a fingerprint
+    query on the streaming connection would discard the rest of the stream.
+    """
+    clusters = _Clusters()
+    stats = {'candidate_pairs': 0, 'duplicate_pairs': 0, 'skipped_buckets': 0}
+    new_ids = set(new_ids) if new_ids is not None else None
+
+    def confirm(pairs):
+        fingerprints = _load_fingerprints(conn, {i for pair in pairs for i in pair})
+        for (a, b) in pairs:
+            score = similarity(fingerprints[a], fingerprints[b], max_days)
+            if score >= threshold:
+                clusters.union(a, b, score)
+                stats['duplicate_pairs'] += 1
+
+    pairs = set()
+    for members in _bucket_groups(stream_conn, max_bucket_size, new_ids):
+        if members is None:
+            stats['skipped_buckets'] += 1
+            continue
+        for (a, b) in itertools.combinations(sorted(members), 2):
+            if new_ids is None or a in new_ids or b in new_ids:
+                pairs.add((a, b))
+        if len(pairs) >= PAIR_BATCH_SIZE:
+            stats['candidate_pairs'] += len(pairs)
+            confirm(pairs)
+            pairs = set()
+    stats['candidate_pairs'] += len(pairs)
+    confirm(pairs)
+    return clusters, stats
+
+
+def _write_clusters(conn, clusters, replace_ids=None):
+    """
+    Stores the clusters, choosing the most recently received version of
+    each case as its canonical report. Existing rows of `replace_ids` (all
+    rows when None) are replaced.
+    """
+    table = ReportCluster.__table__
+    if replace_ids is None:
+        conn.execute(table.delete())
+    else:
+        for chunk in _chunks(list(replace_ids), ID_CHUNK_SIZE):
+            conn.execute(table.delete().where(table.c.safetyreportid.in_(chunk)))
+    now = datetime.datetime.utcnow()
+    rows = []
+    for group in clusters.components():
+        fingerprints = _load_fingerprints(conn, group)
+        canonical = max(group, key=lambda i: (fingerprints[i]['receiptdate'] or datetime.date.min,
+                                              fingerprints[i]['receivedate'] or datetime.date.min, i))
+        rows.extend({'safetyreportid': i, 'cluster_id': canonical, 'similarity': clusters.best.get(i, 1.0),
+                     'detected_at': now} for i in group)
+    for chunk in _chunks(rows, ID_CHUNK_SIZE):
+        conn.execute(table.insert(), chunk)
+    return len(rows)
+
+
+#########################
+# BATCH RUNS
+#########################
+
+def fingerprint_reports(engine, ids, workers, echo=click.echo):
+    """
+    Fingerprints the given reports in chunks of CHUNK_SIZE, on `workers`
+    processes when more than one, writing each chunk as it completes.
+    """
+    tasks = list(_chunks(ids, CHUNK_SIZE))
+    if workers > 1 and len(tasks) > 1:
+        config = {k: v for (k, v) in current_app.config.items() if k.isupper()}
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_worker, initargs=(config,))
+        results = executor.map(_fingerprint_chunk, tasks)
+    else:
+        executor = None
+
+        def compute_inline():
+            for chunk in tasks:
+                with engine.connect() as conn:
+                    yield compute_fingerprints(conn, chunk)
+        results = compute_inline()
+    try:
+        done = 0
+        for (fingerprints, buckets) in results:
+            with engine.begin() as conn:
+                if fingerprints:
+                    conn.execute(ReportFingerprint.__table__.insert(), fingerprints)
+                if buckets:
+                    conn.execute(ReportDedupBucket.__table__.insert(), buckets)
+            done += len(fingerprints)
+            echo(f"  fingerprinted {done} of {len(ids)} reports")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def run(engine, full=False, workers=1, threshold=0.8, max_days=730, max_bucket_size=500, echo=click.echo):
+    """
+    Detects duplicate reports. A full run recomputes every fingerprint and
+    cluster; an incremental run fingerprints only reports without one
+    (new, replaced or previously clustered with a deleted report) and
+    reclusters the clusters they join. Returns a stats dictionary.
+    """
+    fingerprints = ReportFingerprint.__table__
+    with engine.begin() as conn:
+        if full:
+            for model in (ReportCluster, ReportDedupBucket, ReportFingerprint):
+                conn.execute(model.__table__.delete())
+        else:
+            # Reports deleted since the last run drop out of their clusters
+            missing = conn.execute(select(fingerprints.c.safetyreportid)
+                                   .where(fingerprints.c.safetyreportid.notin_(
+                                       select(SafetyReport.safetyreportid)))).scalars().all()
+            forget_reports(conn, missing)
+        ids = conn.execute(select(SafetyReport.safetyreportid)
+                           .where(SafetyReport.safetyreportid.notin_(select(fingerprints.c.safetyreportid)))
+                           .order_by(SafetyReport.safetyreportid)).scalars().all()
+
+    stats = {'fingerprinted': len(ids)}
+    if not ids and not full:
+        return dict(stats, candidate_pairs=0, duplicate_pairs=0, skipped_buckets=0, clustered_reports=None)
+    fingerprint_reports(engine, ids, workers, echo)
+
+    with engine.begin() as conn:
+        with engine.connect() as stream_conn:
+            clusters, pair_stats = find_duplicates(conn, stream_conn, threshold, max_days, max_bucket_size,
+                                                   None if full else ids)
+        stats.update(pair_stats)
+        replace_ids = None
+        if not full:
+            # Merge the clusters the new reports joined with their existing members
+            table = ReportCluster.__table__
+            touched = list(clusters.parent)
+            existing = {}
+            for chunk in _chunks(touched, ID_CHUNK_SIZE):
+                cluster_ids = select(table.c.cluster_id).where(table.c.safetyreportid.in_(chunk))
+                for row in conn.execute(select(table).where(table.c.cluster_id.in_(cluster_ids))):
+                    existing[row.safetyreportid] = row
+            for row in existing.values():
+                clusters.union(row.safetyreportid, row.cluster_id, row.similarity)
+            replace_ids = set(clusters.parent)
+        stats['clustered_reports'] = _write_clusters(conn, clusters, replace_ids)
+    return stats
+
+
+def duplicate_report_ids():
+    """
+    Builds a SELECT of the reports superseded by a newer version of the same
+    case. Excluding these ids deduplicates any report query.
+    """
+    return select(ReportCluster.safetyreportid).where(ReportCluster.cluster_id != ReportCluster.safetyreportid)
+
+
+def canonical_only(column):
+    """
+    Returns a condition keeping only reports that are not superseded duplicates.
+    """
+    return column.notin_(duplicate_report_ids())
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+dedup_cli = AppGroup('dedup', help="Detect duplicate and follow-up versions of the same case.")
+
+
+@dedup_cli.command('run')
+@click.option('--full', is_flag=True, help="Recompute every fingerprint and cluster.")
+@click.option('--workers', type=int, default=None, help="Fingerprinting processes (defaults to DEDUP_WORKERS).")
+def run_command(full, workers):
+    """
+    Fingerprints reports not processed yet and updates the duplicate clusters.
+    """
+    db.create_all()
+    config = current_app.config
+    stats = run(db.engine, full,
+                workers or config.get('DEDUP_WORKERS') or os.cpu_count(),
+                config.get('DEDUP_SIMILARITY_THRESHOLD', 0.8),
+                config.get('DEDUP_MAX_DAYS', 730),
+                config.get('DEDUP_MAX_BUCKET_SIZE', 500))
+    for (name, value) in stats.items():
+        click.echo(f"{name}: {value}")
+    if stats['clustered_reports'] is not None:
+        view_cache.bump_data_version()
+
+
+@dedup_cli.command('status')
+def status_command():
+    """
+    Shows how many reports were fingerprinted and clustered.
+    """
+    clusters = ReportCluster.__table__
+    total = db.session.execute(select(func.count()).select_from(SafetyReport)).scalar()
+    fingerprinted = db.session.execute(select(func.count()).select_from(ReportFingerprint)).scalar()
+    clustered = db.session.execute(select(func.count()).select_from(clusters)).scalar()
+    cluster_count = db.session.execute(select(func.count(func.distinct(clusters.c.cluster_id)))).scalar()
+    click.echo(f"Reports: {total}, fingerprinted: {fingerprinted}")
+    click.echo(f"Duplicate clusters: {cluster_count}, covering {clustered} reports "
+               f"({clustered - cluster_count} superseded versions hidden when deduplicated)")
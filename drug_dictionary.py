@@ -0,0 +1,243 @@
+# drug_dictionary.py
+
+import click
+from sqlalchemy import select, func, bindparam, literal, union_all
+from sqlalchemy.dialects import mysql, sqlite
+
+from models import db, Drug, DrugProduct, DrugProductAlias
+import suggestions
+import snapshot
+
+# Names are looked up in chunks of this size for IN lists
+NAME_CHUNK_SIZE = 500
+
+# Drug rows linked to their product per backfill transaction
+BACKFILL_BATCH_SIZE = 10000
+
+# Set once every drugs row is linked; ingestion keeps it that way afterwards
+_ready = False
+
+
+def alias_key(spelling):
+    """
+    Returns the alias under which a raw medicinalproduct spelling is stored.
+    Lowercased but otherwise untouched, so alias substring matches equal a
+    case-insensitive match on the raw column.
+    """
+    return (spelling or '').lower()
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), NAME_CHUNK_SIZE):
+        yield values[i:i + NAME_CHUNK_SIZE]
+
+
+def resolve_product_ids(bind, entries):
+    """
+    Maps raw (medicinalproduct, activesubstancename) pairs to product ids,
+    registering unknown products and spellings in the caller's transaction.
+    Earlier entries provide the display name of a new product, so callers
+    should list the most frequent spelling first.
+    Returns {alias_key(spelling): product_id}.
+    """
+    spellings = {}
+    for (spelling, substance) in entries:
+        key = alias_key(spelling)
+        if key not in spellings:
+            spellings[key] = [spelling or '', substance]
+        elif spellings[key][1] is None:
+            spellings[key][1] = substance
+
+    resolved = {}
+    for chunk in _chunks(spellings):
+        rows = bind.execute(select(DrugProductAlias.alias, DrugProductAlias.drug_product_id)
+                            .where(DrugProductAlias.alias.in_(chunk)))
+        for (alias, product_id) in rows:
+            resolved.setdefault(alias, product_id)
+    missing = [key for key in spellings if key not in resolved]
+    if not missing:
+        return resolved
+
+    # New spellings of known products only need an alias
+    by_name = {}
+    for key in missing:
+        name = suggestions.normalize_name(spellings[key][0])
+        by_name.setdefault(name, []).append(key)
+    products = {}
+    for chunk in _chunks(by_name):
+        rows = bind.execute(select(DrugProduct.normalized_name, DrugProduct.id)
+                            .where(DrugProduct.normalized_name.in_(chunk)))
+        products.update(rows.all())
+
+    new_products = []
+    for (name, keys) in by_name.items():
+        if name in products:
+            continue
+        substance = next((spellings[k][1] for k in keys if spellings[k][1]), None)
+        new_products.append({'normalized_name': name,
+                             'display_name': spellings[keys[0]][0].strip(),
+                             'activesubstancename': substance})
+    if new_products:
+        # A concurrent writer may register the same product first; keep its row
+        _insert_ignoring_duplicates(bind, DrugProduct.__table__, new_products, 'normalized_name')
+        for chunk in _chunks([p['normalized_name'] for p in new_products]):
+            rows = bind.execute(select(DrugProduct.normalized_name, DrugProduct.id)
+                                .where(DrugProduct.normalized_name.in_(chunk)))
+            products.update(rows.all())
+
+    aliases = []
+    for (name, keys) in by_name.items():
+        for key in keys:
+            resolved[key] = products[name]
+            aliases.append({'alias': key, 'drug_product_id': products[name]})
+    _insert_ignoring_duplicates(bind, DrugProductAlias.__table__, aliases, 'alias')
+    return resolved
+
+
+def _insert_ignoring_duplicates(bind, table, rows, unique_column):
+    """
+    Inserts rows, skipping those whose `unique_column` value already exists.
+    """
+    stmt = table.insert()
+    dialect = bind.dialect.name if hasattr(bind, 'dialect') else bind.get_bind(clause=stmt).dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update({unique_column: stmt.inserted[unique_column]})
+        bind.execute(stmt, rows)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(table).on_conflict_do_nothing(index_elements=[unique_column])
+        bind.execute(stmt, rows)
+    else:
+        column = table.c[unique_column]
+        existing = set()
+        for chunk in _chunks(r[unique_column] for r in rows):
+            existing.update(bind.execute(select(column).where(column.in_(chunk))).scalars())
+        rows = [r for r in rows if r[unique_column] not in existing]
+        if rows:
+            bind.execute(stmt, rows)
+
+
+def dedupe_aliases(bind):
+    """
+    Deletes repeated spellings left by concurrent writers before aliases
+    were unique, keeping the first row of each, so the unique index on
+    the alias can be created.
+    """
+    table = DrugProductAlias.__table__
+    # Grouped in a derived table, which MySQL materializes before deleting
+    first = select(func.min(table.c.id).label('id')).group_by(table.c.alias).subquery()
+    with bind.begin() as conn:
+        removed = conn.execute(table.delete().where(table.c.id.notin_(select(first.c.id)))).rowcount
+    if removed:
+        click.echo(f"  removed {removed} duplicate aliases")
+
+
+def assign_product_ids(bind, drug_rows):
+    """
+    Sets 'drug_product_id' on a list of drugs row dictionaries before insert.
+    """
+    if not drug_rows:
+        return
+    ids = resolve_product_ids(bind, [(d['medicinalproduct'], d.get('activesubstancename')) for d in drug_rows])
+    for d in drug_rows:
+        d['drug_product_id'] = ids[alias_key(d['medicinalproduct'])]
+
+
+def _alias_columns(bind=None):
+    """
+    Returns the (alias, drug_product_id) columns to match spellings on.
+    A snapshot's trigram full-text table answers the substring LIKE from
+    its index instead of scanning every alias.
+    """
+    if snapshot.fts_available(bind):
+        return (snapshot.drug_alias_fts.c.alias, snapshot.drug_alias_fts.c.drug_product_id)
+    return (DrugProductAlias.alias, DrugProductAlias.drug_product_id)
+
+
+def matching_product_ids(drug_query, bind=None):
+    """
+    Returns the ids of products with a spelling containing the query.
+    """
+    bind = bind or db.session
+    (alias, product_id) = _alias_columns(bind)
+    stmt = (select(product_id)
+            .where(alias.like(f"%{alias_key(drug_query)}%"))
+            .distinct())
+    return list(bind.execute(stmt).scalars())
+
+
+def matching_product_ids_by_query(drug_queries, bind=None):
+    """
+    Resolves several name queries in one statement.
+    Returns a list holding the matching product ids of each query, in order.
+    """
+    bind = bind or db.session
+    matched = [set() for _ in drug_queries]
+    if not drug_queries:
+        return []
+    (alias, product_id) = _alias_columns(bind)
+    selects = [select(literal(i).label('query_index'), product_id)
+               .where(alias.like(f"%{alias_key(q)}%"))
+               for (i, q) in enumerate(drug_queries)]
+    for (i, product_id) in bind.execute(union_all(*selects)):
+        matched[i].add(product_id)
+    return [sorted(ids) for ids in matched]
+
+
+def dictionary_ready(bind=None):
+    """
+    True once every drugs row references a product, i.e. the backfill has run.
+    Until then name lookups fall back to matching the raw column.
+    """
+    global _ready
+    if not _ready:
+        bind = bind or db.session
+        unlinked = bind.execute(select(Drug.id).where(Drug.drug_product_id.is_(None)).limit(1)).first()
+        _ready = unlinked is None
+    return _ready
+
+
+#########################
+# BACKFILL
+#########################
+
+def backfill(engine, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Links existing drugs rows to the dictionary. Products and aliases are
+    registered first, most frequent spelling first, then drugs rows are
+    updated in id-range batches with one commit per batch, so the migration
+    can be interrupted and rerun.
+    """
+    with engine.connect() as conn:
+        spelling_rows = conn.execute(
+            select(Drug.medicinalproduct, Drug.activesubstancename, func.count(Drug.id).label('n'))
+            .where(Drug.drug_product_id.is_(None))
+            .group_by(Drug.medicinalproduct, Drug.activesubstancename)
+        ).all()
+        bounds = conn.execute(select(func.min(Drug.id), func.max(Drug.id))
+                              .where(Drug.drug_product_id.is_(None))).first()
+    if not spelling_rows:
+        return
+
+    spelling_rows.sort(key=lambda r: (-r.n, r.medicinalproduct))
+    with engine.begin() as conn:
+        ids = resolve_product_ids(conn, [(r.medicinalproduct, r.activesubstancename) for r in spelling_rows])
+    click.echo(f"  {len(ids)} spellings mapped to products")
+
+    table = Drug.__table__
+    stmt = (table.update()
+            .where(table.c.id == bindparam('b_id'))
+            .values(drug_product_id=bindparam('b_product_id')))
+    (low, high) = bounds
+    linked = 0
+    for start in range(low, high + 1, batch_size):
+        with engine.begin() as conn:
+            rows = conn.execute(select(Drug.id, Drug.medicinalproduct)
+                                .where(Drug.id.between(start, start + batch_size - 1))
+                                .where(Drug.drug_product_id.is_(None))).all()
+            if rows:
+                conn.execute(stmt, [{'b_id': r.id, 'b_product_id': ids[alias_key(r.medicinalproduct)]}
+                                    for r in rows])
+        linked += len(rows)
+        click.echo(f"  linked {linked} drugs rows")
@@ -0,0 +1,344 @@
+# export.py
+
+import csv
+import datetime
+import io
+import os
+import uuid
+import zlib
+
+import click
+from flask import current_app
+from sqlalchemy import select, func
+from werkzeug.datastructures import MultiDict
+
+from models import db, SafetyReport
+from report_data import CHILDREN, REPORT_COLUMNS, attach_children, dumps
+from search_engine import SearchFilters, ORDER_COLUMNS, CRITERIA_BY_KEY
+from stats_engine import matching_report_ids
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = None
+    pq = None
+
+# Reports fetched per server-side cursor batch; child rows are loaded per batch
+DEFAULT_BATCH_SIZE = 1000
+
+# Reports buffered into one Parquet row group
+PARQUET_ROW_GROUP_SIZE = 50000
+
+# Format -> (content type, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# Child values joined into single CSV cells, in CSV column order
+CSV_CHILD_COLUMNS = [
+    ('patient_agegroups', 'patients', 'patientagegroup'),
+    ('patient_sexes', 'patients', 'patientsex'),
+    ('drugs', 'drugs', 'medicinalproduct'),
+    ('drug_characterizations', 'drugs', 'drugcharacterization'),
+    ('active_substances', 'drugs', 'activesubstancename'),
+    ('reactions', 'reactions', 'reactionmeddrapt'),
+    ('reaction_outcomes', 'reactions', 'reactionoutcome'),
+]
+
+# Separator between the values of one report's children in a CSV cell
+CSV_LIST_SEPARATOR = '|'
+
+
+def parquet_available():
+    return pq is not None
+
+
+def export_conditions(filters, filter_drug=''):
+    """
+    Combines the search filters and the listing's drug-name filter into
+    WHERE conditions on SafetyReport.
+    """
+    conds = filters.conditions()
+    if filter_drug:
+        conds.append(SafetyReport.safetyreportid.in_(matching_report_ids(filter_drug)))
+    return conds
+
+
+def iter_report_batches(conditions, batch_size=DEFAULT_BATCH_SIZE, engine=None):
+    """
+    Yields lists of nested report dictionaries, newest first.
+    Reports are read through a server-side cursor in batches of
+    `batch_size`, and the patients, drugs and reactions of each batch are
+    loaded with one query per table on a second connection, so memory use
+    does not depend on the size of the export.
+    """
+    engine = engine or db.engine
+    stmt = (select(SafetyReport.__table__)
+            .where(*conditions)
+            .order_by(*[c.desc() for c in ORDER_COLUMNS]))
+    with engine.connect() as stream_conn, engine.connect() as conn:
+        result = stream_conn.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+        for rows in result.partitions():
+            reports = {row.safetyreportid: dict(row._mapping) for row in rows}
+            attach_children(conn, reports)
+            yield list(reports.values())
+
+
+#########################
+# FORMAT WRITERS
+#########################
+
+def csv_chunks(batches):
+    """
+    Yields CSV text, one report per row with child values joined in cells.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(REPORT_COLUMNS + [name for (name, _, _) in CSV_CHILD_COLUMNS])
+    for batch in batches:
+        for report in batch:
+            row = [report[c] for c in REPORT_COLUMNS]
+            for (_, key, column) in CSV_CHILD_COLUMNS:
+                row.append(CSV_LIST_SEPARATOR.join('' if child[column] is None else str(child[column])
+                                                   for child in report[key]))
+            writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def ndjson_chunks(batches):
+    """
+    Yields newline-delimited JSON, one nested report object per line.
+    """
+    for batch in batches:
+        yield ''.join(dumps(report) + '\n' for report in batch)
+
+
+def _arrow_type(column):
+    """
+    Maps a model column to the Arrow type used in the Parquet schema.
+    """
+    python_type = column.type.python_type
+    if python_type is datetime.date:
+        return pa.date32()
+    if python_type is int:
+        return pa.int64() if isinstance(column.type, db.BigInteger) else pa.int32()
+    return pa.string()
+
+
+def parquet_schema():
+    """
+    Builds the nested Parquet schema: report columns plus list-of-struct
+    columns for patients, drugs and reactions.
+    """
+    fields = [pa.field(c.name, _arrow_type(c)) for c in SafetyReport.__table__.columns]
+    for (key, model, names) in CHILDREN:
+        struct = pa.struct([pa.field(n, _arrow_type(model.__table__.c[n])) for n in names])
+        fields.append(pa.field(key, pa.list_(struct)))
+    return pa.schema(fields)
+
+
+class _ChunkSink:
+    """
+    Write-only file object collecting the bytes produced by the Parquet
+    writer, so they can be streamed out and dropped after each row group.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_chunks(batches, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """
+    Yields a Parquet file in pieces, writing one row group per
+    `row_group_size` reports.
+    """
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    pending = []
+    for batch in batches:
+        pending.extend(batch)
+        if len(pending) >= row_group_size:
+            writer.write_table(pa.Table.from_pylist(pending, schema=schema))
+            pending = []
+            yield sink.drain()
+    if pending:
+        writer.write_table(pa.Table.from_pylist(pending, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+
+def gzip_chunks(chunks):
+    """
+    Compresses a stream of chunks into a single gzip member.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(fmt, batches, compress=False):
+    """
+    Yields the encoded bytes of an export in the given format.
+    """
+    if fmt == 'parquet':
+        return parquet_chunks(batches)
+    chunks = csv_chunks(batches) if fmt == 'csv' else ndjson_chunks(batches)
+    chunks = (chunk.encode('utf-8') for chunk in chunks)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(fmt, compress=False):
+    """
+    Returns a download file name for an export.
+    """
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    name = f"safety-reports-{stamp}.{FORMATS[fmt][1]}"
+    return name + '.gz' if compress else name
+
+
+#########################
+# BACKGROUND EXPORTS
+#########################
+
+def export_params(fmt, compress, filters, filter_drug):
+    """
+    Serializable parameters of an export, for the background job queue.
+    """
+    return {'format': fmt, 'gzip': compress, 'filters': filters.to_args(), 'filter_drug': filter_drug}
+
+
+def run_export(params, progress):
+    """
+    Job handler writing an export to EXPORT_DIR.
+    Returns the file name and the number of exported reports.
+    """
+    filters = SearchFilters.from_args(MultiDict(params['filters']))
+    conditions = export_conditions(filters, params['filter_drug'])
+    total = db.session.execute(select(func.count()).select_from(SafetyReport).where(*conditions)).scalar()
+    db.session.remove()
+
+    export_dir = current_app.config['EXPORT_DIR']
+    os.makedirs(export_dir, exist_ok=True)
+    name = f"{uuid.uuid4().hex}-{export_filename(params['format'], params['gzip'])}"
+    path = os.path.join(export_dir, name)
+    done = 0
+
+    def counted(batches):
+        nonlocal done
+        for batch in batches:
+            yield batch
+            done += len(batch)
+            progress(min(0.99, done / max(total, 1)), f"{done} of {total} reports")
+
+    batch_size = current_app.config.get('EXPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    try:
+        with open(path + '.part', 'wb') as f:
+            for chunk in export_chunks(params['format'], counted(iter_report_batches(conditions, batch_size)),
+                                       params['gzip']):
+                f.write(chunk)
+    except BaseException:
+        os.remove(path + '.part')
+        raise
+    os.replace(path + '.part', path)
+    return {'file': name, 'reports': done}
+
+
+def remove_export_file(result):
+    """
+    Deletes the file written by an export job, if it still exists.
+    """
+    if result and result.get('file'):
+        path = os.path.join(current_app.config['EXPORT_DIR'], result['file'])
+        if os.path.exists(path):
+            os.remove(path)
+
+
+#########################
+# CLI COMMAND
+#########################
+
+@click.command('export')
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)), default='csv', show_default=True)
+@click.option('--output', '-o', required=True, help="Output file, or '-' for standard output.")
+@click.option('--gzip', 'compress', is_flag=True, help="Gzip-compress CSV or NDJSON output.")
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help="Reports per cursor batch.")
+@click.option('--drug', default='', help="Drug name starts with.")
+@click.option('--filter-drug', default='', help="Drug name contains (as on the report listing).")
+@click.option('--reaction', default='', help="Reaction term starts with.")
+@click.option('--country', default='', help="Two-letter reporter country.")
+@click.option('--date-from', default='', help="Received on or after (YYYY-MM-DD).")
+@click.option('--date-to', default='', help="Received on or before (YYYY-MM-DD).")
+@click.option('--serious', default='', help="1 for serious, 2 for non-serious.")
+@click.option('--criteria', multiple=True, type=click.Choice(sorted(CRITERIA_BY_KEY)),
+              help="Seriousness criterion that must apply (repeatable).")
+@click.option('--age-group', default='', help="Patient age group code.")
+@click.option('--sex', default='', help="Patient sex code.")
+def export_command(fmt, output, compress, batch_size, filter_drug, criteria, **filter_args):
+    """
+    Exports safety reports with their patients, drugs and reactions.
+    Accepts the same filters as the search page.
+    """
+    if fmt == 'parquet' and not parquet_available():
+        raise click.ClickException("Parquet export requires the pyarrow package.")
+    args = MultiDict([(k, v) for (k, v) in filter_args.items() if v])
+    for key in criteria:
+        args.add('criteria', key)
+    conditions = export_conditions(SearchFilters.from_args(args), filter_drug.strip())
+
+    done = 0
+
+    def counted(batches):
+        nonlocal done
+        for (i, batch) in enumerate(batches, 1):
+            yield batch
+            done += len(batch)
+            if output != '-' and i % 100 == 0:
+                click.echo(f"{done} reports exported")
+
+    chunks = export_chunks(fmt, counted(iter_report_batches(conditions, batch_size)), compress and fmt != 'parquet')
+    stream = click.get_binary_stream('stdout') if output == '-' else open(output, 'wb')
+    try:
+        for chunk in chunks:
+            stream.write(chunk)
+    finally:
+        if output != '-':
+            stream.close()
+    if output != '-':
+        click.echo(f"Exported {done} reports to {output}")
@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+#
+# Production server settings: gunicorn -c gunicorn.conf.py
+# The application is built and warmed once in the master process (see
+# warmup.py), and workers fork from it with the loaded lookup structures
+# and rendered responses already in shared copy-on-write memory.
+
+import gc
+import multiprocessing
+import os
+
+wsgi_app = 'app:create_app(warm=True)'
+preload_app = True
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+
+def pre_fork(server, worker):
+    # Also freeze whatever the master allocated after the warm-up
+    gc.freeze()
@@ -0,0 +1,577 @@
+# ingest.py
+
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import queue
+import time
+import zipfile
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, update
+from sqlalchemy.dialects import mysql, sqlite
+
+from models import db, SafetyReport, Patient, Drug, Reaction, Company, IngestCheckpoint
+import rollups
+import drug_dictionary
+import dedup
+import approximate
+from caching import view_cache
+
+# Number of reports written per transaction
+DEFAULT_BATCH_SIZE = 2000
+
+# Characters read from a source file per chunk
+READ_CHUNK_SIZE = 1 << 20
+
+# Batches buffered between the parser processes and the writer
+QUEUE_DEPTH_PER_WORKER = 2
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5.0
+
+
+#########################
+# STREAMING JSON READER
+#########################
+
+class _StreamBuffer:
+    """
+    Sliding text window over a file object, refilled on demand.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Appends the next chunk to the window, dropping consumed text.
+        Returns False at end of file.
+        """
+        if self.eof:
+            return False
+        chunk = self.stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_ws(self):
+        """
+        Advances past whitespace, refilling as needed.
+        Returns the next character or '' at end of file.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        """
+        Consumes `char` after optional whitespace, or raises ValueError.
+        """
+        if self.skip_ws() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}")
+        self.pos += 1
+
+    def decode_value(self, decoder):
+        """
+        Decodes one complete JSON value, reading more text until it parses.
+        """
+        self.skip_ws()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the window may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_results(stream):
+    """
+    Yields the records of an openFDA download one at a time.
+    Only the current record is held in memory; other top-level keys such as
+    "meta" are parsed and discarded.
+    """
+    decoder = json.JSONDecoder()
+    reader = _StreamBuffer(stream)
+    reader.expect('{')
+    while True:
+        ch = reader.skip_ws()
+        if ch == '}' or ch == '':
+            return
+        if ch == ',':
+            reader.pos += 1
+            continue
+        key = reader.decode_value(decoder)
+        reader.expect(':')
+        if key != 'results':
+            reader.decode_value(decoder)
+            continue
+
+        reader.expect('[')
+        while True:
+            ch = reader.skip_ws()
+            if ch == ']':
+                reader.pos += 1
+                break
+            if ch == ',':
+                reader.pos += 1
+                continue
+            if ch == '':
+                raise ValueError("Unexpected end of file inside results")
+            yield reader.decode_value(decoder)
+
+
+def iter_file_records(path):
+    """
+    Yields records from a .json file or from every .json member of a .zip file.
+    """
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for name in sorted(zf.namelist()):
+                if name.lower().endswith('.json'):
+                    with zf.open(name) as raw:
+                        yield from iter_results(io.TextIOWrapper(raw, encoding='utf-8'))
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from iter_results(f)
+
+
+#########################
+# RECORD MAPPING
+#########################
+
+def _to_int(value):
+    """
+    Converts openFDA numeric strings to int, returning None when not numeric.
+    """
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+
+def _to_date(value):
+    """
+    Converts an openFDA YYYYMMDD string to a date, returning None when invalid.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(str(value)[:8], '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def _fit(model, column, value):
+    """
+    Truncates string values to the column length declared on the model.
+    """
+    if value is None:
+        return None
+    value = str(value)
+    length = getattr(model.__table__.c[column].type, 'length', None)
+    if length and len(value) > length:
+        value = value[:length]
+    return value
+
+
+def map_record(rec):
+    """
+    Maps one openFDA drug-event record to plain row dictionaries.
+    Returns (report, company, patients, drugs, reactions), or None when
+    required fields are missing.
+    """
+    report_id = _fit(SafetyReport, 'safetyreportid', rec.get('safetyreportid'))
+    serious = _to_int(rec.get('serious'))
+    receivedate = _to_date(rec.get('receivedate'))
+    if not report_id or serious is None or receivedate is None:
+        return None
+
+    companynumb = _fit(SafetyReport, 'companynumb', rec.get('companynumb'))
+    company = None
+    if companynumb:
+        sender = rec.get('sender') or {}
+        company = {
+            'companynumb': companynumb,
+            'companyname': _fit(Company, 'companyname', sender.get('senderorganization') or companynumb),
+        }
+
+    primarysource = rec.get('primarysource') or {}
+    report = {
+        'safetyreportid': report_id,
+        'serious': serious,
+        'seriousnessdeath': _to_int(rec.get('seriousnessdeath')),
+        'seriousnesslifethreatening': _to_int(rec.get('seriousnesslifethreatening')),
+        'seriousnesshospitalization': _to_int(rec.get('seriousnesshospitalization')),
+        'seriousnessdisabling': _to_int(rec.get('seriousnessdisabling')),
+        'seriousnesscongenitalanomali': _to_int(rec.get('seriousnesscongenitalanomali')),
+        'seriousnessother': _to_int(rec.get('seriousnessother')),
+        'receivedate': receivedate,
+        'receiptdate': _to_date(rec.get('receiptdate')) or receivedate,
+        'primarysource_reportercountry': _fit(SafetyReport, 'primarysource_reportercountry',
+                                              primarysource.get('reportercountry')),
+        'companynumb': companynumb,
+    }
+
+    patient = rec.get('patient') or {}
+    patients = [{
+        'safetyreportid': report_id,
+        'patientagegroup': _to_int(patient.get('patientagegroup')),
+        'patientsex': _to_int(patient.get('patientsex')),
+    }]
+
+    drugs = []
+    for d in patient.get('drug') or []:
+        product = d.get('medicinalproduct')
+        if not product:
+            continue
+        substance = (d.get('activesubstance') or {}).get('activesubstancename')
+        drugs.append({
+            'safetyreportid': report_id,
+            'drugcharacterization': _to_int(d.get('drugcharacterization')) or 0,
+            'medicinalproduct': _fit(Drug, 'medicinalproduct', product),
+            'drugstructuredosagenumb': _to_int(d.get('drugstructuredosagenumb')),
+            'drugstructuredosageunit': _fit(Drug, 'drugstructuredosageunit', d.get('drugstructuredosageunit')),
+            'drugdosagetext': _fit(Drug, 'drugdosagetext', d.get('drugdosagetext')),
+            'drugdosageform': _fit(Drug, 'drugdosageform', d.get('drugdosageform')),
+            'drugadministrationroute': _fit(Drug, 'drugadministrationroute', d.get('drugadministrationroute')),
+            'drugindication': _fit(Drug, 'drugindication', d.get('drugindication')),
+            'actiondrug': _to_int(d.get('actiondrug')),
+            'drugrecurreadministration': _to_int(d.get('drugrecurreadministration')),
+            'drugadditional': _to_int(d.get('drugadditional')),
+            'activesubstancename': _fit(Drug, 'activesubstancename', substance),
+        })
+
+    reactions = []
+    for r in patient.get('reaction') or []:
+        term = r.get('reactionmeddrapt')
+        if not term:
+            continue
+        reactions.append({
+            'safetyreportid': report_id,
+            'reactionmeddrapt': _fit(Reaction, 'reactionmeddrapt', term),
+            'reactionoutcome': _to_int(r.get('reactionoutcome')),
+        })
+
+    return report, company, patients, drugs, reactions
+
+
+def parse_batches(path, skip, batch_size):
+    """
+    Streams a source file and yields (records_seen, rejected, mapped) batches.
+    The first `skip` records (already loaded by an earlier run) are passed over.
+    """
+    batch = []
+    rejected = 0
+    seen = 0
+    for rec in iter_file_records(path):
+        seen += 1
+        if seen <= skip:
+            continue
+        mapped = map_record(rec)
+        if mapped is None:
+            rejected += 1
+        else:
+            batch.append(mapped)
+        if len(batch) + rejected >= batch_size:
+            yield seen, rejected, batch
+            batch = []
+            rejected = 0
+    if batch or rejected:
+        yield seen, rejected, batch
+
+
+def _parser_process(tasks, results, batch_size):
+    """
+    Worker loop: parses whole files and pushes mapped batches to the writer.
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        path, skip = task
+        try:
+            for (seen, rejected, batch) in parse_batches(path, skip, batch_size):
+                results.put(('batch', path, seen, rejected, batch))
+            results.put(('done', path, None, 0, None))
+        except Exception as e:
+            results.put(('error', path, None, 0, repr(e)))
+
+
+#########################
+# BATCH WRITER
+#########################
+
+def _upsert_companies(conn, rows):
+    """
+    Inserts companies, updating the name of ones that already exist.
+    """
+    if not rows:
+        return
+    table = Company.__table__
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update(companyname=stmt.inserted.companyname)
+        conn.execute(stmt, rows)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=['companynumb'],
+                                          set_={'companyname': stmt.excluded.companyname})
+        conn.execute(stmt, rows)
+    else:
+        keys = [r['companynumb'] for r in rows]
+        existing = set(conn.execute(select(table.c.companynumb).where(table.c.companynumb.in_(keys))).scalars())
+        new_rows = [r for r in rows if r['companynumb'] not in existing]
+        if new_rows:
+            conn.execute(table.insert(), new_rows)
+
+
+def write_batch(conn, batch, maintain_rollups=True):
+    """
+    Writes one batch of mapped records inside the caller's transaction.
+    Reports that already exist are replaced together with their child rows,
+    and the per-drug rollups are adjusted by the resulting difference, as
+    are the report sample and drug sketches of approximate mode.
+    Returns the number of rows written across all tables.
+    """
+    # Later versions of the same report in a batch replace earlier ones
+    by_id = {}
+    for mapped in batch:
+        by_id[mapped[0]['safetyreportid']] = mapped
+    ids = list(by_id)
+    if not ids:
+        return 0
+
+    existing = list(conn.execute(
+        select(SafetyReport.safetyreportid).where(SafetyReport.safetyreportid.in_(ids))
+    ).scalars())
+    if maintain_rollups:
+        before = rollups.collect_contributions(existing, bind=conn)
+    strata_before = approximate.collect_strata(existing, bind=conn)
+
+    companies = {}
+    reports, patients, drugs, reactions = [], [], [], []
+    for (report, company, pts, drs, rxs) in by_id.values():
+        reports.append(report)
+        if company:
+            companies[company['companynumb']] = company
+        patients.extend(pts)
+        drugs.extend(drs)
+        reactions.extend(rxs)
+
+    _upsert_companies(conn, list(companies.values()))
+
+    if existing:
+        # Replaced reports are fingerprinted again by the next dedup run
+        dedup.forget_reports(conn, existing)
+        for model in (Reaction, Drug, Patient):
+            conn.execute(model.__table__.delete().where(model.__table__.c.safetyreportid.in_(existing)))
+        conn.execute(SafetyReport.__table__.delete().where(SafetyReport.__table__.c.safetyreportid.in_(existing)))
+
+    # Executemany inserts; drivers such as PyMySQL turn these into multi-row INSERTs
+    conn.execute(SafetyReport.__table__.insert(), reports)
+    if patients:
+        conn.execute(Patient.__table__.insert(), patients)
+    if drugs:
+        drug_dictionary.assign_product_ids(conn, drugs)
+        conn.execute(Drug.__table__.insert(), drugs)
+    if reactions:
+        conn.execute(Reaction.__table__.insert(), reactions)
+
+    if maintain_rollups:
+        rollups.refresh_reports(ids, before, bind=conn)
+    approximate.refresh_reports(ids, strata_before, bind=conn)
+
+    return len(reports) + len(companies) + len(patients) + len(drugs) + len(reactions)
+
+
+def _save_checkpoint(conn, path, size, records_done, completed):
+    """
+    Records progress for a source file in the current transaction.
+    """
+    table = IngestCheckpoint.__table__
+    values = {'file_size': size, 'records_done': records_done, 'completed': completed,
+              'updated_at': datetime.datetime.utcnow()}
+    result = conn.execute(update(table).where(table.c.file_path == path).values(**values))
+    if result.rowcount == 0:
+        conn.execute(table.insert().values(file_path=path, **values))
+
+
+def _load_checkpoints(paths):
+    """
+    Returns {path: (records_done, completed)} for files whose size is unchanged
+    since their checkpoint was written.
+    """
+    out = {}
+    rows = db.session.execute(select(IngestCheckpoint).where(IngestCheckpoint.file_path.in_(paths))).scalars()
+    for cp in rows:
+        if cp.file_size == os.path.getsize(cp.file_path):
+            out[cp.file_path] = (cp.records_done, cp.completed)
+    db.session.close()
+    return out
+
+
+def collect_source_files(paths):
+    """
+    Expands files and directories into a sorted list of .json/.zip files.
+    """
+    found = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, names in os.walk(p):
+                for name in names:
+                    if name.lower().endswith(('.json', '.zip')):
+                        found.append(os.path.abspath(os.path.join(root, name)))
+        else:
+            found.append(os.path.abspath(p))
+    return sorted(set(found))
+
+
+class _Progress:
+    """
+    Accumulates counters and prints a rows/sec line at a fixed interval.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.records = 0
+        self.rejected = 0
+        self.rows = 0
+
+    def add(self, records, rejected, rows, force=False):
+        self.records += records
+        self.rejected += rejected
+        self.rows += rows
+        now = time.monotonic()
+        if force or now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            elapsed = max(now - self.started, 1e-6)
+            click.echo(f"{self.records} reports ({self.rejected} rejected), {self.rows} rows, "
+                       f"{self.records / elapsed:.0f} reports/s, {self.rows / elapsed:.0f} rows/s")
+
+
+def ingest_files(paths, workers=1, batch_size=DEFAULT_BATCH_SIZE, restart=False, maintain_rollups=True):
+    """
+    Loads openFDA drug-event files into the database.
+    Parsing runs in `workers` processes (one file each at a time) while the
+    calling process writes batches and checkpoints; each batch commits with
+    its checkpoint, so a rerun resumes where the last one stopped.
+    Returns the progress counters.
+    """
+    engine = db.engine
+    checkpoints = {} if restart else _load_checkpoints(paths)
+    pending = []
+    for path in paths:
+        done, completed = checkpoints.get(path, (0, False))
+        if completed:
+            click.echo(f"Skipping {path} (already loaded)")
+            continue
+        pending.append((path, done))
+
+    progress = _Progress()
+    sizes = {path: os.path.getsize(path) for (path, _) in pending}
+    offsets = dict(pending)
+
+    def handle(kind, path, seen, rejected, payload):
+        if kind == 'error':
+            raise click.ClickException(f"Failed to parse {path}: {payload}")
+        with engine.begin() as conn:
+            rows = 0
+            if kind == 'batch':
+                rows = write_batch(conn, payload, maintain_rollups)
+                offsets[path] = seen
+            _save_checkpoint(conn, path, sizes[path], offsets[path], kind == 'done')
+        if kind == 'batch':
+            progress.add(len(payload) + rejected, rejected, rows)
+        else:
+            # Make the finished file visible to cached pages and the autocomplete index
+            view_cache.bump_data_version()
+            click.echo(f"Finished {path}")
+
+    if workers <= 1:
+        for (path, skip) in pending:
+            for (seen, rejected, batch) in parse_batches(path, skip, batch_size):
+                handle('batch', path, seen, rejected, batch)
+            handle('done', path, None, 0, None)
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        tasks = ctx.Queue()
+        results = ctx.Queue(maxsize=workers * QUEUE_DEPTH_PER_WORKER)
+        for task in pending:
+            tasks.put(task)
+        procs = [ctx.Process(target=_parser_process, args=(tasks, results, batch_size), daemon=True)
+                 for _ in range(min(workers, len(pending)))]
+        for p in procs:
+            tasks.put(None)
+            p.start()
+        remaining = len(pending)
+        try:
+            while remaining:
+                try:
+                    message = results.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(p.is_alive() for p in procs):
+                        raise click.ClickException("Parser processes exited unexpectedly")
+                    continue
+                handle(*message)
+                if message[0] == 'done':
+                    remaining -= 1
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+
+    progress.add(0, 0, 0, force=True)
+    return progress
+
+
+@click.command('ingest')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--workers', default=max(1, (os.cpu_count() or 2) - 1), show_default=True,
+              help="Number of parser processes.")
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help="Reports written per transaction.")
+@click.option('--restart', is_flag=True, help="Ignore checkpoints and reload every file.")
+@click.option('--rebuild-rollups', is_flag=True,
+              help="Skip per-batch rollup maintenance and rebuild the rollups once at the end.")
+@with_appcontext
+def ingest_command(paths, workers, batch_size, restart, rebuild_rollups):
+    """
+    Loads openFDA drug-event .json/.zip files (or directories of them).
+    """
+    db.create_all()
+    files = collect_source_files(paths)
+    if not files:
+        raise click.ClickException("No .json or .zip files found.")
+    ingest_files(files, workers=workers, batch_size=batch_size, restart=restart,
+                 maintain_rollups=not rebuild_rollups)
+    if rebuild_rollups:
+        click.echo("Rebuilding rollups...")
+        rollups.rebuild_all()
+        db.session.commit()
+        view_cache.bump_data_version()
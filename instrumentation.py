@@ -0,0 +1,375 @@
+# instrumentation.py
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Logger receiving slow statements together with their query plans
+slow_query_logger = logging.getLogger('medae.slow_queries')
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Collapses literals so statements differing only in inlined values group together
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def normalize_statement(statement):
+    """
+    Reduces a SQL statement to its shape for repeated-statement detection.
+    """
+    return ' '.join(_LITERAL_RE.sub('?', statement).split())
+
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram with an 'endpoint' label.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self._lock:
+            series = self._series.get(endpoint)
+            if series is None:
+                series = self._series[endpoint] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for (endpoint, (counts, total, value_sum)) in sorted(self._series.items()):
+                for (bound, count) in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {total}')
+                lines.append(f'{self.name}_sum{{endpoint="{endpoint}"}} {value_sum}')
+                lines.append(f'{self.name}_count{{endpoint="{endpoint}"}} {total}')
+        return lines
+
+
+class LabeledCounter:
+    """
+    Prometheus-style counter with an 'endpoint' label.
+    """
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, endpoint, amount=1):
+        with self._lock:
+            self._values[endpoint] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for (endpoint, value) in sorted(self._values.items()):
+                lines.append(f'{self.name}{{endpoint="{endpoint}"}} {value}')
+        return lines
+
+
+def _count_rows(n):
+    metrics = instrumentation.current_metrics()
+    if metrics is not None:
+        metrics.rows += n
+
+
+class _RowCountingCursor:
+    """
+    Mixin for DBAPI cursor classes that adds the rows each fetch returns to
+    the current request's row count. Drivers leave cursor.rowcount at -1 or
+    0 for SELECTs, so rows are counted as they are fetched.
+    """
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows))
+        return rows
+
+
+class _CountingSQLiteCursor(_RowCountingCursor, sqlite3.Cursor):
+    pass
+
+
+class _CountingSQLiteConnection(sqlite3.Connection):
+    """
+    sqlite3 connection whose cursors count the rows they return.
+    """
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or _CountingSQLiteCursor)
+
+
+# pymysql cursor class -> its row-counting subclass
+_counting_cursor_classes = {}
+
+
+def _counting_cursor_class(base):
+    cls = _counting_cursor_classes.get(base)
+    if cls is None:
+        cls = _counting_cursor_classes[base] = type(f"Counting{base.__name__}", (_RowCountingCursor, base), {})
+    return cls
+
+
+class RequestMetrics:
+    """
+    Database and rendering measurements for one request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.slowest = (0.0, None)
+        self.render_time = 0.0
+        self.render_started = None
+        self.statements = Counter()
+        self.slow = []
+
+
+class Instrumentation:
+    """
+    Collects per-request SQL and template timings from SQLAlchemy engine
+    events and Flask signals. Adds a Server-Timing header to every response,
+    feeds Prometheus histograms labelled by endpoint, warns about statements
+    repeated within a request (N+1 patterns), and optionally logs slow
+    statements with their EXPLAIN output.
+    Metrics are kept per process.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = None
+        self.explain = True
+        self.n_plus_one_threshold = 10
+        self.request_seconds = Histogram('medae_request_duration_seconds',
+                                         "Time spent handling a request.", SECONDS_BUCKETS)
+        self.db_seconds = Histogram('medae_db_time_seconds',
+                                    "Time spent in SQL statements per request.", SECONDS_BUCKETS)
+        self.db_queries = Histogram('medae_db_queries',
+                                    "SQL statements executed per request.", COUNT_BUCKETS)
+        self.db_rows = Histogram('medae_db_rows',
+                                 "Rows returned per request.", ROW_BUCKETS)
+        self.render_seconds = Histogram('medae_template_render_seconds',
+                                        "Time spent rendering templates per request.", SECONDS_BUCKETS)
+        self.n_plus_one = LabeledCounter('medae_n_plus_one_requests_total',
+                                         "Requests that repeated one statement past the N+1 threshold.")
+        self.slow_queries = LabeledCounter('medae_slow_queries_total',
+                                           "Statements slower than the slow-query threshold.")
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """
+        Registers the request hooks, template signals and engine listeners.
+        """
+        self.enabled = app.config.get('INSTRUMENTATION_ENABLED', True)
+        if not self.enabled:
+            return
+        threshold_ms = app.config.get('SLOW_QUERY_THRESHOLD_MS')
+        self.slow_threshold = threshold_ms / 1000.0 if threshold_ms else None
+        self.explain = app.config.get('SLOW_QUERY_EXPLAIN', True)
+        self.n_plus_one_threshold = app.config.get('N_PLUS_ONE_THRESHOLD', 10)
+
+        log_path = app.config.get('SLOW_QUERY_LOG')
+        if self.slow_threshold is not None and log_path and not self._has_log_handler(log_path):
+            handler = logging.FileHandler(log_path, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            slow_query_logger.addHandler(handler)
+            slow_query_logger.setLevel(logging.INFO)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'do_connect', self._do_connect)
+
+    @staticmethod
+    def _has_log_handler(log_path):
+        # Building several applications in one process must not log each line twice
+        path = os.path.abspath(log_path)
+        return any(isinstance(h, logging.FileHandler) and h.baseFilename == path
+                   for h in slow_query_logger.handlers)
+
+    #########################
+    # HOOKS
+    #########################
+
+    def _current(self):
+        if not has_request_context():
+            return getattr(self._local, 'metrics', None)
+        return g.get('_request_metrics')
+
+    def current_metrics(self):
+        """
+        Returns the measurements of the request being handled, if any.
+        """
+        return self._current()
+
+    @contextmanager
+    def attach(self, metrics):
+        """
+        Attributes statements run by the current (worker) thread to a
+        request's measurements, as returned by current_metrics().
+        """
+        self._local.metrics = metrics
+        try:
+            yield
+        finally:
+            self._local.metrics = None
+
+    @staticmethod
+    def _do_connect(dialect, conn_rec, cargs, cparams):
+        # New connections hand out cursors that count the rows they return
+        if dialect.driver == 'pysqlite':
+            cparams.setdefault('factory', _CountingSQLiteConnection)
+        elif dialect.driver == 'pymysql':
+            base = cparams.get('cursorclass', dialect.dbapi.cursors.Cursor)
+            cparams['cursorclass'] = _counting_cursor_class(base)
+
+    def _before_request(self):
+        g._request_metrics = RequestMetrics()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._current() is not None:
+            conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        metrics = self._current()
+        started = conn.info.get('_query_started')
+        if metrics is None or not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        metrics.query_count += 1
+        metrics.db_time += elapsed
+        metrics.statements[normalize_statement(statement)] += 1
+        if elapsed > metrics.slowest[0]:
+            metrics.slowest = (elapsed, statement)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            metrics.slow.append((elapsed, statement, parameters, conn.engine))
+
+    def _before_render(self, sender, template, context, **extra):
+        metrics = self._current()
+        if metrics is not None:
+            metrics.render_started = time.perf_counter()
+
+    def _after_render(self, sender, template, context, **extra):
+        metrics = self._current()
+        if metrics is not None and metrics.render_started is not None:
+            metrics.render_time += time.perf_counter() - metrics.render_started
+            metrics.render_started = None
+
+    def _after_request(self, response):
+        metrics = g.pop('_request_metrics', None)
+        if metrics is None:
+            return response
+        total = time.perf_counter() - metrics.started
+        endpoint = request.endpoint or 'unmatched'
+
+        self.request_seconds.observe(endpoint, total)
+        self.db_seconds.observe(endpoint, metrics.db_time)
+        self.db_queries.observe(endpoint, metrics.query_count)
+        self.db_rows.observe(endpoint, metrics.rows)
+        self.render_seconds.observe(endpoint, metrics.render_time)
+
+        repeated = [(s, n) for (s, n) in metrics.statements.items() if n >= self.n_plus_one_threshold]
+        if repeated:
+            self.n_plus_one.inc(endpoint)
+            statement, n = max(repeated, key=lambda x: x[1])
+            slow_query_logger.warning("Possible N+1 in %s: statement ran %d times: %s", endpoint, n, statement)
+
+        if metrics.slow:
+            self.slow_queries.inc(endpoint, len(metrics.slow))
+            self._log_slow(endpoint, metrics.slow)
+
+        parts = [
+            f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.query_count} queries, {metrics.rows} rows"',
+            f'render;dur={metrics.render_time * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}',
+        ]
+        if metrics.slowest[1] is not None:
+            parts.insert(1, f'db-slowest;dur={metrics.slowest[0] * 1000:.2f}')
+        if repeated:
+            parts.append(f'n-plus-one;desc="{len(repeated)} repeated statements"')
+        response.headers.add('Server-Timing', ', '.join(parts))
+        return response
+
+    def _log_slow(self, endpoint, slow):
+        """
+        Logs slow statements, with the query plan of SELECTs when enabled.
+        """
+        for (elapsed, statement, parameters, engine) in slow:
+            plan = None
+            if self.explain and statement.lstrip().upper().startswith('SELECT'):
+                plan = explain_statement(engine, statement, parameters)
+            slow_query_logger.info("%s %.1f ms: %s | params=%r%s", endpoint, elapsed * 1000, statement,
+                                   parameters, f"\n{plan}" if plan else '')
+
+    #########################
+    # EXPOSITION
+    #########################
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in (self.request_seconds, self.db_seconds, self.db_queries, self.db_rows,
+                       self.render_seconds, self.n_plus_one, self.slow_queries):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def explain_statement(engine, statement, parameters):
+    """
+    Returns the backend's plan for a statement as text, or None on failure.
+    Runs on a separate connection so the request's transaction is untouched;
+    it is called after the request's measurements are closed.
+    """
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    try:
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+        return '\n'.join(' | '.join(str(v) for v in row) for row in rows)
+    except Exception as e:
+        return f"(EXPLAIN failed: {e})"
+
+
+# Shared instrumentation used by the application
+instrumentation = Instrumentation()
@@ -0,0 +1,355 @@
+# interactions.py
+
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, func, or_, case
+
+from models import db, Drug, Reaction, DrugPairCount, InteractionSignal
+from rollups import drug_key_expr, normalize_drug_key
+from signal_detection import Encoder, load_pairs
+from caching import view_cache
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# Drug roles (drugcharacterization) counted by each scope:
+# 1 suspect, 2 concomitant, 3 interacting
+ROLE_SCOPES = {
+    'all': (1, 2, 3),
+    'suspect': (1, 3),
+}
+DEFAULT_SCOPE = 'all'
+
+# Pairs, and pair-reaction combinations, seen in fewer reports than this are not stored
+DEFAULT_MIN_COUNT = 3
+
+# Reports whose drug pairs are expanded at once; bounds the memory of a recompute
+REPORT_BLOCK_SIZE = 100000
+
+# Rows written per INSERT batch
+WRITE_BATCH_SIZE = 10000
+
+# 97.5th percentile of the standard normal distribution
+PHI_975 = 1.96
+
+
+#########################
+# SPARSE COMPUTATION
+#########################
+
+def build_incidence(roles):
+    """
+    Builds binary report x drug and report x reaction incidence matrices
+    over the reports listing at least one drug in `roles` and one reaction.
+    Returns (drug_names, reaction_names, D, R) with D and R in CSR form
+    and D's column indices sorted within each row.
+    """
+    # Imported here: scipy is only needed while interactions are recomputed
+    from scipy import sparse
+
+    report_codes = Encoder()
+    drug_codes = Encoder()
+    reaction_codes = Encoder()
+
+    drug_rows, drug_cols = load_pairs(
+        select(Drug.safetyreportid, drug_key_expr())
+        .where(Drug.drugcharacterization.in_(roles))
+        .distinct(), report_codes, drug_codes)
+    reaction_rows, reaction_cols = load_pairs(
+        select(Reaction.safetyreportid, Reaction.reactionmeddrapt).distinct(), report_codes, reaction_codes)
+
+    n_all = len(report_codes.values)
+    D = sparse.csr_matrix((np.ones(len(drug_rows), dtype=np.int32), (drug_rows, drug_cols)),
+                          shape=(n_all, len(drug_codes.values)))
+    R = sparse.csr_matrix((np.ones(len(reaction_rows), dtype=np.int32), (reaction_rows, reaction_cols)),
+                          shape=(n_all, len(reaction_codes.values)))
+    D.data[:] = 1
+    R.data[:] = 1
+
+    keep = (D.getnnz(axis=1) > 0) & (R.getnnz(axis=1) > 0)
+    D = D[keep]
+    R = R[keep]
+    D.sort_indices()
+    return drug_codes.values, reaction_codes.values, D, R
+
+
+def frequent_pairs(D, min_count):
+    """
+    Counts the reports of every drug pair with one sparse product, D.T @ D.
+    Returns (drug_a, drug_b, count) arrays for pairs with drug_a < drug_b
+    seen in at least `min_count` reports, ordered by pair key.
+    """
+    from scipy import sparse
+
+    co = sparse.triu(D.T @ D, k=1).tocoo()
+    keep = co.data >= min_count
+    (a, b, counts) = (co.row[keep], co.col[keep], co.data[keep])
+    order = np.argsort(a.astype(np.int64) * D.shape[1] + b)
+    return a[order], b[order], counts[order]
+
+
+def report_pairs(D):
+    """
+    Lists every (report, drug i, drug j) with i < j of a CSR incidence
+    matrix with sorted indices, without a Python loop over the reports.
+    """
+    lengths = np.diff(D.indptr)
+    position = np.arange(D.nnz) - np.repeat(D.indptr[:-1], lengths)
+    following = np.repeat(lengths, lengths) - position - 1
+    first = np.repeat(np.arange(D.nnz), following)
+    offset = np.arange(len(first)) - np.repeat(np.cumsum(following) - following, following) + 1
+    reports = np.repeat(np.repeat(np.arange(D.shape[0]), lengths), following)
+    return reports, D.indices[first], D.indices[first + offset]
+
+
+def pair_reaction_counts(D, R, pair_a, pair_b, block_size=REPORT_BLOCK_SIZE):
+    """
+    Counts, for every frequent pair and reaction, the reports listing both
+    drugs and the reaction: P.T @ R, where P is the report x pair incidence
+    matrix. P is built and multiplied one block of reports at a time.
+    """
+    from scipy import sparse
+
+    n_drugs = D.shape[1]
+    pair_keys = pair_a.astype(np.int64) * n_drugs + pair_b
+    total = sparse.csr_matrix((len(pair_keys), R.shape[1]), dtype=np.int32)
+    for start in range(0, D.shape[0], block_size):
+        block = D[start:start + block_size]
+        (reports, i, j) = report_pairs(block)
+        keys = i.astype(np.int64) * n_drugs + j
+        pos = np.searchsorted(pair_keys, keys)
+        pos[pos == len(pair_keys)] = 0
+        found = pair_keys[pos] == keys if len(pair_keys) else np.zeros(len(keys), dtype=bool)
+        P = sparse.csr_matrix((np.ones(int(found.sum()), dtype=np.int32), (reports[found], pos[found])),
+                              shape=(block.shape[0], len(pair_keys)))
+        total = total + P.T @ R[start:start + block_size]
+    return total.tocoo()
+
+
+def omega(n111, n11, a_i, a_j, n_i, n_j, n_reaction, n_reports):
+    """
+    Computes the Omega shrinkage measure of Norén et al. (2008) for arrays
+    of pair-reaction combinations. The count expected without an
+    interaction combines the reaction odds with neither drug and with each
+    drug alone additively; Omega is the shrunk log2 ratio of the observed
+    to the expected count, with a lower 95% credibility bound.
+    `a_i`/`a_j` count the reports of each drug with the reaction and
+    `n_i`/`n_j` the reports of each drug. Undefined rates are NaN.
+    """
+    n111 = n111.astype(np.float64)
+    n11 = n11.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate_both = n111 / n11
+        rate_i = (a_i - n111) / (n_i - n11)
+        rate_j = (a_j - n111) / (n_j - n11)
+        rate_neither = (n_reaction - a_i - a_j + n111) / (n_reports - n_i - n_j + n11)
+
+        # Odds; a drug never reported without the other falls back to the baseline
+        (g00, g10, g01) = (f / (1 - f) for f in (rate_neither, rate_i, rate_j))
+        g11 = np.fmax(g00, g10) + np.fmax(g00, g01) - g00
+        expected = (1 - 1 / (g11 + 1)) * n11
+        expected[np.isinf(g11)] = n11[np.isinf(g11)]
+        omega_value = np.log2((n111 + 0.5) / (expected + 0.5))
+        omega025 = omega_value - PHI_975 / (np.log(2) * np.sqrt(n111))
+    return {
+        'rate_both': rate_both, 'rate_a': rate_i, 'rate_b': rate_j, 'rate_neither': rate_neither,
+        'expected': expected, 'omega': omega_value, 'omega025': omega025,
+    }
+
+
+def _nullable(values):
+    return [v if np.isfinite(v) else None for v in values.tolist()]
+
+
+def _write(table, columns):
+    names = list(columns)
+    total = len(columns[names[0]]) if names else 0
+    for start in range(0, total, WRITE_BATCH_SIZE):
+        end = start + WRITE_BATCH_SIZE
+        batch = [dict(zip(names, values)) for values in zip(*(columns[n][start:end] for n in names))]
+        db.session.execute(table.insert(), batch)
+
+
+def compute_interactions(scope=DEFAULT_SCOPE, min_count=DEFAULT_MIN_COUNT):
+    """
+    Recomputes the drug pair counts and interaction signals of a scope.
+    Pairs and pair-reaction combinations seen in fewer than `min_count`
+    reports are skipped; a reaction is stored for a pair when it is
+    reported more often with both drugs than with either drug alone.
+    Returns (stored pairs, stored signals).
+    """
+    drug_names, reaction_names, D, R = build_incidence(ROLE_SCOPES[scope])
+    n_reports = D.shape[0]
+    n_drug = np.asarray(D.sum(axis=0)).ravel()
+    n_reaction = np.asarray(R.sum(axis=0)).ravel()
+    (pair_a, pair_b, pair_counts) = frequent_pairs(D, min_count)
+
+    # Sorted names make drug_a < drug_b hold for the stored keys too
+    rank = np.empty(len(drug_names), dtype=np.int64)
+    rank[np.argsort(np.array(drug_names, dtype=object))] = np.arange(len(drug_names))
+    swap = rank[pair_a] > rank[pair_b]
+    (first, second) = (np.where(swap, pair_b, pair_a), np.where(swap, pair_a, pair_b))
+
+    triples = pair_reaction_counts(D, R, pair_a, pair_b)
+    keep = triples.data >= min_count
+    (pair_idx, reaction_idx, n111) = (triples.row[keep], triples.col[keep], triples.data[keep])
+    (i, j) = (first[pair_idx], second[pair_idx])
+    A = (D.T @ R).tocsr()
+    scores = omega(n111, pair_counts[pair_idx],
+                   np.asarray(A[i, reaction_idx]).ravel(), np.asarray(A[j, reaction_idx]).ravel(),
+                   n_drug[i], n_drug[j], n_reaction[reaction_idx], n_reports)
+    above = scores['rate_both'] > np.fmax(scores['rate_a'], scores['rate_b'])
+    above &= np.isfinite(scores['omega'])
+    signal_idx = np.flatnonzero(above)
+
+    db.session.execute(DrugPairCount.__table__.delete().where(DrugPairCount.__table__.c.scope == scope))
+    db.session.execute(InteractionSignal.__table__.delete().where(InteractionSignal.__table__.c.scope == scope))
+    _write(DrugPairCount.__table__, {
+        'scope': [scope] * len(pair_counts),
+        'drug_a': [drug_names[k] for k in first.tolist()],
+        'drug_b': [drug_names[k] for k in second.tolist()],
+        'report_count': pair_counts.tolist(),
+        'n_a': n_drug[first].tolist(),
+        'n_b': n_drug[second].tolist(),
+    })
+    signals = {
+        'scope': [scope] * len(signal_idx),
+        'drug_a': [drug_names[k] for k in i[signal_idx].tolist()],
+        'drug_b': [drug_names[k] for k in j[signal_idx].tolist()],
+        'reactionmeddrapt': [reaction_names[k] for k in reaction_idx[signal_idx].tolist()],
+        'n111': n111[signal_idx].tolist(),
+        'n11': pair_counts[pair_idx][signal_idx].tolist(),
+    }
+    for name in ('rate_both', 'expected', 'omega', 'omega025'):
+        signals[name] = scores[name][signal_idx].tolist()
+    for name in ('rate_a', 'rate_b', 'rate_neither'):
+        signals[name] = _nullable(scores[name][signal_idx])
+    _write(InteractionSignal.__table__, signals)
+    db.session.commit()
+    return len(pair_counts), len(signal_idx)
+
+
+def run_interactions(params, progress):
+    """
+    Job handler recomputing every scope.
+    """
+    stored = {}
+    for (n, scope) in enumerate(ROLE_SCOPES):
+        progress(n / len(ROLE_SCOPES), f"Computing {scope} co-medications")
+        (pairs, signals) = compute_interactions(scope, params['min_count'])
+        stored[scope] = {'pairs': pairs, 'signals': signals}
+    return stored
+
+
+#########################
+# QUERIES
+#########################
+
+def resolve_drug(drug_query, scope=DEFAULT_SCOPE, limit=20):
+    """
+    Returns (drug key, candidates) for a drug query: the key when it names
+    a drug with stored pairs exactly or matches only one, otherwise None
+    and up to `limit` matching keys to choose from.
+    """
+    q = normalize_drug_key(drug_query)
+    if not q:
+        return None, []
+    t = DrugPairCount
+    for column in (t.drug_a, t.drug_b):
+        if db.session.execute(select(column).where(t.scope == scope, column == q).limit(1)).first():
+            return q, []
+    pattern = f"%{q}%"
+    keys = db.session.execute(select(t.drug_a).where(t.scope == scope, t.drug_a.like(pattern))
+                              .union(select(t.drug_b).where(t.scope == scope, t.drug_b.like(pattern)))
+                              .limit(limit + 1)).scalars().all()
+    if len(keys) == 1:
+        return keys[0], []
+    return None, sorted(keys)[:limit]
+
+
+def co_medications(drug_key, scope=DEFAULT_SCOPE, limit=50):
+    """
+    Returns the drugs most often reported together with `drug_key`, with
+    the number of reactions over-represented in their shared reports
+    (lower Omega bound above zero).
+    """
+    t = DrugPairCount
+    rows = []
+    for (this, other, n_this, n_other) in ((t.drug_a, t.drug_b, t.n_a, t.n_b), (t.drug_b, t.drug_a, t.n_b, t.n_a)):
+        rows.extend(db.session.execute(select(other, t.report_count, n_this, n_other)
+                                       .where(t.scope == scope, this == drug_key)
+                                       .order_by(t.report_count.desc())
+                                       .limit(limit)).all())
+    rows.sort(key=lambda r: (-r[1], r[0]))
+    rows = rows[:limit]
+
+    s = InteractionSignal
+    other = case((s.drug_a == drug_key, s.drug_b), else_=s.drug_a)
+    flagged = dict(db.session.execute(select(other, func.count())
+                                      .where(s.scope == scope, or_(s.drug_a == drug_key, s.drug_b == drug_key))
+                                      .where(s.omega025 > 0)
+                                      .group_by(other)).all())
+    return [{'drug': o, 'reports': count, 'reports_drug': n_this, 'reports_other': n_other,
+             'flagged_reactions': flagged.get(o, 0)}
+            for (o, count, n_this, n_other) in rows]
+
+
+def interaction_signals(drug_key, other=None, scope=DEFAULT_SCOPE, limit=50):
+    """
+    Returns the stored interaction signals of a drug, or of one pair when
+    `other` is given, strongest lower Omega bound first.
+    """
+    s = InteractionSignal
+    q = select(s).where(s.scope == scope)
+    if other:
+        (a, b) = sorted((drug_key, normalize_drug_key(other)))
+        q = q.where(s.drug_a == a, s.drug_b == b)
+    else:
+        q = q.where(or_(s.drug_a == drug_key, s.drug_b == drug_key))
+    return db.session.execute(q.order_by(s.omega025.desc(), s.reactionmeddrapt).limit(limit)).scalars().all()
+
+
+def signal_to_dict(s):
+    """
+    Serializes an InteractionSignal row for the JSON API.
+    """
+    return {
+        'drugs': [s.drug_a, s.drug_b],
+        'reaction': s.reactionmeddrapt,
+        'reports_with_both': s.n111,
+        'reports_both_drugs': s.n11,
+        'rate_both': s.rate_both,
+        'rate_drug_a_alone': s.rate_a,
+        'rate_drug_b_alone': s.rate_b,
+        'rate_neither': s.rate_neither,
+        'expected': s.expected,
+        'omega': s.omega,
+        'omega_ci_lower': s.omega025,
+    }
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+interactions_cli = AppGroup('interactions', help="Compute drug-drug co-medication analytics.")
+
+
+@interactions_cli.command('compute')
+@click.option('--scope', type=click.Choice(sorted(ROLE_SCOPES)), multiple=True,
+              help="Drug roles to count (default: every scope).")
+@click.option('--min-count', default=DEFAULT_MIN_COUNT, show_default=True,
+              help="Minimum number of reports for a pair or pair-reaction combination to be stored.")
+def compute_command(scope, min_count):
+    """
+    Recomputes drug pair counts and interaction signals.
+    """
+    db.create_all()
+    for name in scope or ROLE_SCOPES:
+        started = time.monotonic()
+        (pairs, signals) = compute_interactions(name, min_count)
+        click.echo(f"{name}: stored {pairs} drug pairs and {signals} interaction signals "
+                   f"in {time.monotonic() - started:.1f}s")
+    view_cache.bump_data_version()
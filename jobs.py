@@ -0,0 +1,465 @@
+# jobs.py
+
+import datetime
+import hashlib
+import json
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import Flask
+from flask.cli import AppGroup
+from sqlalchemy import select, update, func, or_, and_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, AnalyticsJob
+from caching import view_cache
+from query_executor import query_executor
+from stats_engine import compute_statistics, matching_report_ids
+import bulk_admin
+import columnar
+import comparison
+import export
+import interactions
+import rollups
+import signal_detection
+
+# Jobs in these states are in flight and count against the per-user limit
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class JobLimitError(Exception):
+    """
+    Raised when a user already has the maximum number of jobs in flight.
+    """
+
+
+class JobsDisabledError(Exception):
+    """
+    Raised when a job is submitted while JOBS_ENABLED is off (for example
+    while serving a read-only snapshot, which cannot store jobs).
+    """
+
+
+#########################
+# JOB KINDS
+#########################
+
+def bounded_report_count(drug_query, limit, deduplicated=False):
+    """
+    Counts the reports matching a drug query, stopping after `limit` + 1.
+    """
+    ids = matching_report_ids(drug_query, deduplicated=deduplicated).limit(limit + 1).subquery()
+    return db.session.execute(select(func.count()).select_from(ids)).scalar()
+
+
+def statistics_cost(params, limit):
+    """
+    Estimates the reports a statistics request has to aggregate. Requests
+    answered by the columnar store or the rollup tables cost nothing;
+    neither holds deduplicated counts.
+    """
+    drug = params['drug']
+    deduplicated = params.get('dedup', False)
+    if not drug:
+        return 0
+    if not deduplicated and (columnar.get_store() is not None or rollups.resolve_drug_key(drug) is not None):
+        return 0
+    return bounded_report_count(drug, limit, deduplicated)
+
+
+def compare_cost(params, limit):
+    """
+    Estimates the reports a comparison has to aggregate across its drugs.
+    """
+    total = 0
+    for drug in params['drugs']:
+        total += bounded_report_count(drug, limit - total, params.get('dedup', False))
+        if total > limit:
+            break
+    return total
+
+
+def run_statistics(params, progress):
+    progress(0.1, "Computing statistics")
+    return compute_statistics(params['drug'], deduplicated=params.get('dedup', False)).to_dict()
+
+
+def run_compare(params, progress):
+    progress(0.1, f"Comparing {len(params['drugs'])} drugs")
+    return comparison.compare_drugs(params['drugs'], deduplicated=params.get('dedup', False)).to_dict()
+
+
+def run_signals(params, progress):
+    progress(0.1, "Scoring drug-reaction pairs")
+    pairs = signal_detection.compute_signals(params['min_count'])
+    progress(0.5, "Scoring drug-reaction pairs over deduplicated cases")
+    return {'pairs': pairs,
+            'deduplicated_pairs': signal_detection.compute_signals(params['min_count'], deduplicated=True)}
+
+
+# Job kind -> (handler, cost estimate). Handlers run in a worker process and
+# return a JSON-serializable result; kinds without a cost estimate always
+# run as jobs.
+JOB_KINDS = {
+    'statistics': (run_statistics, statistics_cost),
+    'compare': (run_compare, compare_cost),
+    'signals': (run_signals, None),
+    'interactions': (interactions.run_interactions, None),
+    'export': (export.run_export, None),
+    **bulk_admin.BULK_JOB_KINDS,
+}
+
+# Kind -> function removing what a job left behind besides its row, called
+# with the job's result when the job is purged
+JOB_CLEANUP = {
+    'export': export.remove_export_file,
+}
+
+# Kinds whose completion changes data shown by cached pages
+CACHE_INVALIDATING_KINDS = {'signals', 'interactions', *bulk_admin.BULK_JOB_KINDS}
+
+
+#########################
+# WORKER PROCESS
+#########################
+
+_worker_app = None
+
+
+def _init_worker(config):
+    """
+    Sets up a minimal application in a freshly spawned worker process.
+    """
+    global _worker_app
+    app = Flask(__name__)
+    app.config.update(config)
+    db.init_app(app)
+    query_executor.init_app(app)
+    _worker_app = app
+
+
+def _update_job(job_id, **values):
+    """
+    Updates a job row in its own transaction, so progress is visible at once.
+    """
+    values['updated_at'] = datetime.datetime.utcnow()
+    table = AnalyticsJob.__table__
+    with db.engine.begin() as conn:
+        conn.execute(update(table).where(table.c.id == job_id).values(**values))
+
+
+def _execute_job(job_id):
+    """
+    Runs one job inside the worker process and records its outcome.
+    Returns the final status.
+    """
+    with _worker_app.app_context():
+        job = db.session.get(AnalyticsJob, job_id)
+        if job is None or job.status != 'queued':
+            return None
+        (handler, _) = JOB_KINDS[job.kind]
+        params = json.loads(job.params)
+        db.session.remove()
+
+        def progress(fraction, message=None):
+            _update_job(job_id, progress=fraction, message=message)
+
+        _update_job(job_id, status='running', progress=0.0)
+        try:
+            result = handler(params, progress)
+            _update_job(job_id, status='done', active_hash=None, progress=1.0, message=None,
+                        result=json.dumps(result), finished_at=datetime.datetime.utcnow())
+            return 'done'
+        except Exception as e:
+            _update_job(job_id, status='failed', active_hash=None, error=repr(e),
+                        finished_at=datetime.datetime.utcnow())
+            return 'failed'
+        finally:
+            db.session.remove()
+
+
+#########################
+# JOB QUEUE
+#########################
+
+def job_to_dict(job, with_result=True):
+    """
+    Converts a jobs row into a plain dictionary with parsed params and result.
+    """
+    out = {
+        'id': job.id,
+        'kind': job.kind,
+        'params': json.loads(job.params),
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if with_result:
+        out['result'] = json.loads(job.result) if job.result else None
+    return out
+
+
+class JobQueue:
+    """
+    Runs expensive analytics requests in a local process pool instead of in
+    the web worker. Requests whose estimated cost exceeds JOB_COST_THRESHOLD
+    become jobs stored in the analytics_jobs table; the browser polls for
+    progress and the finished result is reused by identical requests until
+    the data changes or JOB_RESULT_TTL_SECONDS passes.
+    While the submitting process lives, a heartbeat thread keeps its
+    unfinished jobs' updated_at current, so a job waiting behind long ones
+    is never mistaken for one whose process has gone away.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.workers = 2
+        self.cost_threshold = 20000
+        self.per_user_limit = 2
+        self.result_ttl = 3600
+        self.stale_seconds = 900
+        self.query_timeout = 600.0
+        self._app = None
+        self._executor = None
+        self._pending = set()
+        self._heartbeat = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Reads the pool size, cost threshold and limits from the application config.
+        """
+        self._app = app
+        self.enabled = app.config.get('JOBS_ENABLED', True)
+        self.workers = app.config.get('JOB_WORKERS', 2)
+        self.cost_threshold = app.config.get('JOB_COST_THRESHOLD', 20000)
+        self.per_user_limit = app.config.get('JOBS_PER_USER_LIMIT', 2)
+        self.result_ttl = app.config.get('JOB_RESULT_TTL_SECONDS', 3600)
+        self.stale_seconds = app.config.get('JOB_STALE_SECONDS', 900)
+        self.query_timeout = app.config.get('JOB_QUERY_TIMEOUT_SECONDS', 600.0)
+
+    def _get_executor(self):
+        # Spawned lazily, so workers never inherit the web process's connections or threads
+        with self._lock:
+            if self._executor is None:
+                config = {k: v for (k, v) in self._app.config.items() if k.isupper()}
+                config['QUERY_TIMEOUT_SECONDS'] = self.query_timeout
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_worker,
+                                                     initargs=(config,))
+            return self._executor
+
+    @staticmethod
+    def params_hash(kind, params, data_version):
+        """
+        Identifies a request: equal kind, parameters and data version share a job.
+        """
+        payload = json.dumps([kind, params, data_version], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _track(self, job_id, future):
+        """
+        Adds a submitted job to the heartbeat until its future completes.
+        """
+        with self._lock:
+            self._pending.add(job_id)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+        def untrack(_):
+            with self._lock:
+                self._pending.discard(job_id)
+        future.add_done_callback(untrack)
+
+    def _beat(self):
+        # Touches the unfinished jobs of this process well within JOB_STALE_SECONDS
+        table = AnalyticsJob.__table__
+        while True:
+            time.sleep(max(1.0, self.stale_seconds / 3))
+            with self._lock:
+                job_ids = list(self._pending)
+            if not job_ids:
+                continue
+            try:
+                with self._app.app_context(), db.engine.begin() as conn:
+                    conn.execute(update(table)
+                                 .where(table.c.id.in_(job_ids))
+                                 .where(table.c.status.in_(ACTIVE_STATUSES))
+                                 .values(updated_at=datetime.datetime.utcnow()))
+            except Exception:
+                # Retried on the next beat
+                pass
+
+    def _find_reusable(self, conn, digest):
+        """
+        Returns the newest in-flight or recently finished job for a request.
+        In-flight jobs without an update (progress or heartbeat) for
+        JOB_STALE_SECONDS belonged to a process that has gone away; they are
+        marked failed and skipped.
+        """
+        now = datetime.datetime.utcnow()
+        table = AnalyticsJob.__table__
+        rows = conn.execute(select(table)
+                            .where(table.c.params_hash == digest)
+                            .where(table.c.status.in_(ACTIVE_STATUSES + ('done',)))
+                            .order_by(table.c.created_at.desc())).all()
+        for job in rows:
+            if job.status == 'done':
+                if job.finished_at >= now - datetime.timedelta(seconds=self.result_ttl):
+                    return job
+            elif job.updated_at >= now - datetime.timedelta(seconds=self.stale_seconds):
+                return job
+            else:
+                conn.execute(update(table).where(table.c.id == job.id)
+                             .values(status='failed', active_hash=None, error='Worker lost',
+                                     updated_at=now, finished_at=now))
+        return None
+
+    def defer(self, kind, params, owner):
+        """
+        Returns the job answering an expensive request, submitting it if
+        needed, or None when the request is cheap enough to serve inline.
+        """
+        if not self.enabled:
+            return None
+        (_, cost) = JOB_KINDS[kind]
+        if cost is not None and cost(params, self.cost_threshold) <= self.cost_threshold:
+            return None
+        return self.submit(kind, params, owner)
+
+    def submit(self, kind, params, owner):
+        """
+        Returns the job for a request, reusing an identical in-flight or
+        finished one. Raises JobLimitError when the owner already has
+        JOBS_PER_USER_LIMIT jobs in flight, and JobsDisabledError when jobs
+        are turned off. Both checks hold under concurrent submissions: a second in-flight
+        job for the same request fails the unique active_hash index and the
+        first one is returned instead, and the limit is checked again once
+        the new job is committed, withdrawing it if others got in first.
+        """
+        if not self.enabled:
+            raise JobsDisabledError("Background jobs are not available on this server.")
+        digest = self.params_hash(kind, params, view_cache.data_version())
+        table = AnalyticsJob.__table__
+        now = datetime.datetime.utcnow()
+        job_id = uuid.uuid4().hex
+        try:
+            with db.engine.begin() as conn:
+                job = self._find_reusable(conn, digest)
+                if job is not None:
+                    return job_to_dict(job)
+                self._check_limit(conn, owner)
+                conn.execute(table.insert().values(id=job_id, kind=kind, params=json.dumps(params),
+                                                   params_hash=digest, active_hash=digest, owner=owner,
+                                                   status='queued', progress=0.0,
+                                                   created_at=now, updated_at=now))
+        except IntegrityError:
+            # An identical request was submitted concurrently
+            with db.engine.begin() as conn:
+                job = self._find_reusable(conn, digest)
+            if job is None:
+                raise
+            return job_to_dict(job)
+
+        earlier = or_(table.c.created_at < now, and_(table.c.created_at == now, table.c.id < job_id))
+        try:
+            with db.engine.connect() as conn:
+                self._check_limit(conn, owner, earlier)
+        except JobLimitError as e:
+            _update_job(job_id, status='failed', active_hash=None, error=str(e), finished_at=now)
+            raise
+
+        future = self._get_executor().submit(_execute_job, job_id)
+        self._track(job_id, future)
+        if kind in CACHE_INVALIDATING_KINDS:
+            future.add_done_callback(self._invalidate_cache)
+        return self.get(job_id)
+
+    def _check_limit(self, conn, owner, *conditions):
+        """
+        Raises JobLimitError when the owner has JOBS_PER_USER_LIMIT in-flight
+        jobs matching the conditions.
+        """
+        table = AnalyticsJob.__table__
+        active = conn.execute(select(func.count())
+                              .select_from(table)
+                              .where(table.c.owner == owner)
+                              .where(table.c.status.in_(ACTIVE_STATUSES))
+                              .where(*conditions)).scalar()
+        if active >= self.per_user_limit:
+            raise JobLimitError(f"You already have {active} analyses running. "
+                                f"Wait for one to finish before starting another.")
+
+    def _invalidate_cache(self, future):
+        # Runs on a pool thread in the web process once a data-changing job ends
+        if future.exception() is None and future.result() == 'done':
+            with self._app.app_context():
+                view_cache.bump_data_version()
+
+    def get(self, job_id, with_result=True):
+        """
+        Returns a job as a dictionary, or None if it does not exist.
+        """
+        with db.engine.connect() as conn:
+            job = conn.execute(select(AnalyticsJob.__table__)
+                               .where(AnalyticsJob.__table__.c.id == job_id)).first()
+        return job_to_dict(job, with_result) if job is not None else None
+
+    def purge(self, older_than):
+        """
+        Deletes finished and failed jobs created before `older_than`,
+        together with the files they wrote. Returns the number of deleted jobs.
+        """
+        table = AnalyticsJob.__table__
+        expired = [table.c.created_at < older_than, table.c.status.notin_(ACTIVE_STATUSES)]
+        with db.engine.begin() as conn:
+            leftovers = conn.execute(select(table.c.kind, table.c.result)
+                                     .where(*expired)
+                                     .where(table.c.kind.in_(list(JOB_CLEANUP)))
+                                     .where(table.c.result.isnot(None))).all()
+            result = conn.execute(table.delete().where(*expired))
+        for (kind, job_result) in leftovers:
+            JOB_CLEANUP[kind](json.loads(job_result))
+        return result.rowcount
+
+
+# Shared job queue used by the analytics routes
+job_queue = JobQueue()
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+jobs_cli = AppGroup('jobs', help="Inspect and clean up background analytics jobs.")
+
+
+@jobs_cli.command('list')
+@click.option('--limit', default=20, show_default=True, help="Number of recent jobs to show.")
+def list_command(limit):
+    """
+    Shows the most recent jobs.
+    """
+    rows = db.session.execute(select(AnalyticsJob).order_by(AnalyticsJob.created_at.desc()).limit(limit)).scalars()
+    for job in rows:
+        click.echo(f"{job.id}  {job.created_at:%Y-%m-%d %H:%M:%S}  {job.kind:<10} {job.status:<8} "
+                   f"{job.progress * 100:3.0f}%  {job.params}")
+
+
+@jobs_cli.command('purge')
+@click.option('--days', default=7, show_default=True, help="Delete finished jobs older than this.")
+def purge_command(days):
+    """
+    Deletes finished and failed jobs older than the given number of days.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    click.echo(f"Deleted {job_queue.purge(cutoff)} jobs.")
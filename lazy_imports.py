@@ -0,0 +1,26 @@
+# lazy_imports.py
+
+import importlib.util
+import sys
+
+
+def lazy_module(name):
+    """
+    Returns a module that is only executed when one of its attributes is
+    first used. Modules such as numpy are needed by a few analytics paths
+    but would otherwise be imported by every web worker at start-up.
+    Only top-level packages can be deferred this way; locating a submodule
+    imports its parent package.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
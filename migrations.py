@@ -0,0 +1,127 @@
+# migrations.py
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from models import db
+import drug_dictionary
+import signal_detection
+
+
+def missing_indexes(bind):
+    """
+    Returns the indexes declared on the models that the database lacks.
+    """
+    insp = inspect(bind)
+    existing_tables = set(insp.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {ix['name'] for ix in insp.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            if index.name not in present:
+                missing.append(index)
+    return missing
+
+
+def create_tables(bind):
+    """
+    Creates tables that do not exist yet (with their indexes).
+    """
+    db.metadata.create_all(bind)
+
+
+def missing_columns(bind):
+    """
+    Returns the columns declared on the models that existing tables lack.
+    """
+    insp = inspect(bind)
+    existing_tables = set(insp.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {col['name'] for col in insp.get_columns(table.name)}
+        missing.extend(col for col in table.columns if col.name not in present)
+    return missing
+
+
+def add_columns(bind):
+    """
+    Adds declared nullable columns missing from existing tables.
+    """
+    for column in missing_columns(bind):
+        ddl = CreateColumn(column).compile(dialect=bind.dialect)
+        click.echo(f"  adding {column.name} to {column.table.name}")
+        with bind.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {column.table.name} ADD COLUMN {ddl}"))
+
+
+def create_indexes(bind):
+    """
+    Adds declared indexes missing from existing tables.
+    """
+    for index in missing_indexes(bind):
+        click.echo(f"  creating {index.name} on {index.table.name}")
+        index.create(bind)
+
+
+# Schema steps applied in order by 'flask schema upgrade'. Every step is
+# idempotent and inspects the live schema, so rerunning is always safe.
+SCHEMA_STEPS = [
+    ('create missing tables', create_tables),
+    ('recreate outdated signal scores', signal_detection.rebuild_scores_table),
+    ('add missing columns', add_columns),
+    ('remove duplicate drug aliases', drug_dictionary.dedupe_aliases),
+    ('create missing indexes', create_indexes),
+    ('link drugs to the drug dictionary', drug_dictionary.backfill),
+]
+
+
+def upgrade(bind=None):
+    """
+    Applies every schema step to the database.
+    """
+    bind = bind or db.engine
+    for (name, step) in SCHEMA_STEPS:
+        click.echo(f"{name}...")
+        step(bind)
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+schema_cli = AppGroup('schema', help="Inspect and upgrade the database schema.")
+
+
+@schema_cli.command('upgrade')
+def upgrade_command():
+    """
+    Creates missing tables, columns and indexes and backfills new data.
+    """
+    upgrade()
+    click.echo("Schema is up to date.")
+
+
+@schema_cli.command('status')
+def status_command():
+    """
+    Lists declared tables, columns and indexes missing from the database.
+    """
+    insp = inspect(db.engine)
+    tables = set(insp.get_table_names())
+    pending = [t.name for t in db.metadata.sorted_tables if t.name not in tables]
+    for name in pending:
+        click.echo(f"missing table {name}")
+    columns = missing_columns(db.engine)
+    for column in columns:
+        click.echo(f"missing column {column.name} on {column.table.name}")
+    indexes = missing_indexes(db.engine)
+    for index in indexes:
+        click.echo(f"missing index {index.name} on {index.table.name}")
+    if not pending and not columns and not indexes:
+        click.echo("Schema is up to date.")
@@ -2,7 +2,10 @@
 
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+from replicas import RoutingSession
+
+# SELECTs of replica-enabled views are routed by replicas.replica_router
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class SafetyReport(db.Model):
@@ -31,6 +34,12 @@ class SafetyReport(db.Model):
     reactions = db.relationship('Reaction', backref='safety_report', lazy='select', cascade="all, delete-orphan")
     company = db.relationship('Company', backref='safety_reports', lazy='select')
 
+    # Date range scans and newest-first listings; country filters within a date range
+    __table_args__ = (
+        db.Index('ix_safety_reports_receivedate', 'receivedate', 'safetyreportid'),
+        db.Index('ix_safety_reports_country_date', 'primarysource_reportercountry', 'receivedate'),
+    )
+
     def __repr__(self):
         """
         Returns a string representation of the SafetyReport instance.
@@ -50,6 +59,14 @@ class Patient(db.Model):
     patientagegroup = db.Column(db.SmallInteger, nullable=True)
     patientsex = db.Column(db.SmallInteger, nullable=True)
 
+    # Covering indexes for the age group and sex search filters, and for
+    # per-report age breakdowns joined from a set of report ids
+    __table_args__ = (
+        db.Index('ix_patients_report_agegroup', 'safetyreportid', 'patientagegroup'),
+        db.Index('ix_patients_agegroup_report', 'patientagegroup', 'safetyreportid'),
+        db.Index('ix_patients_sex_report', 'patientsex', 'safetyreportid'),
+    )
+
     def __repr__(self):
         """
         Returns a string representation of the Patient instance.
@@ -69,6 +86,13 @@ class Reaction(db.Model):
     reactionmeddrapt = db.Column(db.String(255), nullable=False)
     reactionoutcome = db.Column(db.SmallInteger, nullable=True)
 
+    # Covering indexes for reaction-term prefix searches and for reaction
+    # counts joined from a set of report ids
+    __table_args__ = (
+        db.Index('ix_reactions_report_term', 'safetyreportid', 'reactionmeddrapt'),
+        db.Index('ix_reactions_term_report', 'reactionmeddrapt', 'safetyreportid'),
+    )
+
     def __repr__(self):
         """
         Returns a string representation of the Reaction instance.
@@ -97,6 +121,15 @@ class Drug(db.Model):
     drugrecurreadministration = db.Column(db.SmallInteger, nullable=True)
     drugadditional = db.Column(db.SmallInteger, nullable=True)
     activesubstancename = db.Column(db.String(255), nullable=True)
+    drug_product_id = db.Column(db.Integer, db.ForeignKey('drug_products.id'), nullable=True)
+
+    product = db.relationship('DrugProduct', lazy='select')
+
+    # Covering index for drug-name prefix searches; report lookups by product id
+    __table_args__ = (
+        db.Index('ix_drugs_product_report', 'medicinalproduct', 'safetyreportid'),
+        db.Index('ix_drugs_product_id_report', 'drug_product_id', 'safetyreportid'),
+    )
 
     def __repr__(self):
         """
@@ -120,3 +153,474 @@ class Company(db.Model):
         Returns a string representation of the Company instance.
         """
         return f"<Company {self.companynumb} - {self.companyname}>"
+
+
+#########################
+# DRUG DICTIONARY
+#########################
+
+class DrugProduct(db.Model):
+    """
+    One distinct medicinal product, identified by its normalized name.
+    Drug rows reference it by id, so drug-level grouping is an integer comparison.
+    """
+    __tablename__ = 'drug_products'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    normalized_name = db.Column(db.String(255), nullable=False, unique=True)
+    display_name = db.Column(db.String(255), nullable=False)
+    activesubstancename = db.Column(db.String(255), nullable=True)
+
+    aliases = db.relationship('DrugProductAlias', backref='product', lazy='select', cascade="all, delete-orphan")
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugProduct instance.
+        """
+        return f"<DrugProduct {self.id} {self.display_name}>"
+
+
+class DrugProductAlias(db.Model):
+    """
+    A lowercased spelling of a medicinal product as it appears in the drugs table.
+    Each spelling is stored once. Name searches match against the aliases
+    and then join on the product id.
+    """
+    __tablename__ = 'drug_product_aliases'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    alias = db.Column(db.String(255), nullable=False)
+    drug_product_id = db.Column(db.Integer, db.ForeignKey('drug_products.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_drug_product_aliases_alias', 'alias', 'drug_product_id'),
+        db.Index('uq_drug_product_aliases_alias', 'alias', unique=True),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugProductAlias instance.
+        """
+        return f"<DrugProductAlias {self.alias} -> {self.drug_product_id}>"
+
+
+#########################
+# PER-DRUG ROLLUP TABLES
+#########################
+
+class DrugMonthRollup(db.Model):
+    """
+    Number of distinct reports per normalized drug and receive month.
+    """
+    __tablename__ = 'drug_month_rollups'
+
+    drug_key = db.Column(db.String(255), primary_key=True)
+    yr = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    mo = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    report_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugMonthRollup instance.
+        """
+        return f"<DrugMonthRollup {self.drug_key} {self.yr}-{self.mo}: {self.report_count}>"
+
+
+class DrugCountryRollup(db.Model):
+    """
+    Number of distinct reports per normalized drug and reporter country.
+    Reports without a country are stored under an empty country code.
+    """
+    __tablename__ = 'drug_country_rollups'
+
+    drug_key = db.Column(db.String(255), primary_key=True)
+    country = db.Column(db.String(2), primary_key=True)
+    report_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugCountryRollup instance.
+        """
+        return f"<DrugCountryRollup {self.drug_key} {self.country}: {self.report_count}>"
+
+
+class DrugAgeGroupRollup(db.Model):
+    """
+    Number of patients per normalized drug and patient age group.
+    Patients without an age group are stored under age group 0.
+    """
+    __tablename__ = 'drug_age_group_rollups'
+
+    drug_key = db.Column(db.String(255), primary_key=True)
+    patientagegroup = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    patient_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugAgeGroupRollup instance.
+        """
+        return f"<DrugAgeGroupRollup {self.drug_key} {self.patientagegroup}: {self.patient_count}>"
+
+
+class DrugSeriousnessRollup(db.Model):
+    """
+    Number of distinct reports per normalized drug meeting each seriousness criterion.
+    Also holds the 'total', 'serious' and 'non_serious' report counts.
+    """
+    __tablename__ = 'drug_seriousness_rollups'
+
+    drug_key = db.Column(db.String(255), primary_key=True)
+    criterion = db.Column(db.String(30), primary_key=True)
+    report_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugSeriousnessRollup instance.
+        """
+        return f"<DrugSeriousnessRollup {self.drug_key} {self.criterion}: {self.report_count}>"
+
+
+class DrugReactionRollup(db.Model):
+    """
+    Number of reaction entries per normalized drug and reaction term.
+    """
+    __tablename__ = 'drug_reaction_rollups'
+
+    drug_key = db.Column(db.String(255), primary_key=True)
+    reactionmeddrapt = db.Column(db.String(255), primary_key=True)
+    reaction_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugReactionRollup instance.
+        """
+        return f"<DrugReactionRollup {self.drug_key} {self.reactionmeddrapt}: {self.reaction_count}>"
+
+
+#########################
+# INGESTION BOOKKEEPING
+#########################
+
+class IngestCheckpoint(db.Model):
+    """
+    Tracks how far the bulk loader has got through each source file.
+    Updated in the same transaction as the rows it covers, so an interrupted
+    load resumes after the last committed batch.
+    """
+    __tablename__ = 'ingest_checkpoints'
+
+    file_path = db.Column(db.String(500), primary_key=True)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    records_done = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the IngestCheckpoint instance.
+        """
+        return f"<IngestCheckpoint {self.file_path}: {self.records_done}>"
+
+
+#########################
+# BACKGROUND JOBS
+#########################
+
+class AnalyticsJob(db.Model):
+    """
+    An expensive analytics request executed by the background job pool.
+    Identical requests share one job through params_hash; the JSON result
+    is kept so later requests are answered without recomputing.
+    """
+    __tablename__ = 'analytics_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    params = db.Column(db.Text, nullable=False)
+    params_hash = db.Column(db.String(64), nullable=False)
+    # params_hash while the job is queued or running, NULL afterwards; its
+    # unique index lets only one in-flight job exist per request
+    active_hash = db.Column(db.String(64), nullable=True)
+    owner = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    message = db.Column(db.String(255), nullable=True)
+    result = db.Column(db.Text(16777215), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_analytics_jobs_hash_status', 'params_hash', 'status'),
+        db.Index('ix_analytics_jobs_owner_status', 'owner', 'status'),
+        db.Index('uq_analytics_jobs_active_hash', 'active_hash', unique=True),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the AnalyticsJob instance.
+        """
+        return f"<AnalyticsJob {self.id} {self.kind} {self.status}>"
+
+
+class ReportArchive(db.Model):
+    """
+    A read-only SQLite snapshot holding the reports received before
+    `upper` (and their patients, drugs, reactions and companies), written
+    by `flask partitions archive`. `dropped` records whether the archived
+    reports were then removed from the live tables.
+    """
+    __tablename__ = 'report_archives'
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(500), nullable=False)
+    lower = db.Column(db.Date, nullable=True)
+    upper = db.Column(db.Date, nullable=False)
+    report_count = db.Column(db.Integer, nullable=False)
+    dropped = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the ReportArchive instance.
+        """
+        return f"<ReportArchive {self.path} before {self.upper}>"
+
+
+#########################
+# DUPLICATE DETECTION
+#########################
+
+class ReportFingerprint(db.Model):
+    """
+    The drug and reaction token set of a report, with the demographics used
+    to confirm duplicate candidates. A report with a fingerprint has been
+    processed by duplicate detection.
+    """
+    __tablename__ = 'report_fingerprints'
+
+    safetyreportid = db.Column(db.String(50), primary_key=True)
+    blocking_key = db.Column(db.String(64), nullable=False)
+    tokens = db.Column(db.Text, nullable=False)
+    patientagegroup = db.Column(db.SmallInteger, nullable=True)
+    patientsex = db.Column(db.SmallInteger, nullable=True)
+    receivedate = db.Column(db.Date, nullable=True)
+    receiptdate = db.Column(db.Date, nullable=True)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the ReportFingerprint instance.
+        """
+        return f"<ReportFingerprint {self.safetyreportid}>"
+
+
+class ReportDedupBucket(db.Model):
+    """
+    One locality-sensitive hashing bucket of a report's MinHash signature.
+    Reports sharing a bucket are duplicate candidates.
+    """
+    __tablename__ = 'report_dedup_buckets'
+
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    safetyreportid = db.Column(db.String(50), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_report_dedup_buckets_report', 'safetyreportid'),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the ReportDedupBucket instance.
+        """
+        return f"<ReportDedupBucket {self.bucket} {self.safetyreportid}>"
+
+
+class ReportCluster(db.Model):
+    """
+    Membership of a report in a cluster of duplicate or follow-up reports.
+    cluster_id is the cluster's canonical report (the most recent version),
+    which has a row pointing at itself; reports in no cluster have no row.
+    similarity is the report's best Jaccard similarity within the cluster.
+    """
+    __tablename__ = 'report_clusters'
+
+    safetyreportid = db.Column(db.String(50), primary_key=True)
+    cluster_id = db.Column(db.String(50), nullable=False)
+    similarity = db.Column(db.Float, nullable=False)
+    detected_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_report_clusters_cluster', 'cluster_id'),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the ReportCluster instance.
+        """
+        return f"<ReportCluster {self.safetyreportid} -> {self.cluster_id}>"
+
+
+#########################
+# SIGNAL DETECTION
+#########################
+
+class SignalScore(db.Model):
+    """
+    Disproportionality scores for one normalized drug and reaction term.
+    Holds the 2x2 contingency counts over reports together with PRR, ROR
+    (with 95% confidence interval) and the information component.
+    Every pair is scored twice: over all reports, and with `deduplicated`
+    set, over the reports left once superseded case versions are excluded.
+    """
+    __tablename__ = 'signal_scores'
+
+    drug_key = db.Column(db.String(255), primary_key=True)
+    reactionmeddrapt = db.Column(db.String(255), primary_key=True)
+    deduplicated = db.Column(db.Boolean, primary_key=True, default=False, server_default=db.false())
+    a = db.Column(db.Integer, nullable=False)
+    b = db.Column(db.Integer, nullable=False)
+    c = db.Column(db.Integer, nullable=False)
+    d = db.Column(db.Integer, nullable=False)
+    prr = db.Column(db.Float, nullable=True)
+    ror = db.Column(db.Float, nullable=True)
+    ror_lower = db.Column(db.Float, nullable=True)
+    ror_upper = db.Column(db.Float, nullable=True)
+    ic = db.Column(db.Float, nullable=True)
+    ic025 = db.Column(db.Float, nullable=True)
+    ic975 = db.Column(db.Float, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_signal_scores_reaction', 'reactionmeddrapt'),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the SignalScore instance.
+        """
+        return f"<SignalScore {self.drug_key} / {self.reactionmeddrapt}: ROR {self.ror}>"
+
+
+#########################
+# CO-MEDICATION ANALYTICS
+#########################
+
+class DrugPairCount(db.Model):
+    """
+    Number of reports listing both drugs of a pair in the roles of `scope`
+    (see interactions.ROLE_SCOPES), with each drug's own report count.
+    A pair is stored once, with drug_a sorting before drug_b.
+    """
+    __tablename__ = 'drug_pair_counts'
+
+    scope = db.Column(db.String(20), primary_key=True)
+    drug_a = db.Column(db.String(255), primary_key=True)
+    drug_b = db.Column(db.String(255), primary_key=True)
+    report_count = db.Column(db.Integer, nullable=False)
+    n_a = db.Column(db.Integer, nullable=False)
+    n_b = db.Column(db.Integer, nullable=False)
+
+    # Co-medications of one drug, most frequent first, whichever side it is on
+    __table_args__ = (
+        db.Index('ix_drug_pair_counts_a', 'scope', 'drug_a', 'report_count'),
+        db.Index('ix_drug_pair_counts_b', 'scope', 'drug_b', 'report_count'),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugPairCount instance.
+        """
+        return f"<DrugPairCount {self.scope} {self.drug_a} + {self.drug_b}: {self.report_count}>"
+
+
+class InteractionSignal(db.Model):
+    """
+    A reaction reported more often when both drugs of a pair are taken than
+    with either drug alone. Holds the reaction rates among reports with
+    both drugs, with only drug_a, with only drug_b and with neither, the
+    count expected if the drugs did not interact, and the Omega shrinkage
+    measure with its lower 95% credibility bound.
+    """
+    __tablename__ = 'interaction_signals'
+
+    scope = db.Column(db.String(20), primary_key=True)
+    drug_a = db.Column(db.String(255), primary_key=True)
+    drug_b = db.Column(db.String(255), primary_key=True)
+    reactionmeddrapt = db.Column(db.String(255), primary_key=True)
+    n111 = db.Column(db.Integer, nullable=False)
+    n11 = db.Column(db.Integer, nullable=False)
+    rate_both = db.Column(db.Float, nullable=False)
+    rate_a = db.Column(db.Float, nullable=True)
+    rate_b = db.Column(db.Float, nullable=True)
+    rate_neither = db.Column(db.Float, nullable=True)
+    expected = db.Column(db.Float, nullable=False)
+    omega = db.Column(db.Float, nullable=False)
+    omega025 = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_interaction_signals_b', 'scope', 'drug_b', 'drug_a'),
+    )
+
+    def __repr__(self):
+        """
+        Returns a string representation of the InteractionSignal instance.
+        """
+        return f"<InteractionSignal {self.drug_a} + {self.drug_b} / {self.reactionmeddrapt}: {self.omega}>"
+
+
+#########################
+# APPROXIMATE QUERY MODE
+#########################
+
+class ReportSample(db.Model):
+    """
+    Membership of a report in the stratified sample answering approximate
+    statistics (see approximate.py). A report is sampled when the hash of
+    its id falls below the sampling rate of its stratum.
+    """
+    __tablename__ = 'report_samples'
+
+    safetyreportid = db.Column(db.String(50), primary_key=True)
+    stratum = db.Column(db.String(20), nullable=False)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the ReportSample instance.
+        """
+        return f"<ReportSample {self.safetyreportid} ({self.stratum})>"
+
+
+class SampleStratum(db.Model):
+    """
+    One stratum of the report sample (a receive year and seriousness), with
+    its number of reports and the sampling rate its members were drawn at.
+    """
+    __tablename__ = 'sample_strata'
+
+    stratum = db.Column(db.String(20), primary_key=True)
+    population = db.Column(db.Integer, nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the SampleStratum instance.
+        """
+        return f"<SampleStratum {self.stratum}: {self.population} at {self.rate}>"
+
+
+class DrugReportSketch(db.Model):
+    """
+    HyperLogLog sketch of the reports mentioning a drug product, stored as
+    zlib-compressed registers. Sketches of several products merge into an
+    estimate of the distinct reports mentioning any of them.
+    """
+    __tablename__ = 'drug_report_sketches'
+
+    drug_product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    registers = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        """
+        Returns a string representation of the DrugReportSketch instance.
+        """
+        return f"<DrugReportSketch {self.drug_product_id}>"
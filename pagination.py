@@ -0,0 +1,151 @@
+# pagination.py
+
+import base64
+import datetime
+import json
+import threading
+import time
+
+from sqlalchemy import and_, or_, select, func, text
+
+from models import db
+import snapshot
+
+
+def encode_cursor(values):
+    """
+    Encodes the sort-key values of a row into an opaque URL-safe cursor.
+    Dates are stored as ISO strings and restored by decode_cursor().
+    """
+    payload = []
+    for v in values:
+        if isinstance(v, datetime.date):
+            payload.append({'d': v.isoformat()})
+        else:
+            payload.append(v)
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """
+    Decodes a cursor produced by encode_cursor().
+    Returns None if the token is missing, malformed or has the wrong length.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        values = []
+        for v in payload:
+            if isinstance(v, dict):
+                v = datetime.date.fromisoformat(v['d'])
+            values.append(v)
+    except Exception:
+        return None
+    if not isinstance(payload, list) or len(values) != size:
+        return None
+    return values
+
+
+def keyset_condition(columns, values, descending):
+    """
+    Builds the WHERE clause selecting rows strictly after `values` in the
+    ordering given by `columns`. Written as nested OR/AND comparisons rather
+    than a row-value comparison so every backend can use a composite index.
+    """
+    conditions = []
+    for i, column in enumerate(columns):
+        equal_prefix = [columns[j] == values[j] for j in range(i)]
+        step = column < values[i] if descending else column > values[i]
+        conditions.append(and_(*equal_prefix, step))
+    return or_(*conditions)
+
+
+def keyset_page(query, columns, per_page, after=None, before=None, descending=True):
+    """
+    Fetches one page of an ORM query using keyset pagination.
+    `after` continues past the given sort-key values; `before` walks back
+    from them. Returns (rows, has_more_in_direction), with rows always in
+    the forward order.
+    """
+    if before is not None:
+        # Walk backwards by flipping the ordering, then restore it
+        q = query.filter(keyset_condition(columns, before, not descending))
+        order = [c.asc() if descending else c.desc() for c in columns]
+        rows = q.order_by(*order).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        return rows, has_more
+
+    q = query
+    if after is not None:
+        q = q.filter(keyset_condition(columns, after, descending))
+    order = [c.desc() if descending else c.asc() for c in columns]
+    rows = q.order_by(*order).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    return rows[:per_page], has_more
+
+
+class CountCache:
+    """
+    Small time-bounded cache for expensive row counts.
+    Listing pages reuse a count for `ttl` seconds instead of recounting on
+    every page view.
+    """
+
+    def __init__(self, ttl=300, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached count for `key`, calling `compute()` when missing or expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                return entry[0]
+        value = compute()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = (value, now + self.ttl)
+        return value
+
+    def clear(self):
+        """
+        Drops every cached count, e.g. after data has changed.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+def estimate_table_rows(model):
+    """
+    Returns a cheap row-count estimate for a whole table.
+    Uses the MySQL table statistics or, on a snapshot, the row counts
+    ANALYZE stored at export time, and an exact COUNT(*) otherwise.
+    """
+    engine = db.session.get_bind()
+    if snapshot.is_active():
+        count = snapshot.table_rows(model.__tablename__)
+        if count is not None:
+            return count
+    if engine.dialect.name == 'mysql':
+        row = db.session.execute(
+            text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :t"),
+            {'t': model.__tablename__}
+        ).first()
+        if row and row[0] is not None:
+            return int(row[0])
+    return db.session.execute(select(func.count()).select_from(model)).scalar() or 0
+
+
+# Shared cache for listing totals
+count_cache = CountCache()
@@ -0,0 +1,500 @@
+# partitions.py
+
+import collections
+import datetime
+import os
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, select, func, extract, inspect, text
+
+from models import (db, SafetyReport, Patient, Drug, Reaction, Company, DrugProduct, DrugProductAlias,
+                    ReportArchive)
+from caching import view_cache
+from pagination import keyset_condition, count_cache
+import rollups
+import dedup
+
+GRANULARITIES = ('year', 'quarter')
+
+# Catch-all MySQL partition for dates past the last named period
+FUTURE_PARTITION = 'pfuture'
+
+# Tables copied into an archive, parents first. Companies and the drug
+# dictionary are copied whole so the archive is self-contained.
+ARCHIVE_MODELS = [Company, DrugProduct, DrugProductAlias, SafetyReport, Patient, Drug, Reaction]
+
+# Report tables emptied of archived reports, children first
+REPORT_MODELS = [Patient, Drug, Reaction, SafetyReport]
+
+Partition = collections.namedtuple('Partition', ['name', 'lower', 'upper'])
+
+
+#########################
+# PERIODS
+#########################
+
+def period_start(day, granularity):
+    """
+    Returns the first day of the year or quarter containing `day`.
+    """
+    if granularity == 'quarter':
+        return datetime.date(day.year, 3 * ((day.month - 1) // 3) + 1, 1)
+    return datetime.date(day.year, 1, 1)
+
+
+def next_period(start, granularity):
+    """
+    Returns the first day of the period following the one starting at `start`.
+    """
+    if granularity == 'quarter':
+        month = start.month + 3
+        return datetime.date(start.year + (month > 12), (month - 1) % 12 + 1, 1)
+    return datetime.date(start.year + 1, 1, 1)
+
+
+def period_name(start, granularity):
+    """
+    Names a period the way its MySQL partition is named, e.g. p2019 or p2019q3.
+    """
+    if granularity == 'quarter':
+        return f"p{start.year}q{(start.month - 1) // 3 + 1}"
+    return f"p{start.year}"
+
+
+def periods_between(first, last, granularity):
+    """
+    Returns the partitions covering the dates `first` to `last`, oldest first.
+    """
+    parts = []
+    lower = period_start(first, granularity)
+    while lower <= last:
+        upper = next_period(lower, granularity)
+        parts.append(Partition(period_name(lower, granularity), lower, upper))
+        lower = upper
+    return parts
+
+
+#########################
+# QUERY ROUTER
+#########################
+
+class PartitionRouter:
+    """
+    Splits newest-first report listings into one query per year or quarter
+    of receivedate. Date filters prune the periods a listing visits; pages
+    are filled from the newest period backwards and stop as soon as they
+    are full. Filtered listings and OFFSET pages consult cached per-period
+    counts, so periods without a match are never queried and whole periods
+    before an offset are skipped. Every query carries an explicit
+    receivedate range, which MySQL uses for partition pruning once
+    `flask partitions apply` has partitioned safety_reports.
+    By default ('auto') the router is only enabled on such a natively
+    partitioned table: elsewhere a single keyset query over the
+    (receivedate, safetyreportid) index is cheaper than one per period.
+    """
+
+    def __init__(self):
+        self.setting = 'auto'
+        self.granularity = 'year'
+        self._enabled = None
+
+    def init_app(self, app):
+        """
+        Reads PARTITIONING_ENABLED ('1', '0' or 'auto') and
+        PARTITION_GRANULARITY from the config.
+        """
+        setting = str(app.config.get('PARTITIONING_ENABLED', 'auto')).lower()
+        self.setting = {'true': '1', 'false': '0'}.get(setting, setting)
+        self._enabled = {'1': True, '0': False}.get(self.setting)
+        self.granularity = app.config.get('PARTITION_GRANULARITY', 'year')
+        if self.granularity not in GRANULARITIES:
+            raise ValueError(f"PARTITION_GRANULARITY must be one of {', '.join(GRANULARITIES)}")
+
+    @property
+    def enabled(self):
+        """
+        Whether listings go through the router. With 'auto', checked once
+        against the database: only a natively partitioned MySQL table qualifies.
+        """
+        if self._enabled is None:
+            with db.engine.connect() as conn:
+                self._enabled = bool(native_partitions(conn))
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        self._enabled = value
+
+    def partitions(self, date_from=None, date_to=None, bind=None):
+        """
+        Returns the periods between the oldest and newest received report,
+        pruned to the given date range, newest first.
+        """
+        bind = bind or db.session
+        col = SafetyReport.receivedate
+        key = ('partition_range', view_cache.data_version())
+        (first, last) = count_cache.get_or_compute(
+            key, lambda: tuple(bind.execute(select(func.min(col), func.max(col))).one()))
+        if first is None:
+            return []
+        if date_from is not None:
+            first = max(first, date_from)
+        if date_to is not None:
+            last = min(last, date_to)
+        if first > last:
+            return []
+        return list(reversed(periods_between(first, last, self.granularity)))
+
+    def partition_counts(self, query, cache_key):
+        """
+        Returns {partition name: matching reports} for an ORM query over
+        SafetyReport, cached per data version under `cache_key`.
+        """
+        col = SafetyReport.receivedate
+        year = extract('year', col)
+        month = extract('month', col)
+
+        def compute():
+            counts = {}
+            for (y, m, n) in query.with_entities(year, month, func.count()).group_by(year, month):
+                start = period_start(datetime.date(int(y), int(m), 1), self.granularity)
+                name = period_name(start, self.granularity)
+                counts[name] = counts.get(name, 0) + n
+            return counts
+
+        key = ('partition_counts', view_cache.data_version(), self.granularity, cache_key)
+        return count_cache.get_or_compute(key, compute)
+
+    def page(self, query, columns, per_page, page=1, after=None, before=None,
+             date_from=None, date_to=None, cache_key=None, filtered=False):
+        """
+        Fetches one newest-first page of an ORM query over SafetyReport,
+        ordered by `columns` (receivedate first). Takes the same cursors as
+        pagination.keyset_page() and returns (rows, has_more_in_direction).
+        `cache_key` identifies the query's filters for the per-period
+        counts; with `filtered` they are used on every page to leave out
+        periods without matches, otherwise only by OFFSET pages.
+        """
+        col = columns[0]
+        parts = self.partitions(date_from, date_to)
+
+        counts = None
+        if filtered or (after is None and before is None and page > 1):
+            counts = self.partition_counts(query, cache_key)
+            parts = [p for p in parts if counts.get(p.name)]
+
+        def in_partition(p):
+            return query.filter(col >= p.lower, col < p.upper)
+
+        if before is not None:
+            # Walk back towards newer periods, then restore the ordering
+            rows = []
+            for p in reversed(parts):
+                if p.upper <= before[0]:
+                    continue
+                rows += (in_partition(p)
+                         .filter(keyset_condition(columns, before, False))
+                         .order_by(*[c.asc() for c in columns])
+                         .limit(per_page + 1 - len(rows))
+                         .all())
+                if len(rows) > per_page:
+                    break
+            return list(reversed(rows[:per_page])), len(rows) > per_page
+
+        skip = (page - 1) * per_page if after is None else 0
+        rows = []
+        for p in parts:
+            if after is not None and p.lower > after[0]:
+                continue
+            if skip:
+                # Whole periods before the requested offset are skipped by their count
+                n = counts.get(p.name, 0)
+                if skip >= n:
+                    skip -= n
+                    continue
+            q = in_partition(p)
+            if after is not None:
+                q = q.filter(keyset_condition(columns, after, True))
+            rows += (q.order_by(*[c.desc() for c in columns])
+                     .offset(skip)
+                     .limit(per_page + 1 - len(rows))
+                     .all())
+            skip = 0
+            if len(rows) > per_page:
+                break
+        return rows[:per_page], len(rows) > per_page
+
+
+# Shared router used by the report listings
+partition_router = PartitionRouter()
+
+
+#########################
+# MYSQL PARTITIONING
+#########################
+
+def native_partitions(bind):
+    """
+    Returns [(name, bound, approximate rows)] for the MySQL partitions of
+    safety_reports in order, or [] when the table is not partitioned.
+    """
+    if bind.dialect.name != 'mysql':
+        return []
+    rows = bind.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'safety_reports' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION")).all()
+    return [(name, bound.strip("'"), n) for (name, bound, n) in rows]
+
+
+def partition_clause(p):
+    return f"PARTITION {p.name} VALUES LESS THAN ('{p.upper.isoformat()}')"
+
+
+def future_clause():
+    return f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN (MAXVALUE)"
+
+
+def partitioning_ddl(bind, granularity, ahead=2):
+    """
+    Returns the statements partitioning safety_reports by RANGE COLUMNS
+    (receivedate), with named periods up to `ahead` periods past today.
+    MySQL requires the partitioning column in every unique key and does
+    not allow foreign keys on or to a partitioned table, so the primary key
+    becomes (safetyreportid, receivedate) and those foreign keys are
+    dropped; the ORM relationships do not depend on them.
+    """
+    insp = inspect(bind)
+    statements = []
+    for table in ('safety_reports', 'patients', 'drugs', 'reactions'):
+        for fk in insp.get_foreign_keys(table):
+            if table == 'safety_reports' or fk['referred_table'] == 'safety_reports':
+                statements.append(f"ALTER TABLE {table} DROP FOREIGN KEY {fk['name']}")
+    if 'receivedate' not in insp.get_pk_constraint('safety_reports')['constrained_columns']:
+        statements.append("ALTER TABLE safety_reports DROP PRIMARY KEY, "
+                          "ADD PRIMARY KEY (safetyreportid, receivedate)")
+
+    col = SafetyReport.receivedate
+    (first, last) = bind.execute(select(func.min(col), func.max(col))).one()
+    today = datetime.date.today()
+    first = first or today
+    last = max(last or today, today)
+    for _ in range(ahead):
+        last = next_period(period_start(last, granularity), granularity)
+    clauses = [partition_clause(p) for p in periods_between(first, last, granularity)] + [future_clause()]
+    statements.append("ALTER TABLE safety_reports PARTITION BY RANGE COLUMNS(receivedate) (\n  "
+                      + ",\n  ".join(clauses) + "\n)")
+    return statements
+
+
+def extend_ddl(bind, granularity, ahead=2):
+    """
+    Returns the statement splitting named periods up to `ahead` periods
+    past today out of the catch-all partition, or None if none are missing.
+    """
+    named = [(name, bound) for (name, bound, _) in native_partitions(bind) if name != FUTURE_PARTITION]
+    if not named:
+        return None
+    lower = datetime.date.fromisoformat(named[-1][1])
+    until = period_start(datetime.date.today(), granularity)
+    for _ in range(ahead):
+        until = next_period(until, granularity)
+    new = periods_between(lower, until, granularity) if lower <= until else []
+    if not new:
+        return None
+    clauses = [partition_clause(p) for p in new] + [future_clause()]
+    return (f"ALTER TABLE safety_reports REORGANIZE PARTITION {FUTURE_PARTITION} INTO (\n  "
+            + ",\n  ".join(clauses) + "\n)")
+
+
+def compact_ddl(bind, before):
+    """
+    Returns the statement merging every named partition ending on or
+    before `before` into a single partition, or None if fewer than two
+    qualify. Old periods are rarely queried on their own, so one partition
+    keeps the partition count (and per-query overhead) low.
+    """
+    old = [(name, bound) for (name, bound, _) in native_partitions(bind)
+           if name != FUTURE_PARTITION and datetime.date.fromisoformat(bound) <= before]
+    if len(old) < 2:
+        return None
+    names = ', '.join(name for (name, _) in old)
+    return (f"ALTER TABLE safety_reports REORGANIZE PARTITION {names} INTO "
+            f"(PARTITION pold VALUES LESS THAN ('{old[-1][1]}'))")
+
+
+#########################
+# ARCHIVING
+#########################
+
+def archive_reports(engine, before, path, drop=False, batch_size=5000):
+    """
+    Copies the reports received before `before`, with their patients,
+    drugs and reactions, into a new SQLite file at `path`, which is then
+    vacuumed and made read-only. With `drop`, the archived reports are
+    deleted from the live tables in batches of `batch_size` reports.
+    Returns the ReportArchive row describing the archive.
+    """
+    if os.path.exists(path):
+        raise click.ClickException(f"{path} already exists.")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    archived_ids = select(SafetyReport.safetyreportid).where(SafetyReport.receivedate < before)
+    archived_companies = select(SafetyReport.companynumb).where(SafetyReport.receivedate < before)
+
+    archive = create_engine(f"sqlite:///{path}")
+    tables = [model.__table__ for model in ARCHIVE_MODELS]
+    db.metadata.create_all(archive, tables=tables)
+    with engine.connect() as src, archive.begin() as dst:
+        for table in tables:
+            stmt = select(table)
+            if table is SafetyReport.__table__:
+                stmt = stmt.where(table.c.receivedate < before)
+            elif table is Company.__table__:
+                stmt = stmt.where(table.c.companynumb.in_(archived_companies))
+            elif 'safetyreportid' in table.c:
+                stmt = stmt.where(table.c.safetyreportid.in_(archived_ids))
+            result = src.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+            copied = 0
+            for rows in result.partitions():
+                dst.execute(table.insert(), [dict(r._mapping) for r in rows])
+                copied += len(rows)
+            click.echo(f"  {table.name}: {copied} rows")
+        (count, lower) = dst.execute(select(func.count(), func.min(SafetyReport.receivedate))).one()
+    with archive.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('ANALYZE')
+        conn.exec_driver_sql('VACUUM')
+    archive.dispose()
+    os.chmod(path, 0o444)
+
+    if drop:
+        deleted = 0
+        while True:
+            with engine.begin() as conn:
+                ids = conn.execute(archived_ids.limit(batch_size)).scalars().all()
+                if not ids:
+                    break
+                dedup.forget_reports(conn, ids)
+                for model in REPORT_MODELS:
+                    conn.execute(model.__table__.delete().where(model.__table__.c.safetyreportid.in_(ids)))
+            deleted += len(ids)
+            click.echo(f"  removed {deleted} of {count} reports from the live tables")
+
+    record = ReportArchive(path=os.path.abspath(path), lower=lower, upper=before, report_count=count,
+                           dropped=drop, created_at=datetime.datetime.utcnow())
+    db.session.add(record)
+    db.session.commit()
+    return record
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+partitions_cli = AppGroup('partitions', help="Partition, compact and archive the report tables by receive date.")
+
+
+def _execute_ddl(statements, dry_run):
+    for statement in statements:
+        click.echo(statement + ';')
+        if not dry_run:
+            with db.engine.begin() as conn:
+                conn.execute(text(statement))
+
+
+@partitions_cli.command('status')
+def status_command():
+    """
+    Shows the reports per period, the MySQL partitions and the archives.
+    """
+    granularity = partition_router.granularity
+    click.echo(f"Granularity: {granularity}")
+    counts = partition_router.partition_counts(SafetyReport.query, 'status')
+    for p in partition_router.partitions():
+        click.echo(f"  {p.name:<10} {p.lower} .. {p.upper}  {counts.get(p.name, 0)} reports")
+
+    with db.engine.connect() as conn:
+        native = native_partitions(conn)
+    if native:
+        click.echo("MySQL partitions of safety_reports:")
+        for (name, bound, n) in native:
+            click.echo(f"  {name:<10} < {bound}  ~{n} rows")
+    else:
+        click.echo("safety_reports is not natively partitioned.")
+
+    for archive in db.session.execute(select(ReportArchive).order_by(ReportArchive.upper)).scalars():
+        state = 'removed from live tables' if archive.dropped else 'still in live tables'
+        click.echo(f"Archive {archive.path}: {archive.report_count} reports "
+                   f"{archive.lower} .. {archive.upper} ({state})")
+
+
+@partitions_cli.command('apply')
+@click.option('--ahead', default=2, show_default=True, help="Empty periods to create past today.")
+@click.option('--dry-run', is_flag=True, help="Print the statements without running them.")
+def apply_command(ahead, dry_run):
+    """
+    Partitions safety_reports by receivedate on MySQL.
+    """
+    if db.engine.dialect.name != 'mysql':
+        raise click.ClickException("Native partitioning needs MySQL; on this backend the query "
+                                   "router prunes periods through the receivedate index.")
+    with db.engine.connect() as conn:
+        if native_partitions(conn):
+            raise click.ClickException("safety_reports is already partitioned; use 'flask partitions extend'.")
+        statements = partitioning_ddl(conn, partition_router.granularity, ahead)
+    _execute_ddl(statements, dry_run)
+
+
+@partitions_cli.command('extend')
+@click.option('--ahead', default=2, show_default=True, help="Empty periods to keep past today.")
+@click.option('--dry-run', is_flag=True, help="Print the statement without running it.")
+def extend_command(ahead, dry_run):
+    """
+    Adds upcoming periods to a partitioned safety_reports table.
+    """
+    with db.engine.connect() as conn:
+        statement = extend_ddl(conn, partition_router.granularity, ahead)
+    if statement is None:
+        click.echo("No periods to add.")
+        return
+    _execute_ddl([statement], dry_run)
+
+
+@partitions_cli.command('compact')
+@click.option('--before', required=True, type=click.DateTime(['%Y-%m-%d']), help="Merge periods ending by this date.")
+@click.option('--dry-run', is_flag=True, help="Print the statement without running it.")
+def compact_command(before, dry_run):
+    """
+    Merges old MySQL partitions of safety_reports into one.
+    """
+    with db.engine.connect() as conn:
+        statement = compact_ddl(conn, before.date())
+    if statement is None:
+        click.echo("Nothing to compact.")
+        return
+    _execute_ddl([statement], dry_run)
+
+
+@partitions_cli.command('archive')
+@click.option('--before', required=True, type=click.DateTime(['%Y-%m-%d']), help="Archive reports received before this date.")
+@click.option('--output', '-o', default=None, help="Archive file (defaults to PARTITION_ARCHIVE_DIR/reports-before-<date>.db).")
+@click.option('--drop', is_flag=True, help="Remove the archived reports from the live tables.")
+@click.option('--batch-size', default=5000, show_default=True, help="Reports copied or deleted per batch.")
+def archive_command(before, output, drop, batch_size):
+    """
+    Copies old reports into a read-only SQLite snapshot, optionally
+    removing them from the live tables so queries only touch recent data.
+    """
+    before = before.date()
+    path = output or os.path.join(current_app.config['PARTITION_ARCHIVE_DIR'], f"reports-before-{before}.db")
+    db.create_all()
+    record = archive_reports(db.engine, before, path, drop, batch_size)
+    if drop and record.report_count:
+        # Aggregates no longer include the archived reports
+        rollups.rebuild_all()
+        db.session.commit()
+        view_cache.bump_data_version()
+        click.echo("Rebuilt the rollup tables. Run 'flask signals compute', and 'flask columnar refresh' "
+                   "if a columnar store is in use, to drop the archived reports from them too.")
+    click.echo(f"Archived {record.report_count} reports to {record.path}")
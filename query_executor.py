@@ -0,0 +1,253 @@
+# query_executor.py
+
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection
+from sqlalchemy.pool import NullPool
+
+from models import db
+from instrumentation import instrumentation
+
+
+class QueryTimeout(Exception):
+    """
+    Raised when a statement is cancelled for running past its timeout.
+    """
+
+
+# Engines without a pool that send KILL QUERY, one per database URL
+_kill_engines = {}
+_kill_engines_lock = threading.Lock()
+
+
+def _kill_engine(engine):
+    """
+    Returns an engine for `engine`'s database that opens a new connection
+    each time, so a kill never waits on a pool its own statements saturate.
+    """
+    with _kill_engines_lock:
+        if engine.url not in _kill_engines:
+            _kill_engines[engine.url] = create_engine(engine.url, poolclass=NullPool)
+        return _kill_engines[engine.url]
+
+
+class RunningStatement:
+    """
+    Lets another thread cancel the statement running on a connection.
+    cancel() only reaches the connection while attach() holds it, so it
+    never interrupts a later statement of whoever uses the connection next;
+    cancelling before attach() makes attach() raise QueryTimeout.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._engine = None
+        self._dbapi_connection = None
+        self._kill_done = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def attach(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise QueryTimeout("Cancelled before it started")
+            self._engine = conn.engine
+            self._dbapi_connection = conn.connection.dbapi_connection
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._dbapi_connection = None
+                kill_done = self._kill_done
+            # Keep the connection out of the pool until a KILL in flight has landed
+            if kill_done is not None:
+                kill_done.wait()
+
+    def cancel(self):
+        """
+        Stops the statement, leaving the connection usable: SQLite
+        interrupts it, MySQL kills the query from a separate unpooled
+        connection, and drivers with a cancel() method (psycopg) use that.
+        """
+        with self._lock:
+            self.cancelled = True
+            dbapi_connection = self._dbapi_connection
+            if dbapi_connection is None:
+                return
+            engine = self._engine
+            if engine.dialect.name != 'mysql':
+                try:
+                    if engine.dialect.name == 'sqlite':
+                        dbapi_connection.interrupt()
+                    elif hasattr(dbapi_connection, 'cancel'):
+                        dbapi_connection.cancel()
+                except Exception:
+                    # The statement may have just finished, or the connection dropped
+                    pass
+                return
+            thread_id = int(dbapi_connection.thread_id())
+            self._kill_done = kill_done = threading.Event()
+
+        # Connecting can be slow, so the lock is not held meanwhile
+        try:
+            with _kill_engine(engine).connect() as conn:
+                conn.exec_driver_sql(f"KILL QUERY {thread_id}")
+        except Exception:
+            pass
+        finally:
+            kill_done.set()
+
+
+class QueryExecutor:
+    """
+    Runs independent read-only statements in parallel, each on its own
+    pooled connection, so a dashboard waits for its slowest query rather
+    than the sum of all of them.
+    Each statement has a timeout; one that misses it is cancelled on the
+    server and reported as failed while the others are still returned.
+    When the worker slots or the connection pool are exhausted, statements
+    run inline on the caller's connection instead of queueing behind other
+    requests.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_workers = 8
+        self.default_timeout = 10.0
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Reads the worker count and timeout from the application config.
+        """
+        self.enabled = app.config.get('QUERY_EXECUTOR_ENABLED', True)
+        self.max_workers = app.config.get('QUERY_EXECUTOR_WORKERS', 8)
+        self.default_timeout = app.config.get('QUERY_TIMEOUT_SECONDS', 10.0)
+
+    def _get_executor(self):
+        # Created lazily so worker threads never exist in a process before it forks
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='query-executor')
+                self._slots = threading.BoundedSemaphore(self.max_workers)
+            return self._executor
+
+    @staticmethod
+    def _pool_has_room(engine):
+        """
+        True if the engine's pool can hand out a connection without waiting.
+        """
+        pool = engine.pool
+        if not hasattr(pool, 'checkedout') or not hasattr(pool, 'size'):
+            return True
+        limit = pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+        return pool.checkedout() < limit
+
+    @staticmethod
+    def _execute(engine, statement, timeout, running):
+        """
+        Runs one statement on a fresh pooled connection and returns its rows,
+        registered with `running` so the caller can cancel it.
+        On MySQL the timeout is also enforced by the server.
+        """
+        with engine.connect() as conn, running.attach(conn):
+            if engine.dialect.name == 'mysql':
+                conn.exec_driver_sql(f"SET SESSION MAX_EXECUTION_TIME={int(timeout * 1000)}")
+                try:
+                    return conn.execute(statement).all()
+                finally:
+                    conn.exec_driver_sql("SET SESSION MAX_EXECUTION_TIME=0")
+            return conn.execute(statement).all()
+
+    def run(self, statements, bind=None, timeouts=None):
+        """
+        Executes a dict of name -> statement and returns (rows, failed):
+        rows maps each successful name to its result rows, and failed lists
+        the names that timed out or raised.
+        An explicit `bind` (e.g. a connection inside a transaction) runs
+        every statement on it in turn, so they see its uncommitted changes.
+        """
+        timeouts = timeouts or {}
+        rows = {}
+        failed = []
+        if bind is not None or not self.enabled or len(statements) < 2:
+            bind = bind or db.session
+            for (name, statement) in statements.items():
+                rows[name] = bind.execute(statement).all()
+            return rows, failed
+
+        # The replica serving this request when it is routed to one
+        engine = db.session.get_bind()
+        executor = self._get_executor()
+        futures = {}
+        inline = []
+        metrics = instrumentation.current_metrics()
+        for (name, statement) in statements.items():
+            timeout = timeouts.get(name, self.default_timeout)
+            if not self._pool_has_room(engine) or not self._slots.acquire(blocking=False):
+                inline.append(name)
+                continue
+
+            running = RunningStatement()
+
+            def task(statement=statement, timeout=timeout, running=running):
+                # Attribute the worker's queries to the calling request
+                try:
+                    with instrumentation.attach(metrics):
+                        return self._execute(engine, statement, timeout, running)
+                finally:
+                    self._slots.release()
+
+            futures[name] = (executor.submit(task), time.monotonic() + timeout, running)
+
+        # Saturated: run the remainder on the request's session meanwhile
+        for name in inline:
+            rows[name] = db.session.execute(statements[name]).all()
+
+        for (name, (future, deadline, running)) in futures.items():
+            try:
+                rows[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                # Free the worker and its pooled connection instead of abandoning them
+                failed.append(name)
+                running.cancel()
+            except Exception:
+                failed.append(name)
+        return rows, failed
+
+    def execute(self, statement, bind=None, timeout=None):
+        """
+        Runs one statement on `bind` (the request's session by default) and
+        returns its rows, cancelling it once `timeout` seconds (by default
+        QUERY_TIMEOUT_SECONDS) have passed. Raises QueryTimeout then.
+        """
+        timeout = timeout or self.default_timeout
+        bind = bind or db.session
+        if isinstance(bind, Connection):
+            conn = bind
+        else:
+            conn = bind.connection(bind_arguments={'clause': statement})
+        running = RunningStatement()
+        timer = threading.Timer(timeout, running.cancel)
+        timer.daemon = True
+        with running.attach(conn):
+            timer.start()
+            try:
+                return conn.execute(statement).all()
+            except Exception as e:
+                if running.cancelled:
+                    raise QueryTimeout(f"The query took longer than {timeout:g} seconds") from e
+                raise
+            finally:
+                timer.cancel()
+
+
+# Shared executor used by the dashboard queries
+query_executor = QueryExecutor()
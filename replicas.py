@@ -0,0 +1,181 @@
+# replicas.py
+
+import functools
+import itertools
+import threading
+import time
+
+from flask import g, has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+
+# Flask session key holding the end of the admin's read-your-writes window
+PRIMARY_UNTIL_KEY = '_db_primary_until'
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of views marked with use_replica() to read replicas,
+    round-robin over the replicas that pass a periodic health check.
+    Everything else (writes, flushes, unmarked views, CLI commands and
+    ingestion) stays on the primary. After a session commits writes, its
+    browser session reads from the primary for READ_YOUR_WRITES_SECONDS.
+    """
+
+    def __init__(self):
+        self.replica_keys = []
+        self.health_interval = 10.0
+        self.read_your_writes = 0.0
+        self._db = None
+        self._health = {}
+        self._checking = set()
+        self._cycle = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db):
+        """
+        Registers every URI in SQLALCHEMY_REPLICA_URIS as a 'replica_<n>'
+        bind. Must be called before db.init_app() so the engines get created.
+        """
+        self._db = db
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.replica_keys = []
+        for (i, uri) in enumerate(uris):
+            key = f'replica_{i}'
+            binds[key] = uri
+            self.replica_keys.append(key)
+            self._health[key] = (True, 0.0)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self._cycle = itertools.cycle(range(len(self.replica_keys)))
+        self.health_interval = app.config.get('REPLICA_HEALTH_CHECK_SECONDS', 10.0)
+        self.read_your_writes = app.config.get('READ_YOUR_WRITES_SECONDS', 0.0)
+        if self.replica_keys:
+            event.listen(Engine, 'handle_error', self._on_error)
+
+    def use_replica(self):
+        """
+        Decorator marking a view whose queries may be served by a replica.
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                g._db_use_replica = True
+                return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    #########################
+    # HEALTH
+    #########################
+
+    def mark_unhealthy(self, key):
+        """
+        Takes a replica out of rotation until its next health check.
+        """
+        self._health[key] = (False, time.monotonic())
+
+    def _on_error(self, context):
+        # A dropped connection takes its replica out of rotation right away
+        if not context.is_disconnect or context.engine is None or not has_request_context():
+            return
+        for key in self.replica_keys:
+            if self._db.engines[key] is context.engine:
+                self.mark_unhealthy(key)
+
+    def _check(self, key):
+        """
+        Pings a replica and records the outcome.
+        """
+        try:
+            with self._db.engines[key].connect() as conn:
+                conn.execute(text('SELECT 1'))
+            healthy = True
+        except Exception:
+            healthy = False
+        self._health[key] = (healthy, time.monotonic())
+        return healthy
+
+    def is_healthy(self, key):
+        """
+        Returns the replica's health, re-checking it once the last check is
+        older than the interval. Only one thread re-checks a given replica;
+        the others use the previous result meanwhile.
+        """
+        healthy, checked = self._health[key]
+        if time.monotonic() - checked < self.health_interval:
+            return healthy
+        with self._lock:
+            if key in self._checking:
+                return healthy
+            self._checking.add(key)
+        try:
+            return self._check(key)
+        finally:
+            with self._lock:
+                self._checking.discard(key)
+
+    #########################
+    # ROUTING
+    #########################
+
+    def in_read_your_writes_window(self):
+        return flask_session.get(PRIMARY_UNTIL_KEY, 0) > time.time()
+
+    def read_engine(self):
+        """
+        Returns the replica engine for the current request's reads, or None
+        when they should go to the primary. A request keeps the replica it
+        was first given, so all its reads see one consistent copy.
+        """
+        if not self.replica_keys or not has_request_context() or not g.get('_db_use_replica'):
+            return None
+        if '_db_replica_key' in g:
+            key = g._db_replica_key
+            return self._db.engines[key] if key else None
+        key = None
+        if not self.in_read_your_writes_window():
+            # Advance the rotation once per request, then fall through the
+            # others in order when the replica it lands on is unhealthy
+            with self._lock:
+                start = next(self._cycle)
+            n = len(self.replica_keys)
+            for i in range(n):
+                candidate = self.replica_keys[(start + i) % n]
+                if self.is_healthy(candidate):
+                    key = candidate
+                    break
+        g._db_replica_key = key
+        return self._db.engines[key] if key else None
+
+    def record_write(self):
+        """
+        Starts the read-your-writes window for the current browser session.
+        """
+        if self.read_your_writes and has_request_context():
+            flask_session[PRIMARY_UNTIL_KEY] = time.time() + self.read_your_writes
+
+
+class RoutingSession(Session):
+    """
+    Flask-SQLAlchemy session that routes SELECTs through the replica router.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and (clause is None or isinstance(clause, Select)):
+            engine = replica_router.read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    # Any flushed change means this visitor should read from the primary for a while
+    replica_router.record_write()
+
+
+# Shared router used by the models' session and the read-only views
+replica_router = ReplicaRouter()
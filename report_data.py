@@ -0,0 +1,83 @@
+# report_data.py
+
+import datetime
+import json
+
+from sqlalchemy import select
+
+from models import db, SafetyReport, Patient, Drug, Reaction, Company
+
+# Nested child lists of a report: key, model and columns
+CHILDREN = [
+    ('patients', Patient, ['patientagegroup', 'patientsex']),
+    ('drugs', Drug, ['drugcharacterization', 'medicinalproduct', 'drugstructuredosagenumb',
+                     'drugstructuredosageunit', 'drugdosagetext', 'drugdosageform',
+                     'drugadministrationroute', 'drugindication', 'actiondrug',
+                     'drugrecurreadministration', 'drugadditional', 'activesubstancename',
+                     'drug_product_id']),
+    ('reactions', Reaction, ['reactionmeddrapt', 'reactionoutcome']),
+]
+
+REPORT_COLUMNS = [c.name for c in SafetyReport.__table__.columns]
+
+
+def attach_children(conn, reports):
+    """
+    Fills the patients, drugs and reactions lists of report dictionaries
+    keyed by safetyreportid, with one IN query per child table.
+    Rows are read as plain tuples, without creating ORM objects.
+    """
+    ids = list(reports)
+    for report in reports.values():
+        for (key, _, _) in CHILDREN:
+            report[key] = []
+    for (key, model, names) in CHILDREN:
+        columns = [model.safetyreportid] + [getattr(model, n) for n in names]
+        child_rows = conn.execute(select(*columns)
+                                  .where(model.safetyreportid.in_(ids))
+                                  .order_by(model.id))
+        for child in child_rows:
+            reports[child[0]][key].append(dict(zip(names, child[1:])))
+    return reports
+
+
+def load_reports(ids, bind=None):
+    """
+    Loads reports with their company, patients, drugs and reactions as
+    nested dictionaries, in the order of `ids`. Unknown ids are skipped.
+    """
+    bind = bind or db.session
+    rows = bind.execute(select(SafetyReport.__table__, Company.companyname)
+                        .outerjoin(Company, Company.companynumb == SafetyReport.companynumb)
+                        .where(SafetyReport.safetyreportid.in_(ids))).all()
+    reports = {row.safetyreportid: dict(row._mapping) for row in rows}
+    if reports:
+        attach_children(bind, reports)
+    return [reports[i] for i in ids if i in reports]
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def compact(value):
+    """
+    Drops None values from report dictionaries and their child lists.
+    """
+    if isinstance(value, dict):
+        return {k: compact(v) for (k, v) in value.items() if v is not None}
+    if isinstance(value, list):
+        return [compact(v) for v in value]
+    return value
+
+
+def dumps(value, compact_output=False):
+    """
+    Serializes report dictionaries to JSON; dates become ISO strings.
+    `compact_output` also drops None values and insignificant whitespace.
+    """
+    if compact_output:
+        return json.dumps(compact(value), default=_json_default, separators=(',', ':'))
+    return json.dumps(value, default=_json_default)
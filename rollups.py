@@ -0,0 +1,330 @@
+# rollups.py
+
+import sys
+from collections import Counter
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, func, case, extract, bindparam, tuple_
+from sqlalchemy.dialects import mysql, sqlite
+
+from models import (db, SafetyReport, Drug, Patient, Reaction,
+                    DrugMonthRollup, DrugCountryRollup, DrugAgeGroupRollup,
+                    DrugSeriousnessRollup, DrugReactionRollup)
+from stats_engine import StatisticsResult, AGE_GROUP_LABELS, SERIOUS_CRITERIA, TOP_REACTIONS_LIMIT, sort_counts_desc
+
+# Report ids are processed in chunks of this size for IN lists
+ID_CHUNK_SIZE = 500
+
+# Rows are written to the rollup tables in batches of this size
+WRITE_BATCH_SIZE = 5000
+
+# Rollup model, its dimension columns and its counter column
+ROLLUP_TABLES = [
+    (DrugMonthRollup, ('yr', 'mo'), 'report_count'),
+    (DrugCountryRollup, ('country',), 'report_count'),
+    (DrugAgeGroupRollup, ('patientagegroup',), 'patient_count'),
+    (DrugSeriousnessRollup, ('criterion',), 'report_count'),
+    (DrugReactionRollup, ('reactionmeddrapt',), 'reaction_count'),
+]
+
+
+def drug_key_expr():
+    """
+    SQL expression producing the normalized drug key of a drugs row.
+    """
+    return func.lower(func.trim(Drug.medicinalproduct))
+
+
+def normalize_drug_key(value):
+    """
+    Python counterpart of drug_key_expr() for user input.
+    """
+    return (value or '').strip().lower()
+
+
+def _report_drug_pairs(report_ids=None):
+    """
+    Builds a subquery of distinct (safetyreportid, drug_key) pairs.
+    A report listing the same drug twice contributes a single pair.
+    """
+    stmt = select(Drug.safetyreportid.label('safetyreportid'), drug_key_expr().label('drug_key')).distinct()
+    if report_ids is not None:
+        stmt = stmt.where(Drug.safetyreportid.in_(report_ids))
+    return stmt.subquery('pairs')
+
+
+def _aggregate(bind, report_ids=None):
+    """
+    Computes rollup counts from the raw tables.
+    Covers every report when report_ids is None, otherwise only the given ones.
+    Returns {model: Counter({(drug_key, *dims): count})}.
+    """
+    pairs = _report_drug_pairs(report_ids)
+    key = pairs.c.drug_key
+    joined = pairs.join(SafetyReport, SafetyReport.safetyreportid == pairs.c.safetyreportid)
+    out = {model: Counter() for (model, _, _) in ROLLUP_TABLES}
+
+    yr = extract('year', SafetyReport.receivedate)
+    mo = extract('month', SafetyReport.receivedate)
+    for (k, y, m, c) in bind.execute(select(key, yr, mo, func.count()).select_from(joined).group_by(key, yr, mo)):
+        out[DrugMonthRollup][(k, int(y), int(m))] += int(c)
+
+    country = func.coalesce(SafetyReport.primarysource_reportercountry, '')
+    for (k, cc, c) in bind.execute(select(key, country, func.count()).select_from(joined).group_by(key, country)):
+        out[DrugCountryRollup][(k, cc)] += int(c)
+
+    age = func.coalesce(Patient.patientagegroup, 0)
+    age_join = pairs.join(Patient, Patient.safetyreportid == pairs.c.safetyreportid)
+    for (k, a, c) in bind.execute(select(key, age, func.count(Patient.id)).select_from(age_join).group_by(key, age)):
+        out[DrugAgeGroupRollup][(k, int(a))] += int(c)
+
+    criteria = [('total', None), ('serious', SafetyReport.serious == 1), ('non_serious', SafetyReport.serious != 1)]
+    criteria += [(column.key, column == 1) for (_, column) in SERIOUS_CRITERIA]
+    columns = [func.count() if cond is None else func.sum(case((cond, 1), else_=0)) for (_, cond) in criteria]
+    for row in bind.execute(select(key, *columns).select_from(joined).group_by(key)):
+        for (i, (name, _)) in enumerate(criteria):
+            if row[i + 1]:
+                out[DrugSeriousnessRollup][(row[0], name)] += int(row[i + 1])
+
+    reaction_join = pairs.join(Reaction, Reaction.safetyreportid == pairs.c.safetyreportid)
+    for (k, r, c) in bind.execute(select(key, Reaction.reactionmeddrapt, func.count(Reaction.id))
+                                  .select_from(reaction_join)
+                                  .group_by(key, Reaction.reactionmeddrapt)):
+        out[DrugReactionRollup][(k, r)] += int(c)
+
+    return out
+
+
+def collect_contributions(report_ids, bind=None):
+    """
+    Returns what the given reports currently contribute to each rollup table.
+    Call once before and once after changing the reports, then pass both
+    snapshots to apply_delta().
+    """
+    bind = bind or db.session
+    ids = sorted(set(i for i in report_ids if i is not None))
+    total = {model: Counter() for (model, _, _) in ROLLUP_TABLES}
+    for i in range(0, len(ids), ID_CHUNK_SIZE):
+        part = _aggregate(bind, ids[i:i + ID_CHUNK_SIZE])
+        for model in total:
+            total[model].update(part[model])
+    return total
+
+
+def apply_delta(before, after, bind=None):
+    """
+    Adjusts the stored rollup counters by (after - before).
+    Only the rows touched by the affected reports are written: each counter
+    is incremented in place (inserting missing rows), so concurrent writers
+    never overwrite each other's changes, and counters that drop to zero
+    are removed.
+    """
+    bind = bind or db.session
+    for (model, dims, counter_name) in ROLLUP_TABLES:
+        diff = Counter(after.get(model, {}))
+        diff.subtract(before.get(model, {}))
+        diff = {k: v for (k, v) in diff.items() if v}
+        if not diff:
+            continue
+
+        key_columns = [model.drug_key] + [getattr(model, d) for d in dims]
+        names = ['drug_key'] + list(dims)
+        rows = [dict(zip(names, k), **{counter_name: d}) for (k, d) in diff.items()]
+        for i in range(0, len(rows), WRITE_BATCH_SIZE):
+            _increment(bind, model, names, counter_name, rows[i:i + WRITE_BATCH_SIZE])
+
+        removals = [k for (k, d) in diff.items() if d < 0]
+        counter = getattr(model, counter_name)
+        for i in range(0, len(removals), ID_CHUNK_SIZE):
+            bind.execute(model.__table__.delete()
+                         .where(tuple_(*key_columns).in_(removals[i:i + ID_CHUNK_SIZE]))
+                         .where(counter <= 0))
+
+
+def _increment(bind, model, names, counter_name, rows):
+    """
+    Adds each row's counter value to the stored counter with the same key,
+    inserting the rows that do not exist yet.
+    """
+    table = model.__table__
+    counter = table.c[counter_name]
+    dialect = _dialect_name(bind, table.insert())
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update({counter_name: counter + stmt.inserted[counter_name]})
+        bind.execute(stmt, rows)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=names,
+                                          set_={counter_name: counter + stmt.excluded[counter_name]})
+        bind.execute(stmt, rows)
+    else:
+        stmt = (table.update()
+                .where(*[table.c[n] == bindparam('b_' + n) for n in names])
+                .values({counter_name: counter + bindparam('b_' + counter_name)}))
+        bind.execute(stmt, [{'b_' + k: v for (k, v) in r.items()} for r in rows])
+        key_columns = [table.c[n] for n in names]
+        keys = [tuple(r[n] for n in names) for r in rows]
+        existing = set(tuple(row) for row in bind.execute(select(*key_columns).where(tuple_(*key_columns).in_(keys))))
+        missing = [r for (k, r) in zip(keys, rows) if k not in existing]
+        if missing:
+            bind.execute(table.insert(), missing)
+
+
+def _dialect_name(bind, stmt):
+    # Sessions resolve their engine per statement, so ask with the write itself
+    if hasattr(bind, 'dialect'):
+        return bind.dialect.name
+    return bind.get_bind(clause=stmt).dialect.name
+
+
+def refresh_reports(report_ids, before, bind=None):
+    """
+    Convenience wrapper: collects the current contributions of the given
+    reports and applies the difference against an earlier snapshot.
+    """
+    after = collect_contributions(report_ids, bind)
+    apply_delta(before, after, bind)
+
+
+def rebuild_all(bind=None):
+    """
+    Recomputes every rollup table from scratch.
+    """
+    bind = bind or db.session
+    counts = _aggregate(bind)
+    for (model, dims, counter_name) in ROLLUP_TABLES:
+        bind.execute(model.__table__.delete())
+        names = ['drug_key'] + list(dims)
+        rows = [dict(zip(names, k), **{counter_name: v}) for (k, v) in counts[model].items()]
+        for i in range(0, len(rows), WRITE_BATCH_SIZE):
+            bind.execute(model.__table__.insert(), rows[i:i + WRITE_BATCH_SIZE])
+    return {model.__tablename__: len(counts[model]) for (model, _, _) in ROLLUP_TABLES}
+
+
+def verify_all(bind=None):
+    """
+    Compares the stored rollups against a fresh computation from the raw tables.
+    Returns {table_name: number_of_mismatched_rows}.
+    """
+    bind = bind or db.session
+    expected = _aggregate(bind)
+    mismatches = {}
+    for (model, dims, counter_name) in ROLLUP_TABLES:
+        key_columns = [model.drug_key] + [getattr(model, d) for d in dims]
+        stored = {tuple(row[:-1]): row[-1]
+                  for row in bind.execute(select(*key_columns, getattr(model, counter_name)))}
+        wanted = expected[model]
+        bad = sum(1 for k in set(stored) | set(wanted) if stored.get(k, 0) != wanted.get(k, 0))
+        mismatches[model.__tablename__] = bad
+    return mismatches
+
+
+def resolve_drug_key(drug_query, bind=None):
+    """
+    Returns the single rollup drug key matched by a substring query, or None
+    when the query matches no known drug or more than one. Results are only
+    exact when one key matches, since a report can mention several drugs.
+    """
+    bind = bind or db.session
+    q = normalize_drug_key(drug_query)
+    if not q:
+        return None
+    keys = bind.execute(
+        select(DrugSeriousnessRollup.drug_key)
+        .where(DrugSeriousnessRollup.criterion == 'total')
+        .where(DrugSeriousnessRollup.drug_key.like(f"%{q}%"))
+        .limit(2)
+    ).scalars().all()
+    if len(keys) != 1:
+        return None
+    return keys[0]
+
+
+def load_statistics(drug_query, bind=None):
+    """
+    Builds a StatisticsResult from the rollup tables.
+    Returns None when the query does not resolve to exactly one known drug,
+    in which case the caller should compute from the raw tables.
+    """
+    bind = bind or db.session
+    drug_key = resolve_drug_key(drug_query, bind)
+    if drug_key is None:
+        return None
+
+    seriousness = dict(bind.execute(
+        select(DrugSeriousnessRollup.criterion, DrugSeriousnessRollup.report_count)
+        .where(DrugSeriousnessRollup.drug_key == drug_key)
+    ).all())
+
+    monthly_data = {}
+    for (y, m, c) in bind.execute(select(DrugMonthRollup.yr, DrugMonthRollup.mo, DrugMonthRollup.report_count)
+                                  .where(DrugMonthRollup.drug_key == drug_key)
+                                  .order_by(DrugMonthRollup.yr, DrugMonthRollup.mo)):
+        monthly_data[f"{int(y)}-{int(m):02d}"] = int(c)
+
+    age_group_counts = {}
+    for (a, c) in bind.execute(select(DrugAgeGroupRollup.patientagegroup, DrugAgeGroupRollup.patient_count)
+                               .where(DrugAgeGroupRollup.drug_key == drug_key)):
+        label = AGE_GROUP_LABELS.get(a, "Unknown")
+        age_group_counts[label] = age_group_counts.get(label, 0) + int(c)
+
+    country_counts = {}
+    for (cc, c) in bind.execute(select(DrugCountryRollup.country, DrugCountryRollup.report_count)
+                                .where(DrugCountryRollup.drug_key == drug_key)):
+        label = cc if cc else "Unknown"
+        country_counts[label] = country_counts.get(label, 0) + int(c)
+
+    top_reactions = dict(bind.execute(
+        select(DrugReactionRollup.reactionmeddrapt, DrugReactionRollup.reaction_count)
+        .where(DrugReactionRollup.drug_key == drug_key)
+        .order_by(DrugReactionRollup.reaction_count.desc())
+        .limit(TOP_REACTIONS_LIMIT)
+    ).all())
+
+    serious_criteria_counts = {label: int(seriousness.get(column.key, 0)) for (label, column) in SERIOUS_CRITERIA}
+
+    return StatisticsResult(drug_query,
+                            total_reports=int(seriousness.get('total', 0)),
+                            monthly_data=monthly_data,
+                            age_group_counts=age_group_counts,
+                            seriousness_counts={
+                                "Serious": int(seriousness.get('serious', 0)),
+                                "Non-Serious": int(seriousness.get('non_serious', 0)),
+                            },
+                            serious_criteria_counts=sort_counts_desc(serious_criteria_counts),
+                            country_counts=sort_counts_desc(country_counts),
+                            top_reactions=sort_counts_desc(top_reactions))
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+rollups_cli = AppGroup('rollups', help="Maintain the per-drug rollup tables.")
+
+
+@rollups_cli.command('rebuild')
+def rebuild_command():
+    """
+    Rebuilds every rollup table from the raw report tables.
+    """
+    db.create_all()
+    sizes = rebuild_all()
+    db.session.commit()
+    for (name, n) in sizes.items():
+        click.echo(f"{name}: {n} rows")
+
+
+@rollups_cli.command('verify')
+def verify_command():
+    """
+    Checks the rollup tables against the raw report tables.
+    Exits with status 1 if any row differs.
+    """
+    mismatches = verify_all()
+    for (name, n) in mismatches.items():
+        click.echo(f"{name}: {'OK' if n == 0 else f'{n} mismatched rows'}")
+    if any(mismatches.values()):
+        sys.exit(1)
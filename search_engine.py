@@ -0,0 +1,248 @@
+# search_engine.py
+
+import datetime
+
+from sqlalchemy import select, func, case, literal, union_all
+
+from models import db, SafetyReport, Drug, Patient, Reaction
+from stats_engine import AGE_GROUP_LABELS, SERIOUS_CRITERIA
+from pagination import keyset_page
+from partitions import partition_router
+from dedup import canonical_only
+
+# Human-readable labels for the patientsex codes
+SEX_LABELS = {1: "Male", 2: "Female"}
+
+# Seriousness criteria selectable in the search form, keyed by column name
+CRITERIA_BY_KEY = {column.key: (label, column) for (label, column) in SERIOUS_CRITERIA}
+
+# Newest first, with the report id as a unique tie-breaker
+ORDER_COLUMNS = [SafetyReport.receivedate, SafetyReport.safetyreportid]
+
+
+def _parse_int(value, allowed):
+    """
+    Returns value as an int if it is one of `allowed`, else None.
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value in allowed else None
+
+
+def _parse_date(value):
+    """
+    Parses a YYYY-MM-DD string, returning None for anything else.
+    """
+    try:
+        return datetime.date.fromisoformat(value.strip())
+    except (AttributeError, ValueError):
+        return None
+
+
+def prefix_pattern(value):
+    """
+    Builds a LIKE pattern matching values that start with `value`.
+    Wildcards typed by the user are escaped, so the pattern stays a prefix
+    and the database can answer it with an index range scan.
+    """
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+class SearchFilters:
+    """
+    Filters accepted by the faceted search, parsed from request arguments.
+    Drug and reaction filters match names starting with the given text.
+    """
+
+    def __init__(self, drug='', reaction='', country='', date_from=None, date_to=None,
+                 serious=None, criteria=(), age_group=None, sex=None, dedup=False):
+        self.drug = drug
+        self.reaction = reaction
+        self.country = country
+        self.date_from = date_from
+        self.date_to = date_to
+        self.serious = serious
+        self.criteria = list(criteria)
+        self.age_group = age_group
+        self.sex = sex
+        # Leave out earlier versions of a case superseded by a newer report
+        self.dedup = dedup
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Builds filters from a request's query arguments, ignoring invalid values.
+        """
+        return cls(
+            drug=args.get('drug', '').strip(),
+            reaction=args.get('reaction', '').strip(),
+            country=args.get('country', '').strip().upper()[:2],
+            date_from=_parse_date(args.get('date_from')),
+            date_to=_parse_date(args.get('date_to')),
+            serious=_parse_int(args.get('serious'), (1, 2)),
+            criteria=[c for c in args.getlist('criteria') if c in CRITERIA_BY_KEY],
+            age_group=_parse_int(args.get('age_group'), AGE_GROUP_LABELS),
+            sex=_parse_int(args.get('sex'), SEX_LABELS),
+            dedup=args.get('dedup') == '1',
+        )
+
+    def to_args(self, **overrides):
+        """
+        Returns the non-empty filters as URL arguments, with `overrides`
+        applied (a value of None removes the argument).
+        """
+        args = {
+            'drug': self.drug,
+            'reaction': self.reaction,
+            'country': self.country,
+            'date_from': self.date_from.isoformat() if self.date_from else None,
+            'date_to': self.date_to.isoformat() if self.date_to else None,
+            'serious': self.serious,
+            'criteria': self.criteria,
+            'age_group': self.age_group,
+            'sex': self.sex,
+            'dedup': 1 if self.dedup else None,
+        }
+        args.update(overrides)
+        return {k: v for (k, v) in args.items() if v not in (None, '', [])}
+
+    def is_empty(self):
+        return not self.to_args()
+
+    def conditions(self):
+        """
+        Returns the WHERE conditions on SafetyReport for these filters.
+        Child-table filters are semi-joins on (value, safetyreportid) indexes.
+        """
+        conds = []
+        if self.drug:
+            conds.append(SafetyReport.safetyreportid.in_(
+                select(Drug.safetyreportid).where(Drug.medicinalproduct.like(prefix_pattern(self.drug), escape='\\'))
+            ))
+        if self.reaction:
+            conds.append(SafetyReport.safetyreportid.in_(
+                select(Reaction.safetyreportid)
+                .where(Reaction.reactionmeddrapt.like(prefix_pattern(self.reaction), escape='\\'))
+            ))
+        if self.country:
+            conds.append(SafetyReport.primarysource_reportercountry == self.country)
+        if self.date_from:
+            conds.append(SafetyReport.receivedate >= self.date_from)
+        if self.date_to:
+            conds.append(SafetyReport.receivedate <= self.date_to)
+        if self.serious is not None:
+            conds.append(SafetyReport.serious == self.serious)
+        for key in self.criteria:
+            conds.append(CRITERIA_BY_KEY[key][1] == 1)
+        if self.age_group is not None:
+            conds.append(SafetyReport.safetyreportid.in_(
+                select(Patient.safetyreportid).where(Patient.patientagegroup == self.age_group)
+            ))
+        if self.sex is not None:
+            conds.append(SafetyReport.safetyreportid.in_(
+                select(Patient.safetyreportid).where(Patient.patientsex == self.sex)
+            ))
+        if self.dedup:
+            conds.append(canonical_only(SafetyReport.safetyreportid))
+        return conds
+
+
+class Facets:
+    """
+    Counts of the matching reports broken down by each filterable field.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.serious = {1: 0, 2: 0}
+        self.criteria = []
+        self.countries = []
+        self.age_groups = []
+        self.sexes = []
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'serious': {'Serious': self.serious[1], 'Non-Serious': self.serious[2]},
+            'criteria': {key: count for (key, _, count) in self.criteria},
+            'countries': {code or 'Unknown': count for (code, count) in self.countries},
+            'age_groups': {label: count for (_, label, count) in self.age_groups},
+            'sexes': {label: count for (_, label, count) in self.sexes},
+        }
+
+
+def compute_facets(conditions, bind=None):
+    """
+    Computes every facet for the filtered report set in two statements:
+    one grouped pass over safety_reports (countries, seriousness and
+    criteria as conditional sums) and one UNION ALL over patients (age
+    group and sex, counting distinct reports).
+    """
+    bind = bind or db.session
+    facets = Facets()
+
+    country = func.coalesce(SafetyReport.primarysource_reportercountry, '')
+    columns = [
+        country.label('country'),
+        func.count().label('n'),
+        func.sum(case((SafetyReport.serious == 1, 1), else_=0)).label('serious'),
+    ] + [func.sum(case((column == 1, 1), else_=0)) for (_, column) in SERIOUS_CRITERIA]
+    rows = bind.execute(select(*columns).where(*conditions).group_by(country)).all()
+
+    criteria_totals = [0] * len(SERIOUS_CRITERIA)
+    for row in rows:
+        n = int(row[1])
+        facets.total += n
+        facets.serious[1] += int(row[2] or 0)
+        facets.countries.append((row[0], n))
+        for i in range(len(SERIOUS_CRITERIA)):
+            criteria_totals[i] += int(row[3 + i] or 0)
+    facets.serious[2] = facets.total - facets.serious[1]
+    facets.countries.sort(key=lambda x: (-x[1], x[0]))
+    facets.criteria = [(column.key, label, count)
+                       for ((label, column), count) in zip(SERIOUS_CRITERIA, criteria_totals)]
+
+    if facets.total == 0:
+        return facets
+
+    report_ids = select(SafetyReport.safetyreportid).where(*conditions)
+    patient_counts = func.count(func.distinct(Patient.safetyreportid))
+    age = (select(literal('age').label('facet'), Patient.patientagegroup.label('code'), patient_counts)
+           .where(Patient.safetyreportid.in_(report_ids))
+           .group_by(Patient.patientagegroup))
+    sex = (select(literal('sex').label('facet'), Patient.patientsex.label('code'), patient_counts)
+           .where(Patient.safetyreportid.in_(report_ids))
+           .group_by(Patient.patientsex))
+    for (facet, code, count) in bind.execute(union_all(age, sex)).all():
+        if facet == 'age':
+            facets.age_groups.append((code, AGE_GROUP_LABELS.get(code, "Unknown"), int(count)))
+        else:
+            facets.sexes.append((code, SEX_LABELS.get(code, "Unknown"), int(count)))
+    facets.age_groups.sort(key=lambda x: -x[2])
+    facets.sexes.sort(key=lambda x: -x[2])
+    return facets
+
+
+def search_reports(filters, per_page, page=1, after=None, before=None):
+    """
+    Returns (reports, has_more) for one page of matching reports, newest
+    first. `after`/`before` are keyset cursors; without one the page number
+    is used as an OFFSET.
+    """
+    conditions = filters.conditions()
+    q = SafetyReport.query.filter(*conditions)
+    if partition_router.enabled:
+        return partition_router.page(q, ORDER_COLUMNS, per_page, page, after, before,
+                                     date_from=filters.date_from, date_to=filters.date_to,
+                                     cache_key=('search', repr(sorted(filters.to_args().items()))),
+                                     filtered=bool(conditions))
+    if before is not None or after is not None:
+        return keyset_page(q, ORDER_COLUMNS, per_page, after=after, before=before)
+    reports = (q.order_by(*[c.desc() for c in ORDER_COLUMNS])
+               .offset((page - 1) * per_page)
+               .limit(per_page + 1)
+               .all())
+    return reports[:per_page], len(reports) > per_page
@@ -0,0 +1,279 @@
+# signal_detection.py
+
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, func, inspect
+
+from models import db, Drug, Reaction, SignalScore
+from rollups import drug_key_expr
+import dedup
+from caching import view_cache
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# Pairs seen in fewer reports than this are not stored
+DEFAULT_MIN_COUNT = 3
+
+# Rows fetched per round trip while loading pairs and written per INSERT batch
+FETCH_BATCH_SIZE = 50000
+WRITE_BATCH_SIZE = 10000
+
+# z value for the 95% ROR confidence interval
+Z_95 = 1.96
+
+# Columns the /signals listing may be sorted by
+SORTABLE_COLUMNS = {
+    'a': SignalScore.a,
+    'prr': SignalScore.prr,
+    'ror': SignalScore.ror,
+    'ror_lower': SignalScore.ror_lower,
+    'ic': SignalScore.ic,
+    'ic025': SignalScore.ic025,
+}
+
+
+class Encoder:
+    """
+    Assigns consecutive integer codes to distinct values.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = len(self.values)
+            self.codes[value] = c
+            self.values.append(value)
+        return c
+
+
+def load_pairs(stmt, report_codes, item_codes):
+    """
+    Streams distinct (safetyreportid, item) rows into two int32 code arrays.
+    """
+    rows_out = []
+    cols_out = []
+    result = db.session.execute(stmt.execution_options(yield_per=FETCH_BATCH_SIZE))
+    for part in result.partitions():
+        rows_out.append(np.fromiter((report_codes.code(r[0]) for r in part), dtype=np.int32, count=len(part)))
+        cols_out.append(np.fromiter((item_codes.code(r[1]) for r in part), dtype=np.int32, count=len(part)))
+    if not rows_out:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    return np.concatenate(rows_out), np.concatenate(cols_out)
+
+
+def build_contingency(deduplicated=False):
+    """
+    Builds report x drug and report x reaction incidence matrices and
+    returns (drug_names, reaction_names, a, n_drug, n_reaction, n_reports),
+    where `a` is the sparse drug x reaction co-report count matrix.
+    Only reports with at least one drug and one reaction are counted, and
+    with `deduplicated`, only those not superseded by a later case version.
+    """
+    # Imported here: scipy is only needed while scores are recomputed
+    from scipy import sparse
+
+    report_codes = Encoder()
+    drug_codes = Encoder()
+    reaction_codes = Encoder()
+
+    drug_pairs = select(Drug.safetyreportid, drug_key_expr()).distinct()
+    reaction_pairs = select(Reaction.safetyreportid, Reaction.reactionmeddrapt).distinct()
+    if deduplicated:
+        drug_pairs = drug_pairs.where(dedup.canonical_only(Drug.safetyreportid))
+        reaction_pairs = reaction_pairs.where(dedup.canonical_only(Reaction.safetyreportid))
+    drug_rows, drug_cols = load_pairs(drug_pairs, report_codes, drug_codes)
+    reaction_rows, reaction_cols = load_pairs(reaction_pairs, report_codes, reaction_codes)
+
+    n_all = len(report_codes.values)
+    D = sparse.csr_matrix((np.ones(len(drug_rows), dtype=np.int32), (drug_rows, drug_cols)),
+                          shape=(n_all, len(drug_codes.values)))
+    R = sparse.csr_matrix((np.ones(len(reaction_rows), dtype=np.int32), (reaction_rows, reaction_cols)),
+                          shape=(n_all, len(reaction_codes.values)))
+    # Distinct pairs were requested, but clamp anyway so counts stay per report
+    D.data[:] = 1
+    R.data[:] = 1
+
+    keep = (D.getnnz(axis=1) > 0) & (R.getnnz(axis=1) > 0)
+    D = D[keep]
+    R = R[keep]
+
+    a = (D.T @ R).tocoo()
+    n_drug = np.asarray(D.sum(axis=0)).ravel()
+    n_reaction = np.asarray(R.sum(axis=0)).ravel()
+    return drug_codes.values, reaction_codes.values, a, n_drug, n_reaction, int(keep.sum())
+
+
+def score_pairs(a, n_drug_pair, n_reaction_pair, n_reports):
+    """
+    Computes PRR, ROR with 95% CI and the information component for arrays of
+    pairs in one vectorized pass.
+    `a` is the count of reports with both the drug and the reaction,
+    `n_drug_pair`/`n_reaction_pair` the report counts of each pair's drug and
+    reaction, and `n_reports` the total. Undefined ratios are returned as NaN.
+    """
+    a = a.astype(np.float64)
+    b = n_drug_pair - a
+    c = n_reaction_pair - a
+    d = n_reports - a - b - c
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prr = (a / (a + b)) / (c / (c + d))
+        prr[~np.isfinite(prr)] = np.nan
+
+        # Haldane correction for tables with an empty cell
+        zero = (b == 0) | (c == 0) | (d == 0)
+        ha, hb, hc, hd = (np.where(zero, x + 0.5, x) for x in (a, b, c, d))
+        ror = (ha * hd) / (hb * hc)
+        se = np.sqrt(1 / ha + 1 / hb + 1 / hc + 1 / hd)
+        log_ror = np.log(ror)
+        ror_lower = np.exp(log_ror - Z_95 * se)
+        ror_upper = np.exp(log_ror + Z_95 * se)
+
+        # Information component with the usual +0.5 shrinkage and its
+        # closed-form credibility interval approximation
+        expected = (a + b) * (a + c) / n_reports
+        ic = np.log2((a + 0.5) / (expected + 0.5))
+        ic025 = ic - 3.3 * (a + 0.5) ** -0.5 - 2.0 * (a + 0.5) ** -1.5
+        ic975 = ic + 2.4 * (a + 0.5) ** -0.5 - 0.5 * (a + 0.5) ** -1.5
+
+    return {
+        'b': b, 'c': c, 'd': d,
+        'prr': prr, 'ror': ror, 'ror_lower': ror_lower, 'ror_upper': ror_upper,
+        'ic': ic, 'ic025': ic025, 'ic975': ic975,
+    }
+
+
+def _nullable(values):
+    """
+    Converts an array of scores to a list, with NaN/inf replaced by None.
+    """
+    return [v if np.isfinite(v) else None for v in values.tolist()]
+
+
+def compute_signals(min_count=DEFAULT_MIN_COUNT, deduplicated=False):
+    """
+    Recomputes the signal_scores rows for every drug-reaction pair seen in
+    at least `min_count` reports, over all reports or, with `deduplicated`,
+    counting each case once. Returns the number of stored pairs.
+    """
+    drug_names, reaction_names, a, n_drug, n_reaction, n_reports = build_contingency(deduplicated)
+    keep = a.data >= min_count
+    drug_idx = a.row[keep]
+    reaction_idx = a.col[keep]
+    counts = a.data[keep]
+    scores = score_pairs(counts, n_drug[drug_idx], n_reaction[reaction_idx], n_reports)
+
+    # Convert whole columns at once rather than element by element
+    columns = {
+        'drug_key': [drug_names[i] for i in drug_idx.tolist()],
+        'reactionmeddrapt': [reaction_names[i] for i in reaction_idx.tolist()],
+        'deduplicated': [deduplicated] * len(counts),
+        'a': counts.tolist(),
+        'b': scores['b'].astype(np.int64).tolist(),
+        'c': scores['c'].astype(np.int64).tolist(),
+        'd': scores['d'].astype(np.int64).tolist(),
+    }
+    for name in ('prr', 'ror', 'ror_lower', 'ror_upper', 'ic', 'ic025', 'ic975'):
+        columns[name] = _nullable(scores[name])
+    names = list(columns)
+
+    table = SignalScore.__table__
+    db.session.execute(table.delete().where(table.c.deduplicated == deduplicated))
+    for start in range(0, len(counts), WRITE_BATCH_SIZE):
+        end = start + WRITE_BATCH_SIZE
+        batch = [dict(zip(names, values)) for values in zip(*(columns[n][start:end] for n in names))]
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+    return len(counts)
+
+
+def query_signals(drug='', reaction='', min_count=DEFAULT_MIN_COUNT, min_prr=None, min_ror_lower=None,
+                  min_ic025=None, sort='ror_lower', descending=True, page=1, per_page=50, deduplicated=False):
+    """
+    Filters and sorts stored signal scores, from the deduplicated variant
+    with `deduplicated`.
+    Returns (rows, total_count) where rows are SignalScore instances.
+    """
+    q = SignalScore.query.filter(SignalScore.deduplicated == deduplicated)
+    if drug:
+        q = q.filter(SignalScore.drug_key.like(f"%{drug.strip().lower()}%"))
+    if reaction:
+        q = q.filter(SignalScore.reactionmeddrapt.ilike(f"%{reaction.strip()}%"))
+    if min_count:
+        q = q.filter(SignalScore.a >= min_count)
+    if min_prr is not None:
+        q = q.filter(SignalScore.prr >= min_prr)
+    if min_ror_lower is not None:
+        q = q.filter(SignalScore.ror_lower >= min_ror_lower)
+    if min_ic025 is not None:
+        q = q.filter(SignalScore.ic025 >= min_ic025)
+
+    total = q.with_entities(func.count()).scalar()
+    column = SORTABLE_COLUMNS.get(sort, SignalScore.ror_lower)
+    q = q.order_by(column.desc() if descending else column.asc(),
+                   SignalScore.drug_key, SignalScore.reactionmeddrapt)
+    rows = q.offset((page - 1) * per_page).limit(per_page).all()
+    return rows, total
+
+
+def signal_to_dict(s):
+    """
+    Serializes a SignalScore row for the JSON API.
+    """
+    return {
+        'drug': s.drug_key,
+        'reaction': s.reactionmeddrapt,
+        'a': s.a, 'b': s.b, 'c': s.c, 'd': s.d,
+        'prr': s.prr,
+        'ror': s.ror,
+        'ror_ci': [s.ror_lower, s.ror_upper],
+        'ic': s.ic,
+        'ic_ci': [s.ic025, s.ic975],
+    }
+
+
+def rebuild_scores_table(bind):
+    """
+    Recreates signal_scores when its primary key predates the deduplicated
+    variant. The scores are derived data, so they are dropped rather than
+    migrated and 'flask signals compute' fills the table again.
+    """
+    table = SignalScore.__table__
+    insp = inspect(bind)
+    if not insp.has_table(table.name):
+        return
+    if 'deduplicated' in insp.get_pk_constraint(table.name)['constrained_columns']:
+        return
+    table.drop(bind)
+    table.create(bind)
+    click.echo("  recreated signal_scores; run 'flask signals compute' to fill it")
+
+
+#########################
+# CLI COMMANDS
+#########################
+
+signals_cli = AppGroup('signals', help="Compute drug-reaction disproportionality signals.")
+
+
+@signals_cli.command('compute')
+@click.option('--min-count', default=DEFAULT_MIN_COUNT, show_default=True,
+              help="Minimum number of co-reports for a pair to be stored.")
+def compute_command(min_count):
+    """
+    Recomputes PRR, ROR and IC for every drug-reaction pair, over all
+    reports and over deduplicated cases.
+    """
+    db.create_all()
+    started = time.monotonic()
+    n = compute_signals(min_count)
+    n_dedup = compute_signals(min_count, deduplicated=True)
+    view_cache.bump_data_version()
+    click.echo(f"Stored {n} drug-reaction pairs ({n_dedup} deduplicated) in {time.monotonic() - started:.1f}s")
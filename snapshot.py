@@ -0,0 +1,350 @@
+# snapshot.py
+
+import datetime
+import os
+import time
+
+import click
+from flask import current_app, has_app_context, request, jsonify
+from flask.cli import AppGroup
+from sqlalchemy import create_engine, event, select, func, text, MetaData, Table, Column, Integer, String, Text
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from models import (db, SafetyReport, Patient, Reaction, Drug, Company, DrugProduct, DrugProductAlias,
+                    DrugMonthRollup, DrugCountryRollup, DrugAgeGroupRollup, DrugSeriousnessRollup,
+                    DrugReactionRollup, SignalScore, DrugPairCount, InteractionSignal, ReportCluster,
+                    ReportSample, SampleStratum, DrugReportSketch)
+
+# Tables whose rows are copied into a snapshot. Every other table of the
+# schema is created empty, so the read routes querying them still work.
+SNAPSHOT_MODELS = [
+    Company, SafetyReport, Patient, Drug, Reaction,
+    DrugProduct, DrugProductAlias,
+    DrugMonthRollup, DrugCountryRollup, DrugAgeGroupRollup, DrugSeriousnessRollup, DrugReactionRollup,
+    SignalScore, DrugPairCount, InteractionSignal, ReportCluster,
+    ReportSample, SampleStratum, DrugReportSketch,
+]
+
+# Admin endpoints that write to the database, refused while serving a snapshot
+WRITE_ENDPOINTS = {
+    'admin_compute_signals', 'admin_compute_interactions', 'admin_update',
+    'admin_bulk_update', 'admin_bulk_delete', 'admin_bulk_edit', 'admin_bulk_import',
+}
+
+# Rows fetched from the source and inserted per batch
+DEFAULT_BATCH_SIZE = 20000
+
+# Larger pages mean fewer, longer reads for the range scans of a read-only file
+DEFAULT_PAGE_SIZE = 16384
+
+# Tables that only exist in snapshots
+snapshot_metadata = MetaData()
+
+# Export details and per-table row counts
+snapshot_info = Table(
+    'snapshot_info', snapshot_metadata,
+    Column('key', String(50), primary_key=True),
+    Column('value', Text, nullable=False),
+)
+
+# The autocomplete vocabulary (see suggestions.py), counted at export time
+snapshot_vocabulary = Table(
+    'snapshot_vocabulary', snapshot_metadata,
+    Column('name', String(255), nullable=False),
+    Column('n', Integer, nullable=False),
+)
+
+# Trigram full-text index over the drug spellings, created with
+# CREATE VIRTUAL TABLE; declared here so queries can refer to it
+drug_alias_fts = Table(
+    'drug_alias_fts', snapshot_metadata,
+    Column('alias', String(255)),
+    Column('drug_product_id', Integer),
+)
+
+
+#########################
+# SERVING A SNAPSHOT
+#########################
+
+def snapshot_uri(path):
+    """
+    Returns the SQLAlchemy URI opening a snapshot read-only. `immutable`
+    tells SQLite the file cannot change, so it takes no locks and keeps
+    no change counters.
+    """
+    return f"sqlite:///file:{os.path.abspath(path)}?mode=ro&immutable=1&uri=true"
+
+
+def is_active():
+    """
+    Whether the current application serves a snapshot.
+    """
+    return has_app_context() and current_app.config.get('DATABASE_BACKEND') == 'snapshot'
+
+
+def init_app(app):
+    """
+    Points the application at the snapshot file when DATABASE_BACKEND is
+    'snapshot'. Must run before db.init_app(). Features that write to the
+    database (background jobs) and read replicas are turned off, and the
+    admin endpoints in WRITE_ENDPOINTS and requests for background jobs
+    answer 403.
+    """
+    if app.config.get('DATABASE_BACKEND', 'mysql') != 'snapshot':
+        return
+    path = app.config['SNAPSHOT_PATH']
+    if not os.path.exists(path):
+        raise RuntimeError(f"DATABASE_BACKEND is 'snapshot' but {path} does not exist; "
+                           f"write one with 'flask snapshot export'.")
+    app.config['SQLALCHEMY_DATABASE_URI'] = snapshot_uri(path)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['SQLALCHEMY_ENGINE_OPTIONS'].get('pool_size', 10),
+        'max_overflow': app.config['SQLALCHEMY_ENGINE_OPTIONS'].get('max_overflow', 20),
+        # Pooled connections are handed to the query executor's threads
+        'connect_args': {'check_same_thread': False},
+    }
+    app.config['SQLALCHEMY_REPLICA_URIS'] = []
+    app.config['JOBS_ENABLED'] = False
+    mmap_bytes = app.config.get('SNAPSHOT_MMAP_BYTES', 0)
+    cache_kib = app.config.get('SNAPSHOT_CACHE_KIB', 65536)
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA query_only = ON')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.execute(f'PRAGMA cache_size = -{int(cache_kib)}')
+        if mmap_bytes:
+            # Pages are read straight from the OS page cache, shared by all workers
+            cursor.execute(f"PRAGMA mmap_size = {int(mmap_bytes)}")
+        cursor.close()
+
+    app.extensions['snapshot_on_connect'] = on_connect
+
+    @app.before_request
+    def refuse_writes():
+        # Background requests (e.g. /export?background=1) would store a job row
+        if request.endpoint in WRITE_ENDPOINTS or request.args.get('background') == '1':
+            return jsonify({"error": "This server is serving a read-only snapshot."}), 403
+
+
+def attach_engine_events(app):
+    """
+    Installs the snapshot connection settings on the application's engine.
+    Called after db.init_app().
+    """
+    on_connect = app.extensions.get('snapshot_on_connect')
+    if on_connect is None:
+        return
+    with app.app_context():
+        event.listen(db.engine, 'connect', on_connect)
+
+
+def fts_available(bind=None):
+    """
+    Whether the drug spelling trigram index exists; only snapshots have it.
+    """
+    if not is_active():
+        return False
+    state = current_app.extensions.setdefault('snapshot_fts', {})
+    if 'available' not in state:
+        bind = bind or db.session
+        state['available'] = bind.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'drug_alias_fts'")).first() is not None
+    return state['available']
+
+
+def vocabulary_rows(bind=None):
+    """
+    Returns the (name, count) rows of the autocomplete vocabulary stored in
+    the snapshot, or None when not serving a snapshot.
+    """
+    if not is_active():
+        return None
+    bind = bind or db.session
+    return bind.execute(select(snapshot_vocabulary.c.name, snapshot_vocabulary.c.n)).all()
+
+
+def info(bind=None):
+    """
+    Returns the snapshot's export details as a dictionary.
+    """
+    bind = bind or db.session
+    return dict(bind.execute(select(snapshot_info.c.key, snapshot_info.c.value)).all())
+
+
+def table_rows(table_name):
+    """
+    Returns the number of rows exported for a table, or None if it was
+    created empty. Snapshots never change, so the details are read once.
+    """
+    details = current_app.extensions.get('snapshot_info')
+    if details is None:
+        details = current_app.extensions['snapshot_info'] = info()
+    count = details.get(f'rows.{table_name}')
+    return int(count) if count is not None else None
+
+
+#########################
+# WRITING A SNAPSHOT
+#########################
+
+def _snapshot_tables():
+    """
+    Returns the schema's tables copied into a separate MetaData. Tables
+    with a non-integer or composite primary key are stored WITHOUT ROWID,
+    so their rows are clustered by primary key and need no second index.
+    """
+    meta = MetaData()
+    tables = []
+    for table in db.metadata.sorted_tables:
+        copy = table.to_metadata(meta)
+        pk = list(copy.primary_key.columns)
+        if len(pk) > 1 or not isinstance(pk[0].type, Integer):
+            copy.dialect_options['sqlite']['with_rowid'] = False
+        tables.append(copy)
+    return tables
+
+
+def _vocabulary_rows(src):
+    """
+    Counts the autocomplete vocabulary the way suggestions.py does from a
+    live database with a populated drug dictionary.
+    """
+    counts = (select(Drug.drug_product_id, func.count(Drug.id).label('n'))
+              .group_by(Drug.drug_product_id)
+              .subquery())
+    products = src.execute(select(DrugProduct.display_name, counts.c.n)
+                           .join(counts, counts.c.drug_product_id == DrugProduct.id)).all()
+    unlinked = src.execute(select(Drug.medicinalproduct, func.count(Drug.id))
+                           .where(Drug.drug_product_id.is_(None))
+                           .group_by(Drug.medicinalproduct)).all()
+    substances = src.execute(select(Drug.activesubstancename, func.count(Drug.id))
+                             .where(Drug.activesubstancename.isnot(None))
+                             .group_by(Drug.activesubstancename)).all()
+    return [{'name': name, 'n': n} for (name, n) in products + unlinked + substances if name]
+
+
+def export_snapshot(engine, path, batch_size=DEFAULT_BATCH_SIZE, page_size=DEFAULT_PAGE_SIZE, fts=True,
+                    echo=click.echo):
+    """
+    Writes a read-only SQLite snapshot of the database behind `engine` to
+    `path`: the report tables with the drug dictionary, rollups, signal,
+    interaction and duplicate cluster tables, loaded in primary-key order
+    before their covering indexes are built, plus a trigram full-text
+    index over the drug spellings and the precomputed autocomplete
+    vocabulary. The file is analyzed, vacuumed and made read-only.
+    Returns the number of copied rows per table.
+    """
+    if os.path.exists(path):
+        raise click.ClickException(f"{path} already exists.")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    started = time.monotonic()
+    part = path + '.part'
+    if os.path.exists(part):
+        os.remove(part)
+
+    target = create_engine(f"sqlite:///{part}")
+
+    @event.listens_for(target, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        # Nothing needs to survive a crash half way through an export
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA page_size = {int(page_size)}')
+        cursor.execute('PRAGMA journal_mode = OFF')
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA cache_size = -262144')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.close()
+
+    tables = _snapshot_tables()
+    copied_names = {model.__tablename__ for model in SNAPSHOT_MODELS}
+    counts = {}
+    with engine.connect() as src, target.begin() as dst:
+        for table in tables:
+            dst.execute(CreateTable(table, include_foreign_key_constraints=[]))
+        snapshot_metadata.create_all(dst, tables=[snapshot_info, snapshot_vocabulary])
+
+        for table in tables:
+            if table.name not in copied_names:
+                continue
+            source = db.metadata.tables[table.name]
+            stmt = select(source).order_by(*source.primary_key.columns)
+            result = src.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+            counts[table.name] = 0
+            for rows in result.partitions():
+                dst.execute(table.insert(), [dict(r._mapping) for r in rows])
+                counts[table.name] += len(rows)
+            echo(f"  {table.name}: {counts[table.name]} rows")
+
+        for table in tables:
+            for index in table.indexes:
+                dst.execute(CreateIndex(index))
+        echo("  indexes built")
+
+        if fts:
+            dst.exec_driver_sql("CREATE VIRTUAL TABLE drug_alias_fts USING fts5("
+                                "alias, drug_product_id UNINDEXED, tokenize = 'trigram')")
+            dst.exec_driver_sql("INSERT INTO drug_alias_fts (alias, drug_product_id) "
+                                "SELECT alias, drug_product_id FROM drug_product_aliases")
+            echo("  drug spelling full-text index built")
+
+        vocabulary = _vocabulary_rows(src)
+        if vocabulary:
+            dst.execute(snapshot_vocabulary.insert(), vocabulary)
+        details = {
+            'created_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+            'source': engine.dialect.name,
+            'fts': '1' if fts else '0',
+        }
+        details.update({f'rows.{name}': str(n) for (name, n) in counts.items()})
+        dst.execute(snapshot_info.insert(), [{'key': k, 'value': v} for (k, v) in details.items()])
+
+    with target.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('ANALYZE')
+        conn.exec_driver_sql('VACUUM')
+        conn.exec_driver_sql('PRAGMA journal_mode = DELETE')
+    target.dispose()
+    os.replace(part, path)
+    os.chmod(path, 0o444)
+    echo(f"Wrote {path} ({os.path.getsize(path) / 2 ** 20:.1f} MiB) in {time.monotonic() - started:.1f}s")
+    return counts
+
+
+#########################
+# CLI
+#########################
+
+snapshot_cli = AppGroup('snapshot', help="Write and inspect offline read-only snapshots.")
+
+
+@snapshot_cli.command('export')
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False),
+              help="Snapshot file to write; must not exist yet.")
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help="Rows copied per batch.")
+@click.option('--page-size', default=DEFAULT_PAGE_SIZE, show_default=True,
+              help="SQLite page size of the snapshot.")
+@click.option('--no-fts', is_flag=True, help="Skip the drug spelling full-text index.")
+def export_command(output, batch_size, page_size, no_fts):
+    """
+    Writes a read-only snapshot of the database for serving with
+    DATABASE_BACKEND=snapshot.
+    """
+    if is_active():
+        raise click.ClickException("Already serving a snapshot; export from the live database.")
+    click.echo(f"Exporting to {output}")
+    export_snapshot(db.engine, output, batch_size=batch_size, page_size=page_size, fts=not no_fts)
+
+
+@snapshot_cli.command('info')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def info_command(path):
+    """
+    Prints the export details of a snapshot file.
+    """
+    engine = create_engine(snapshot_uri(path))
+    with engine.connect() as conn:
+        for (key, value) in sorted(info(conn).items()):
+            click.echo(f"{key}: {value}")
+    engine.dispose()
@@ -0,0 +1,241 @@
+# stats_engine.py
+
+from sqlalchemy import select, func, case, extract
+
+from models import db, SafetyReport, Drug, Patient, Reaction
+from query_executor import query_executor
+import drug_dictionary
+import dedup
+
+# Human-readable labels for the patientagegroup codes
+AGE_GROUP_LABELS = {1: "Neonate", 2: "Infant", 3: "Child", 4: "Adolescent", 5: "Adult", 6: "Elderly"}
+
+# Seriousness criteria shown on the dashboard, keyed by their display label
+SERIOUS_CRITERIA = [
+    ("Death", SafetyReport.seriousnessdeath),
+    ("Life-Threatening", SafetyReport.seriousnesslifethreatening),
+    ("Hospitalization", SafetyReport.seriousnesshospitalization),
+    ("Disabling", SafetyReport.seriousnessdisabling),
+    ("Congenital Anomaly", SafetyReport.seriousnesscongenitalanomali),
+    ("Other", SafetyReport.seriousnessother),
+]
+
+# Matching sets up to this size are resolved into an explicit id list;
+# larger ones are kept as a deduplicated subquery inside each statement
+INLINE_ID_LIMIT = 5000
+
+TOP_REACTIONS_LIMIT = 5
+
+# Result sections filled by each concurrent statement, for reporting timeouts
+UNAVAILABLE_SECTIONS = {
+    'monthly': 'monthly_data',
+    'age': 'age_group_counts',
+    'country': 'country_counts',
+    'reactions': 'top_reactions',
+}
+
+
+class StatisticsResult:
+    """
+    Structured result of a drug statistics computation.
+    Shared by the HTML dashboard and the JSON API.
+    """
+
+    def __init__(self, query, total_reports=0, monthly_data=None, age_group_counts=None,
+                 seriousness_counts=None, serious_criteria_counts=None,
+                 country_counts=None, top_reactions=None, unavailable=None, approximate=False, margins=None):
+        self.query = query
+        self.total_reports = total_reports
+        self.monthly_data = monthly_data or {}
+        self.age_group_counts = age_group_counts or {}
+        self.seriousness_counts = seriousness_counts or {}
+        self.serious_criteria_counts = serious_criteria_counts or {}
+        self.country_counts = country_counts or {}
+        self.top_reactions = top_reactions or {}
+        # Sections left empty because their query timed out or failed
+        self.unavailable = unavailable or []
+        # Estimated from the report sample (see approximate.py), with the
+        # 95% margin of error of every count keyed like the counts
+        self.approximate = approximate
+        self.margins = margins or {}
+
+    def to_dict(self):
+        """
+        Returns the result as a plain dictionary, suitable for JSON or templates.
+        """
+        return {
+            'query': self.query,
+            'total_reports': self.total_reports,
+            'monthly_data': self.monthly_data,
+            'age_group_counts': self.age_group_counts,
+            'seriousness_counts': self.seriousness_counts,
+            'serious_criteria_counts': self.serious_criteria_counts,
+            'country_counts': self.country_counts,
+            'top_reactions': self.top_reactions,
+            'unavailable': self.unavailable,
+            'approximate': self.approximate,
+            'margins': self.margins,
+        }
+
+
+def sort_counts_desc(counts):
+    """
+    Returns a copy of a label -> count mapping ordered by descending count.
+    """
+    return dict(sorted(counts.items(), key=lambda x: x[1], reverse=True))
+
+
+def statistics_scalar_columns():
+    """
+    Returns the total, serious, non-serious and per-criterion report counts
+    as aggregate columns over SafetyReport, in the order build_statistics_result() reads them.
+    """
+    columns = [
+        func.count(SafetyReport.safetyreportid),
+        func.sum(case((SafetyReport.serious == 1, 1), else_=0)),
+        func.sum(case((SafetyReport.serious != 1, 1), else_=0)),
+    ]
+    for (_, column) in SERIOUS_CRITERIA:
+        columns.append(func.sum(case((column == 1, 1), else_=0)))
+    return columns
+
+
+def matching_report_ids(drug_query, bind=None, deduplicated=False):
+    """
+    Builds a SELECT of the distinct report ids that mention a matching drug.
+    Deduplicates reports that list the same drug more than once.
+    The name is matched against the drug dictionary first, so the drugs
+    table is only probed by integer product id; until the dictionary has
+    been backfilled the raw product names are scanned instead.
+    With `deduplicated`, earlier versions of a case superseded by a newer
+    report are left out.
+    """
+    if drug_dictionary.dictionary_ready(bind):
+        product_ids = drug_dictionary.matching_product_ids(drug_query, bind)
+        name_filter = Drug.drug_product_id.in_(product_ids)
+    else:
+        name_filter = Drug.medicinalproduct.ilike(f"%{drug_query}%")
+    stmt = select(Drug.safetyreportid).where(name_filter)
+    if deduplicated:
+        stmt = stmt.where(dedup.canonical_only(Drug.safetyreportid))
+    return stmt.distinct()
+
+
+def resolve_report_ids(drug_query, bind=None, deduplicated=False):
+    """
+    Resolves the matching report-id set once for reuse by every breakdown.
+    Small sets become an explicit list of primary keys; larger ones stay a
+    single deduplicated subquery. Returns (ids, count), where count is None
+    when the set was left as a subquery.
+    """
+    bind = bind or db.session
+    id_select = matching_report_ids(drug_query, bind, deduplicated)
+    ids = [r[0] for r in bind.execute(id_select.limit(INLINE_ID_LIMIT + 1))]
+    if len(ids) <= INLINE_ID_LIMIT:
+        return ids, len(ids)
+    return id_select, None
+
+
+def compute_statistics(drug_query, bind=None, deduplicated=False):
+    """
+    Computes every dashboard breakdown for a drug name query.
+    Scalar and conditional counts come from one aggregate pass; the
+    grouped breakdowns reuse the same resolved report-id filter and run
+    concurrently with it on separate pooled connections.
+    """
+    if not drug_query:
+        return StatisticsResult(drug_query)
+
+    # Only the default session lets the executor spread work over the pool
+    parallel_bind = bind
+    bind = bind or db.session
+    report_ids, known_count = resolve_report_ids(drug_query, bind, deduplicated)
+    if known_count == 0:
+        return StatisticsResult(drug_query)
+    report_filter = SafetyReport.safetyreportid.in_(report_ids)
+
+    # Total, seriousness and per-criterion counts in a single aggregate pass
+    scalar_columns = statistics_scalar_columns()
+
+    # Reports per year and month
+    yr = extract('year', SafetyReport.receivedate).label('yr')
+    mo = extract('month', SafetyReport.receivedate).label('mo')
+
+    # Most frequent reactions
+    reaction_count = func.count(Reaction.id)
+
+    # The breakdowns are independent, so they run concurrently
+    statements = {
+        'scalar': select(*scalar_columns).where(report_filter),
+        'monthly': (select(yr, mo, func.count(SafetyReport.safetyreportid))
+                    .where(report_filter)
+                    .group_by(yr, mo)
+                    .order_by(yr, mo)),
+        'age': (select(Patient.patientagegroup, func.count(Patient.id))
+                .where(Patient.safetyreportid.in_(report_ids))
+                .group_by(Patient.patientagegroup)),
+        'country': (select(SafetyReport.primarysource_reportercountry, func.count(SafetyReport.safetyreportid))
+                    .where(report_filter)
+                    .group_by(SafetyReport.primarysource_reportercountry)),
+        'reactions': (select(Reaction.reactionmeddrapt, reaction_count)
+                      .where(Reaction.safetyreportid.in_(report_ids))
+                      .group_by(Reaction.reactionmeddrapt)
+                      .order_by(reaction_count.desc())
+                      .limit(TOP_REACTIONS_LIMIT)),
+    }
+    rows, failed = query_executor.run(statements, parallel_bind)
+    if 'scalar' in failed:
+        # The totals are required; retry them once on the caller's connection,
+        # under the same timeout (QueryTimeout if they miss it again)
+        rows['scalar'] = query_executor.execute(statements['scalar'], bind)
+        failed.remove('scalar')
+
+    return build_statistics_result(drug_query, rows, failed)
+
+
+def build_statistics_result(drug_query, rows, failed=()):
+    """
+    Assembles a StatisticsResult from the rows of the 'scalar', 'monthly',
+    'age', 'country' and 'reactions' statements. Missing or failed
+    breakdowns are left empty.
+    """
+    if not rows.get('scalar'):
+        return StatisticsResult(drug_query)
+    scalar_row = rows['scalar'][0]
+    total_reports = int(scalar_row[0] or 0)
+    if total_reports == 0:
+        return StatisticsResult(drug_query)
+
+    seriousness_counts = {
+        "Serious": int(scalar_row[1] or 0),
+        "Non-Serious": int(scalar_row[2] or 0),
+    }
+    serious_criteria_counts = {}
+    for (i, (label, _)) in enumerate(SERIOUS_CRITERIA):
+        serious_criteria_counts[label] = int(scalar_row[3 + i] or 0)
+
+    monthly_data = {}
+    for (y, m, cnt) in rows.get('monthly', []):
+        monthly_data[f"{int(y)}-{int(m):02d}"] = int(cnt)
+
+    age_group_counts = {}
+    for (age_val, cnt) in rows.get('age', []):
+        label = AGE_GROUP_LABELS.get(age_val, "Unknown")
+        age_group_counts[label] = age_group_counts.get(label, 0) + int(cnt)
+
+    country_counts = {}
+    for (cc, cnt) in rows.get('country', []):
+        label = cc if cc else "Unknown"
+        country_counts[label] = country_counts.get(label, 0) + int(cnt)
+
+    top_reactions = {r: int(c) for (r, c) in rows.get('reactions', [])}
+
+    return StatisticsResult(drug_query,
+                            total_reports=total_reports,
+                            monthly_data=monthly_data,
+                            age_group_counts=age_group_counts,
+                            seriousness_counts=seriousness_counts,
+                            serious_criteria_counts=sort_counts_desc(serious_criteria_counts),
+                            country_counts=sort_counts_desc(country_counts),
+                            top_reactions=sort_counts_desc(top_reactions),
+                            unavailable=[UNAVAILABLE_SECTIONS[name] for name in failed])
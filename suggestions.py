@@ -0,0 +1,221 @@
+# suggestions.py
+
+import threading
+from array import array
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from models import db, Drug, DrugProduct
+import drug_dictionary
+import snapshot
+
+
+def normalize_name(value):
+    """
+    Normalizes a drug name for grouping and matching.
+    Mirrors the strip().lower() grouping used by the report detail page.
+    """
+    if value is None:
+        return ''
+    return ' '.join(value.split()).lower()
+
+
+class _IndexSnapshot:
+    """
+    Immutable set of lookup structures produced by a single build.
+    Terms are numbered in descending frequency order, so every posting list
+    is already sorted by popularity and scans can stop after `limit` hits.
+    Posting lists are slices of one flat array of term ids rather than
+    tuples of int objects: half the memory, and scanning them does not
+    write to reference counts, so an index built before the server forks
+    stays in pages shared by all workers.
+    """
+
+    def __init__(self, terms, displays, frequencies, postings, max_gram):
+        self.terms = tuple(terms)
+        self.displays = tuple(displays)
+        self.frequencies = array('q', frequencies)
+        self.grams = {}
+        self.posting_ids = array('I')
+        for (gram, ids) in postings.items():
+            self.grams[gram] = (len(self.posting_ids), len(self.posting_ids) + len(ids))
+            self.posting_ids.extend(ids)
+        self.max_gram = max_gram
+
+    def posting(self, gram):
+        """
+        Returns the ids of the terms containing `gram`, or None.
+        """
+        bounds = self.grams.get(gram)
+        if bounds is None:
+            return None
+        return memoryview(self.posting_ids)[bounds[0]:bounds[1]]
+
+
+class SuggestionIndex:
+    """
+    In-memory n-gram index over distinct drug product and active substance names.
+    Answers prefix and substring lookups ranked by how often each name occurs,
+    without touching the database once built.
+    """
+
+    def __init__(self, max_gram=3):
+        self.max_gram = max_gram
+        self._snapshot = None
+        self.data_version = None
+        self._lock = threading.Lock()
+        self._refresh_pending = False
+        self._refresh_running = False
+        self._pending_version = None
+        self._building_version = None
+
+    @property
+    def ready(self):
+        """
+        True once the index has been built at least once.
+        """
+        return self._snapshot is not None
+
+    def build(self, entries):
+        """
+        Builds the index from an iterable of (display_name, frequency) pairs.
+        Spellings that normalize to the same term are merged, and the most
+        frequent spelling is kept for display.
+        """
+        totals = defaultdict(int)
+        best_display = {}
+        for display, freq in entries:
+            term = normalize_name(display)
+            if not term:
+                continue
+            freq = int(freq or 0)
+            totals[term] += freq
+            current = best_display.get(term)
+            if current is None or freq > current[1]:
+                best_display[term] = (display.strip(), freq)
+
+        # Highest frequency first; ties broken alphabetically for stable output
+        ordered = sorted(totals.items(), key=lambda x: (-x[1], x[0]))
+        terms = [t for (t, _) in ordered]
+        frequencies = [f for (_, f) in ordered]
+        displays = [best_display[t][0] for t in terms]
+
+        postings = defaultdict(list)
+        for term_id, term in enumerate(terms):
+            seen = set()
+            for n in range(1, self.max_gram + 1):
+                for i in range(len(term) - n + 1):
+                    gram = term[i:i + n]
+                    if gram not in seen:
+                        seen.add(gram)
+                        postings[gram].append(term_id)
+
+        # Swap the whole snapshot at once so readers never see a partial build
+        self._snapshot = _IndexSnapshot(terms, displays, frequencies, postings, self.max_gram)
+
+    def suggest(self, query, limit=10):
+        """
+        Returns up to `limit` display names containing the query.
+        Names starting with the query rank first, then by frequency.
+        """
+        snap = self._snapshot
+        q = normalize_name(query)
+        if snap is None or not q:
+            return []
+
+        # Pick the rarest n-gram of the query as the candidate list
+        if len(q) <= snap.max_gram:
+            candidates = snap.posting(q) or ()
+        else:
+            candidates = None
+            n = snap.max_gram
+            for i in range(len(q) - n + 1):
+                plist = snap.posting(q[i:i + n])
+                if plist is None:
+                    return []
+                if candidates is None or len(plist) < len(candidates):
+                    candidates = plist
+
+        prefix_hits = []
+        other_hits = []
+        terms = snap.terms
+        for term_id in candidates:
+            term = terms[term_id]
+            if term.startswith(q):
+                prefix_hits.append(term_id)
+                if len(prefix_hits) >= limit:
+                    break
+            elif len(other_hits) < limit and q in term:
+                other_hits.append(term_id)
+
+        ranked = (prefix_hits + other_hits)[:limit]
+        return [snap.displays[t] for t in ranked]
+
+    def load_from_db(self, data_version=None):
+        """
+        Rebuilds the index from the distinct names in the drugs table.
+        Products are counted per drug dictionary entry by integer id when the
+        dictionary is populated, otherwise per raw spelling.
+        A snapshot stores these counts, so serving one only reads them.
+        Records the data version it was built from, if given.
+        Must be called inside an application context.
+        """
+        vocabulary = snapshot.vocabulary_rows()
+        if vocabulary is not None:
+            self.build(vocabulary)
+            self.data_version = data_version
+            return
+        if drug_dictionary.dictionary_ready():
+            counts = (db.session.query(Drug.drug_product_id, func.count(Drug.id).label('n'))
+                      .group_by(Drug.drug_product_id)
+                      .subquery())
+            product_rows = (db.session.query(DrugProduct.display_name, counts.c.n)
+                            .join(counts, counts.c.drug_product_id == DrugProduct.id)
+                            .all())
+        else:
+            product_rows = (db.session.query(Drug.medicinalproduct, func.count(Drug.id))
+                            .group_by(Drug.medicinalproduct)
+                            .all())
+        substance_rows = (db.session.query(Drug.activesubstancename, func.count(Drug.id))
+                          .filter(Drug.activesubstancename.isnot(None))
+                          .group_by(Drug.activesubstancename)
+                          .all())
+        self.build(list(product_rows) + list(substance_rows))
+        self.data_version = data_version
+
+    def refresh_in_background(self, app, data_version=None):
+        """
+        Schedules a rebuild on a background thread.
+        Requests made while a rebuild is running are coalesced into one more
+        pass, and requests for the version already being built are ignored.
+        """
+        with self._lock:
+            if self._refresh_running:
+                if data_version != self._building_version:
+                    self._pending_version = data_version
+                    self._refresh_pending = True
+                return
+            self._refresh_running = True
+            self._building_version = data_version
+
+        def worker():
+            while True:
+                try:
+                    with app.app_context():
+                        self.load_from_db(self._building_version)
+                        db.session.remove()
+                except Exception as e:
+                    app.logger.warning("Suggestion index refresh failed: %s", e)
+                with self._lock:
+                    if not self._refresh_pending:
+                        self._refresh_running = False
+                        return
+                    self._refresh_pending = False
+                    self._building_version = self._pending_version
+
+        threading.Thread(target=worker, daemon=True).start()
+
+
+# Shared index used by the autocomplete route
+suggestion_index = SuggestionIndex()
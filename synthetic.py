@@ -0,0 +1,242 @@
+# synthetic.py
+
+import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from models import db
+import ingest
+import rollups
+from caching import view_cache
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+# Reports generated and written per transaction
+DEFAULT_BATCH_SIZE = 5000
+
+# Syllables combined into made-up product names
+NAME_PREFIXES = ['Ab', 'Ac', 'Al', 'Am', 'Ar', 'Bel', 'Cal', 'Cor', 'Dex', 'Dul', 'Ena', 'Far', 'Glu', 'Hy',
+                 'Ib', 'Jar', 'Ket', 'Lam', 'Lev', 'Met', 'Nap', 'Ola', 'Pan', 'Que', 'Ris', 'Sim', 'Tam',
+                 'Val', 'War', 'Xel', 'Zol']
+NAME_MIDDLES = ['', 'a', 'e', 'i', 'o', 'u', 'ara', 'eni', 'ilo', 'ora', 'uti']
+NAME_SUFFIXES = ['cin', 'dine', 'fen', 'lol', 'mab', 'nib', 'pam', 'pril', 'sartan', 'statin', 'tide',
+                 'vir', 'xaban', 'zole', 'mide', 'trel']
+
+# Common MedDRA preferred terms; rarer terms are synthesized after these
+COMMON_REACTIONS = ['Nausea', 'Headache', 'Fatigue', 'Dizziness', 'Diarrhoea', 'Vomiting', 'Rash',
+                    'Pruritus', 'Drug ineffective', 'Dyspnoea', 'Pain', 'Arthralgia', 'Pyrexia',
+                    'Death', 'Insomnia', 'Malaise', 'Abdominal pain', 'Anxiety', 'Back pain',
+                    'Hypertension', 'Cough', 'Weight decreased', 'Off label use', 'Asthenia', 'Fall']
+
+# Reporter countries in rough order of report volume
+COUNTRIES = ['US', 'GB', 'JP', 'FR', 'DE', 'CA', 'IT', 'ES', 'BR', 'AU', 'NL', 'IN', 'CN', 'KR', 'SE',
+             'CH', 'BE', 'PL', 'MX', 'AR']
+
+ROUTES = ['048', '042', '058', '061', '065']
+FORMS = ['TABLET', 'CAPSULE', 'INJECTION', 'SOLUTION', 'CREAM']
+UNITS = ['003', '004', '012', '032']
+
+
+def zipf_weights(n, exponent):
+    """
+    Returns normalized Zipf probabilities for ranks 1..n.
+    """
+    weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** exponent
+    return weights / weights.sum()
+
+
+def make_drug_names(rng, count):
+    """
+    Generates `count` distinct (product, substance) name pairs.
+    Syllable combinations are used in random order, then reused with a
+    numeric strength suffix once they run out.
+    """
+    combos = list(dict.fromkeys((p + m + s).capitalize()
+                                for p in NAME_PREFIXES for m in NAME_MIDDLES for s in NAME_SUFFIXES))
+    order = rng.permutation(len(combos))
+    result = []
+    for k in range(count):
+        base = combos[order[k % len(combos)]]
+        name = base if k < len(combos) else f"{base} {k // len(combos) * 10}"
+        substance = base.upper() + (' HYDROCHLORIDE' if k % 7 == 0 else '')
+        result.append((name, substance))
+    return result
+
+
+def make_reaction_terms(count):
+    """
+    Returns `count` reaction terms: the common ones first, then numbered rarities.
+    """
+    terms = COMMON_REACTIONS[:count]
+    terms += [f"Reaction term {i:05d}" for i in range(count - len(terms))]
+    return terms
+
+
+class SyntheticGenerator:
+    """
+    Produces skewed synthetic reports in the mapped-record format used by
+    the ingest writer: (report, company, patients, drugs, reactions).
+    Drug and reaction popularity follow Zipf distributions, reports carry
+    several drugs and reactions, and seriousness criteria are mostly null.
+    """
+
+    def __init__(self, seed=42, n_drugs=5000, n_reactions=2000, n_companies=200,
+                 start_date=datetime.date(2004, 1, 1), end_date=datetime.date(2024, 12, 31),
+                 drug_exponent=1.1, reaction_exponent=1.0):
+        self.rng = np.random.default_rng(seed)
+        self.drugs = make_drug_names(self.rng, n_drugs)
+        self.reactions = make_reaction_terms(n_reactions)
+        self.companies = [(f"SYN-CO-{i:05d}", f"Synthetic Pharma {i}") for i in range(n_companies)]
+        self.drug_p = zipf_weights(n_drugs, drug_exponent)
+        self.reaction_p = zipf_weights(n_reactions, reaction_exponent)
+        self.country_p = zipf_weights(len(COUNTRIES), 1.3)
+        self.company_p = zipf_weights(n_companies, 1.0)
+        self.start_ordinal = start_date.toordinal()
+        self.span_days = end_date.toordinal() - self.start_ordinal
+
+    def batch(self, first_index, count):
+        """
+        Returns `count` mapped records numbered from `first_index`.
+        """
+        rng = self.rng
+
+        # Per-report draws, vectorized for the whole batch
+        serious = np.where(rng.random(count) < 0.55, 1, 2)
+        # Report volume grows over time: square-root warping skews dates recent
+        days = (np.sqrt(rng.random(count)) * self.span_days).astype(np.int64)
+        lag = rng.integers(0, 30, count)
+        country = rng.choice(len(COUNTRIES), count, p=self.country_p)
+        country_missing = rng.random(count) < 0.05
+        company = rng.choice(len(self.companies), count, p=self.company_p)
+        company_missing = rng.random(count) < 0.4
+        n_drugs = np.minimum(rng.geometric(0.45, count), 20)
+        n_reactions = np.minimum(rng.geometric(0.5, count), 15)
+        n_patients = np.where(rng.random(count) < 0.02, 2, 1)
+        criteria = rng.random((count, 6))
+
+        drug_idx = rng.choice(len(self.drugs), int(n_drugs.sum()), p=self.drug_p)
+        reaction_idx = rng.choice(len(self.reactions), int(n_reactions.sum()), p=self.reaction_p)
+        drug_role = rng.choice([1, 2, 3], len(drug_idx), p=[0.6, 0.35, 0.05])
+        drug_upper = rng.random(len(drug_idx)) < 0.15
+        drug_sparse = rng.random(len(drug_idx)) < 0.7
+        outcomes = rng.integers(1, 7, len(reaction_idx))
+        age_groups = rng.choice([0, 1, 2, 3, 4, 5, 6], int(n_patients.sum()),
+                                p=[0.45, 0.01, 0.01, 0.03, 0.05, 0.3, 0.15])
+        sexes = rng.choice([0, 1, 2], len(age_groups), p=[0.15, 0.4, 0.45])
+
+        records = []
+        d_pos = r_pos = p_pos = 0
+        for i in range(count):
+            report_id = f"SYN{first_index + i:010d}"
+            received = datetime.date.fromordinal(self.start_ordinal + int(days[i]))
+            is_serious = serious[i] == 1
+            # Only serious reports have criteria, and most criteria stay null
+            flags = [1 if is_serious and criteria[i, k] < rate else None
+                     for (k, rate) in enumerate((0.12, 0.05, 0.45, 0.03, 0.01, 0.6))]
+            companynumb = None if company_missing[i] else self.companies[company[i]][0]
+            report = {
+                'safetyreportid': report_id,
+                'serious': int(serious[i]),
+                'seriousnessdeath': flags[0],
+                'seriousnesslifethreatening': flags[1],
+                'seriousnesshospitalization': flags[2],
+                'seriousnessdisabling': flags[3],
+                'seriousnesscongenitalanomali': flags[4],
+                'seriousnessother': flags[5],
+                'receivedate': received,
+                'receiptdate': received + datetime.timedelta(days=int(lag[i])),
+                'primarysource_reportercountry': None if country_missing[i] else COUNTRIES[country[i]],
+                'companynumb': companynumb,
+            }
+            company_row = None
+            if companynumb:
+                company_row = {'companynumb': companynumb, 'companyname': self.companies[company[i]][1]}
+
+            patients = []
+            for _ in range(n_patients[i]):
+                patients.append({
+                    'safetyreportid': report_id,
+                    'patientagegroup': int(age_groups[p_pos]) or None,
+                    'patientsex': int(sexes[p_pos]) or None,
+                })
+                p_pos += 1
+
+            drugs = []
+            for _ in range(n_drugs[i]):
+                name, substance = self.drugs[drug_idx[d_pos]]
+                sparse = drug_sparse[d_pos]
+                drugs.append({
+                    'safetyreportid': report_id,
+                    'drugcharacterization': int(drug_role[d_pos]),
+                    'medicinalproduct': name.upper() if drug_upper[d_pos] else name,
+                    'drugstructuredosagenumb': None if sparse else int(drug_idx[d_pos] % 500 + 1),
+                    'drugstructuredosageunit': None if sparse else UNITS[drug_idx[d_pos] % len(UNITS)],
+                    'drugdosagetext': None,
+                    'drugdosageform': None if sparse else FORMS[drug_idx[d_pos] % len(FORMS)],
+                    'drugadministrationroute': None if sparse else ROUTES[drug_idx[d_pos] % len(ROUTES)],
+                    'drugindication': None,
+                    'actiondrug': None if sparse else int(drug_idx[d_pos] % 6 + 1),
+                    'drugrecurreadministration': None,
+                    'drugadditional': None,
+                    'activesubstancename': None if sparse else substance,
+                })
+                d_pos += 1
+
+            reactions = []
+            for _ in range(n_reactions[i]):
+                reactions.append({
+                    'safetyreportid': report_id,
+                    'reactionmeddrapt': self.reactions[reaction_idx[r_pos]],
+                    'reactionoutcome': int(outcomes[r_pos]),
+                })
+                r_pos += 1
+
+            records.append((report, company_row, patients, drugs, reactions))
+        return records
+
+
+def generate(reports, seed=42, start=0, batch_size=DEFAULT_BATCH_SIZE, n_drugs=5000, n_reactions=2000,
+             n_companies=200, maintain_rollups=False):
+    """
+    Writes `reports` synthetic reports numbered from `start` into the
+    configured database, one transaction per batch. Rerunning with the same
+    arguments replaces the same reports with identical data.
+    Returns the ingest progress counters.
+    """
+    generator = SyntheticGenerator(seed=seed, n_drugs=n_drugs, n_reactions=n_reactions, n_companies=n_companies)
+    progress = ingest._Progress()
+    for first in range(start, start + reports, batch_size):
+        count = min(batch_size, start + reports - first)
+        batch = generator.batch(first, count)
+        with db.engine.begin() as conn:
+            rows = ingest.write_batch(conn, batch, maintain_rollups=maintain_rollups)
+        progress.add(count, 0, rows)
+    progress.add(0, 0, 0, force=True)
+    return progress
+
+
+@click.command('synth')
+@click.option('--reports', default=10000, show_default=True, help="Number of reports to generate.")
+@click.option('--seed', default=42, show_default=True, help="Random seed; equal seeds give equal data.")
+@click.option('--start', default=0, show_default=True, help="Number of the first report (to append).")
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help="Reports written per transaction.")
+@click.option('--drugs', 'n_drugs', default=5000, show_default=True, help="Distinct drug products.")
+@click.option('--reactions', 'n_reactions', default=2000, show_default=True, help="Distinct reaction terms.")
+@click.option('--companies', 'n_companies', default=200, show_default=True, help="Distinct companies.")
+@click.option('--skip-rollups', is_flag=True, help="Leave the per-drug rollup tables untouched.")
+@with_appcontext
+def synth_command(reports, seed, start, batch_size, n_drugs, n_reactions, n_companies, skip_rollups):
+    """
+    Fills the database with skewed synthetic reports for benchmarking.
+    """
+    db.create_all()
+    generate(reports, seed=seed, start=start, batch_size=batch_size, n_drugs=n_drugs,
+             n_reactions=n_reactions, n_companies=n_companies)
+    if not skip_rollups:
+        click.echo("Rebuilding rollups...")
+        rollups.rebuild_all()
+        db.session.commit()
+    view_cache.bump_data_version()
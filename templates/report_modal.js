@@ -0,0 +1,163 @@
+// templates/report_modal.js
+// Report details modal shared by the listing and search pages.
+// Reports are fetched from /api/reports and rendered in the browser.
+
+const AGE_GROUPS = {1: 'Neonate', 2: 'Infant', 3: 'Child', 4: 'Adolescent', 5: 'Adult', 6: 'Elderly'};
+const SEXES = {1: 'Male', 2: 'Female'};
+const REACTION_OUTCOMES = {
+  1: 'Recovered/Resolved',
+  2: 'Recovering/Resolving',
+  3: 'Not Recovered/Not Resolved',
+  4: 'Recovered/Resolved with Sequelae',
+  5: 'Fatal',
+  6: 'Unknown'
+};
+const DRUG_CHARACTERIZATIONS = {1: 'Suspect', 2: 'Concomitant', 3: 'Interacting'};
+const SERIOUSNESS_CRITERIA = [
+  ['seriousnessdeath', 'Death'],
+  ['seriousnesslifethreatening', 'Life-Threatening'],
+  ['seriousnesshospitalization', 'Hospitalization'],
+  ['seriousnessdisabling', 'Disabling'],
+  ['seriousnesscongenitalanomali', 'Congenital Anomaly'],
+  ['seriousnessother', 'Other Medically Important Condition']
+];
+
+/**
+ * Escapes text for insertion into HTML.
+ * @param {*} value - The value to escape; null and undefined become ''.
+ */
+function escapeHtml(value) {
+  return String(value ?? '').replace(/[&<>"']/g, c => ({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+  })[c]);
+}
+
+/**
+ * Groups a report's drugs by drug dictionary product (or spelling), so
+ * repeated entries of one product are shown once with a count.
+ * @param {Array} drugs - The report's drug records.
+ */
+function groupDrugs(drugs) {
+  const groups = new Map();
+  for (const d of drugs) {
+    const key = d.drug_product_id ?? (d.medicinalproduct || 'Unknown').trim().toLowerCase();
+    if (!groups.has(key)) {
+      groups.set(key, {medicinalproduct: d.medicinalproduct || 'Unknown', count: 0, first: d});
+    }
+    groups.get(key).count += 1;
+  }
+  return [...groups.values()];
+}
+
+/**
+ * Builds the details markup of one report returned by /api/reports.
+ * @param {Object} report - The compact report object (empty fields omitted).
+ */
+function renderReport(report) {
+  const yesNo = value => value === 1 ? 'Yes' : 'No';
+  let html = '<div class="p-4 overflow-y-auto max-h-[80vh]">';
+  html += '<h2 class="text-2xl font-bold mb-4">Safety Report Details</h2>';
+  html += `<p><strong>ID:</strong> ${escapeHtml(report.safetyreportid)}</p>`;
+  html += `<p><strong>Date Received:</strong> ${escapeHtml(report.receivedate || 'N/A')}</p>`;
+  html += `<p><strong>Date of Receipt:</strong> ${escapeHtml(report.receiptdate || 'N/A')}</p>`;
+  html += `<p><strong>Serious:</strong> ${yesNo(report.serious)}</p>`;
+  if (report.serious === 1) {
+    html += '<ul class="list-disc list-inside ml-4">';
+    for (const [field, label] of SERIOUSNESS_CRITERIA) {
+      html += `<li><strong>${label}:</strong> ${yesNo(report[field])}</li>`;
+    }
+    html += '</ul>';
+  }
+  html += `<p><strong>Reporter Country:</strong> ${escapeHtml(report.primarysource_reportercountry || 'N/A')}</p>`;
+
+  html += '<h3 class="text-xl font-semibold mt-6 mb-2">Company</h3>';
+  if (report.companynumb) {
+    html += `<p><strong>Number:</strong> ${escapeHtml(report.companynumb)}</p>`;
+    html += `<p><strong>Name:</strong> ${escapeHtml(report.companyname)}</p>`;
+  } else {
+    html += '<p>No company information available.</p>';
+  }
+
+  html += '<h3 class="text-xl font-semibold mt-6 mb-2">Patients</h3>';
+  if (report.patients.length) {
+    html += '<ul class="list-disc list-inside">';
+    for (const p of report.patients) {
+      html += `<li><strong>Age Group:</strong> ${AGE_GROUPS[p.patientagegroup] || 'Unknown'}`
+            + ` &nbsp;|&nbsp; <strong>Sex:</strong> ${SEXES[p.patientsex] || 'Unknown'}</li>`;
+    }
+    html += '</ul>';
+  } else {
+    html += '<p>No patient records available.</p>';
+  }
+
+  html += '<h3 class="text-xl font-semibold mt-6 mb-2">Reactions</h3>';
+  if (report.reactions.length) {
+    html += '<ul class="list-disc list-inside">';
+    for (const r of report.reactions) {
+      html += `<li><strong>Reaction:</strong> ${escapeHtml(r.reactionmeddrapt)}`
+            + ` <strong>Outcome:</strong> ${REACTION_OUTCOMES[r.reactionoutcome] || 'Unknown'}</li>`;
+    }
+    html += '</ul>';
+  } else {
+    html += '<p>No reactions recorded.</p>';
+  }
+
+  html += '<h3 class="text-xl font-semibold mt-6 mb-2">Drugs</h3>';
+  const groups = groupDrugs(report.drugs);
+  if (groups.length) {
+    html += '<ul class="list-disc list-inside">';
+    for (const g of groups) {
+      const d = g.first;
+      html += `<li class="mb-3"><strong>Medicinal Product:</strong> ${escapeHtml(g.medicinalproduct)}`;
+      if (g.count > 1) {
+        html += ` (repeated ${g.count} times)`;
+      }
+      html += '<br><ul class="list-disc list-inside ml-4">';
+      if (d.drugcharacterization) {
+        html += `<li><strong>Characterization:</strong> ${DRUG_CHARACTERIZATIONS[d.drugcharacterization] || 'Unknown'}</li>`;
+      }
+      if (d.drugdosageform) {
+        html += `<li><strong>Dosage Form:</strong> ${escapeHtml(d.drugdosageform)}</li>`;
+      }
+      if (d.drugadministrationroute) {
+        html += `<li><strong>Administration Route:</strong> ${escapeHtml(d.drugadministrationroute)}</li>`;
+      }
+      if (d.drugindication) {
+        html += `<li><strong>Indication:</strong> ${escapeHtml(d.drugindication)}</li>`;
+      }
+      if (d.activesubstancename) {
+        html += `<li><strong>Active Substance:</strong> ${escapeHtml(d.activesubstancename)}</li>`;
+      }
+      html += '</ul></li>';
+    }
+    html += '</ul>';
+  } else {
+    html += '<p>No drug information available.</p>';
+  }
+  return html + '</div>';
+}
+
+/**
+ * Opens the report details modal and fetches the report from the JSON API.
+ * @param {string} safetyReportId - The ID of the safety report to display.
+ */
+function openModal(safetyReportId) {
+  document.getElementById('report-modal').classList.remove('hidden');
+  fetch(`/api/reports?ids=${encodeURIComponent(safetyReportId)}`)
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+      }
+      return response.json();
+    })
+    .then(data => {
+      if (!data.reports.length) {
+        throw new Error('Report not found');
+      }
+      document.getElementById('modal-content').innerHTML = renderReport(data.reports[0]);
+    })
+    .catch(error => {
+      console.error('Error fetching report details:', error);
+      document.getElementById('modal-content').innerHTML = '<p class="text-center text-red-500">Failed to load report details.</p>';
+    });
+}
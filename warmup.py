@@ -0,0 +1,93 @@
+# warmup.py
+
+import gc
+import time
+from urllib.parse import urlencode
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from models import db, DrugSeriousnessRollup
+from caching import view_cache
+from suggestions import suggestion_index
+from query_executor import query_executor
+from jobs import job_queue
+import columnar
+import approximate
+import drug_dictionary
+
+
+def hot_urls(top_drugs, extra_urls=()):
+    """
+    Returns the pages worth rendering ahead of the first request: the
+    report listing, the statistics of the `top_drugs` most reported drugs
+    (by the rollup tables) and any configured extra URLs.
+    """
+    urls = ['/']
+    if top_drugs:
+        drug_keys = db.session.execute(select(DrugSeriousnessRollup.drug_key)
+                                       .where(DrugSeriousnessRollup.criterion == 'total')
+                                       .order_by(DrugSeriousnessRollup.report_count.desc())
+                                       .limit(top_drugs)).scalars().all()
+        for key in drug_keys:
+            urls.append('/statistics?' + urlencode({'drug': key}))
+            urls.append('/api/statistics?' + urlencode({'drug': key}))
+    urls.extend(u for u in extra_urls if u)
+    return urls
+
+
+def warm_up(app, echo=None):
+    """
+    Prepares a process that is about to fork into server workers:
+    loads the drug dictionary state, the autocomplete index, the columnar
+    store and the report sample of approximate mode, renders the hottest pages into the response cache,
+    then releases every database connection so no socket is shared across
+    the fork. With WARMUP_FREEZE_GC the surviving objects are moved out of
+    the garbage collector's reach, so collections in the workers do not
+    write to (and thereby copy) the pages they all inherit.
+    Returns (seconds taken, number of pages rendered).
+    """
+    started = time.perf_counter()
+    with app.app_context():
+        data_version = view_cache.data_version()
+        drug_dictionary.dictionary_ready()
+        suggestion_index.load_from_db(data_version)
+        columnar.get_store()
+        approximate.get_index()
+        urls = hot_urls(app.config.get('WARMUP_TOP_DRUGS', 10), app.config.get('WARMUP_URLS', []))
+        db.session.remove()
+
+    # Rendered inline: neither job processes nor query threads may exist before the fork
+    saved = (job_queue.enabled, query_executor.enabled)
+    (job_queue.enabled, query_executor.enabled) = (False, False)
+    client = app.test_client()
+    try:
+        for url in urls:
+            status = client.get(url).status_code
+            if echo:
+                echo(f"  {status} {url}")
+    finally:
+        (job_queue.enabled, query_executor.enabled) = saved
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    if app.config.get('WARMUP_FREEZE_GC', True):
+        gc.collect()
+        gc.freeze()
+    elapsed = time.perf_counter() - started
+    app.logger.info("Warm-up rendered %d pages in %.2fs", len(urls), elapsed)
+    return elapsed, len(urls)
+
+
+@click.command('warmup')
+@with_appcontext
+def warmup_command():
+    """
+    Runs the pre-fork warm-up once and reports what it loaded. Useful to
+    fill a shared response cache (Redis or filesystem) after a deploy.
+    """
+    (elapsed, pages) = warm_up(current_app._get_current_object(), echo=click.echo)
+    click.echo(f"Warmed {pages} pages in {elapsed:.2f}s")